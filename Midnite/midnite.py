@@ -6,62 +6,602 @@ __author__ = "David Durost <david.durost@gmail.com>"
 __version__ = "0.2.1"
 __license__ = "Apache2"
 
-from copy import deepcopy
-import sys
+import select
+import struct
+import threading
+import time
 
 import pymodbus.exceptions
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from collections.abc import ItemsView, Mapping
 from pymodbus.client.sync import ModbusTcpClient as ModbusClient
 from pymodbus.constants import Endian
-from pymodbus.payload import BinaryPayloadDecoder
-from functools import partial
-from tenacity import retry, stop_after_attempt, wait_random, retry_if_exception_type
+from tenacity import Retrying, stop_after_attempt, stop_after_delay, wait_random, retry_if_exception_type
 import logging
 logger = logging.getLogger(__appname__)
 
+# Maximum number of registers in a single modbus read
+MAX_READ_COUNT = 125
+
+# Register field types (struct format, size in bytes)
+FIELD_TYPES = {
+    'uint8': ('B', 1),
+    'int8': ('b', 1),
+    'uint16': ('H', 2),
+    'int16': ('h', 2),
+    'uint32': ('I', 4),
+    'int32': ('i', 4),
+}
+
+# Register Field
+#   register   Classic register number (one above its modbus address)
+#   name       Key in the decoded data
+#   type       One of FIELD_TYPES, 8 bit fields fill the MSB then the LSB
+#   scale      Divisor applied to the raw value
+#   offset     Added to the raw value after scaling
+#   wordorder  Word order of 32 bit values
+#   unit       Unit of measurement of the decoded value
+Field = namedtuple(
+    'Field', ['register', 'name', 'type', 'scale', 'offset', 'wordorder', 'unit'])
+Field.__new__.__defaults__ = (None, None, Endian.Little, None)
+
+
+# Register refresh tiers
+#   static  Identity registers, read once and again after invalidation
+#   slow    Settings, refreshed every slow tier ttl
+#   fast    Telemetry, read every poll
+STATIC = 'static'
+SLOW = 'slow'
+FAST = 'fast'
+
+
+class RegisterBlock:
+    """A run of Classic registers decoded with one precompiled struct."""
+
+    def __init__(self, address, count, fields, tier=FAST, byteorder=Endian.Big):
+        """Constructor."""
+        self.address = address
+        self.count = count
+        self.fields = fields
+        self.tier = tier
+        self.names = tuple(field.name for field in fields)
+        self.compile(byteorder)
+
+    def compile(self, byteorder):
+        """Build the struct format and value fixups for this block."""
+        fmt = byteorder
+        cursor = 0
+        index = 0
+        # Indexes of little word order 32 bit values split over two slots
+        self.words = []
+        # (index, scale, offset) of scaled values
+        self.scales = []
+
+        for position, field in enumerate(self.fields):
+            char, size = FIELD_TYPES[field.type]
+            target = (field.register - 1 - self.address) * 2
+            if cursor < target:
+                fmt += '{}x'.format(target - cursor)
+                cursor = target
+            elif cursor >= target + 2:
+                raise ValueError("Register field {} overlaps {}".format(
+                    field.name, cursor // 2 + self.address + 1))
+
+            if size == 4 and field.wordorder == Endian.Little:
+                # Low word first, the high word carries the sign
+                fmt += 'H' + ('h' if char == 'i' else 'H')
+                self.words.append(index)
+                index += 1
+            else:
+                fmt += char
+            index += 1
+            cursor += size
+
+            if field.scale is not None or field.offset is not None:
+                self.scales.append((
+                    position,
+                    field.scale or 1.0,
+                    field.offset or 0.0))
+
+        if cursor > self.count * 2:
+            raise ValueError("Register block {} is shorter than its fields".format(
+                self.address))
+
+        self.words.reverse()
+        self.struct = struct.Struct(fmt)
+        self.packer = struct.Struct('>{}H'.format(self.count))
+
+    def decode(self, registers):
+        """Decode the block registers into an ordered dict."""
+        return OrderedDict(zip(self.names, self.unpack(registers)))
+
+    def unpack(self, registers):
+        """Decode the block registers into its field values, in order."""
+        if len(registers) == self.count:
+            buffer = self.packer.pack(*registers)
+        else:
+            buffer = struct.pack('>{}H'.format(len(registers)), *registers)
+        values = self.struct.unpack_from(buffer)
+
+        if self.words or self.scales:
+            values = list(values)
+            # Join split 32 bit values, last first so indexes stay put
+            for index in self.words:
+                values[index] = values[index + 1] << 16 | values[index]
+                del values[index + 1]
+            for index, scale, offset in self.scales:
+                values[index] = values[index] / scale + offset
+
+        return values
+
+
+# Classic register map (modbus address: block)
+REGISTER_MAP = OrderedDict((block.address, block) for block in [
+    RegisterBlock(4100, 12, [
+        Field(4101, 'pcb_revision', 'uint8'),
+        Field(4101, 'unit_type', 'uint8'),
+        Field(4102, 'build_year', 'uint16'),
+        Field(4103, 'build_month', 'uint8'),
+        Field(4103, 'build_day', 'uint8'),
+        Field(4104, 'info_flag_bits_3', 'uint16'),
+        # 4105 Reserved
+        Field(4106, 'mac_1', 'uint8'),
+        Field(4106, 'mac_0', 'uint8'),
+        Field(4107, 'mac_3', 'uint8'),
+        Field(4107, 'mac_2', 'uint8'),
+        Field(4108, 'mac_5', 'uint8'),
+        Field(4108, 'mac_4', 'uint8'),
+        # 4109, 4110 Reserved
+        Field(4111, 'unit_id', 'int32'),
+    ], STATIC),
+    RegisterBlock(4112, 32, [
+        Field(4113, 'status_roll', 'uint16'),
+        Field(4114, 'restart_timer_ms', 'uint16'),
+        Field(4115, 'avg_battery_voltage', 'int16', 10.0, unit='V'),
+        Field(4116, 'avg_pv_voltage', 'uint16', 10.0, unit='V'),
+        Field(4117, 'avg_battery_current', 'uint16', 10.0, unit='A'),
+        Field(4118, 'avg_energy_today', 'uint16', 10.0, unit='kWh'),
+        Field(4119, 'avg_power', 'uint16', 1.0, unit='W'),
+        Field(4120, 'charge_stage', 'uint8'),
+        Field(4120, 'charge_state', 'uint8'),
+        Field(4121, 'avg_pv_current', 'uint16', 10.0, unit='A'),
+        Field(4122, 'last_voc', 'uint16', 10.0, unit='V'),
+        Field(4123, 'highest_pv_voltage_seen', 'uint16', unit='V'),
+        Field(4124, 'match_point_shadow', 'uint16'),
+        Field(4125, 'amphours_today', 'uint16', unit='Ah'),
+        Field(4126, 'lifetime_energy', 'uint32', 10.0, unit='kWh'),
+        Field(4128, 'lifetime_amphours', 'uint32', unit='Ah'),
+        Field(4130, 'info_flags_bits', 'int32'),
+        Field(4132, 'battery_temperature', 'int16', 10.0, unit='°C'),
+        Field(4133, 'fet_temperature', 'int16', 10.0, unit='°C'),
+        Field(4134, 'pcb_temperature', 'int16', 10.0, unit='°C'),
+        Field(4135, 'no_power_timer', 'uint16', unit='s'),
+        # In seconds, minimum: 1 minute
+        Field(4136, 'log_interval', 'uint16', unit='s'),
+        Field(4137, 'modbus_port_register', 'uint16'),
+        Field(4138, 'float_time_today', 'uint16', unit='s'),
+        Field(4139, 'absorb_time', 'uint16', unit='s'),
+        # 4140 Reserved
+        Field(4141, 'pwm_readonly', 'uint16'),
+        Field(4142, 'reason_for_reset', 'uint16'),
+        Field(4143, 'equalize_time', 'uint16', unit='s'),
+    ]),
+    RegisterBlock(4163, 2, [
+        Field(4164, 'mppt_mode', 'uint16'),
+        Field(4165, 'aux1_and_2_function', 'int16'),
+    ], SLOW),
+    RegisterBlock(4209, 4, [
+        Field(4210, 'name_0', 'uint8'),
+        Field(4210, 'name_1', 'uint8'),
+        Field(4211, 'name_2', 'uint8'),
+        Field(4211, 'name_3', 'uint8'),
+        Field(4212, 'name_4', 'uint8'),
+        Field(4212, 'name_5', 'uint8'),
+        Field(4213, 'name_6', 'uint8'),
+        Field(4213, 'name_7', 'uint8'),
+    ], STATIC),
+    RegisterBlock(4243, 32, [
+        Field(4244, 'temp_regulated_battery_target_voltage', 'int16', 10.0, unit='V'),
+        # 4245, 4246 Settings, in the slow block below
+        # 4247 - 4274 Reserved
+        Field(4275, 'reason_for_resting', 'uint16'),
+    ]),
+    RegisterBlock(4244, 2, [
+        Field(4245, 'nominal_battery_voltage', 'uint16', unit='V'),
+        Field(4246, 'ending_amps', 'int16', 10.0, unit='A'),
+    ], SLOW),
+    RegisterBlock(4360, 22, [
+        Field(4361, 'wbjr_cmd_s', 'uint16'),
+        Field(4362, 'wbjr_raw_current', 'int16'),
+        # 4363, 4364 Reserved
+        Field(4365, 'wbjr_pos_amphour', 'uint32', unit='Ah'),
+        Field(4367, 'wbjr_neg_amphour', 'int32', unit='Ah'),
+        Field(4369, 'wbjr_net_amphour', 'int32', unit='Ah'),
+        Field(4371, 'wbjr_battery_current', 'int16', 10.0, unit='A'),
+        Field(4372, 'wbjr_crc', 'int8'),
+        Field(4372, 'shunt_temperature', 'int8', offset=-50.0, unit='°C'),
+        Field(4373, 'soc', 'uint16', unit='%'),
+        # 4374 - 4376 Reserved
+        Field(4377, 'remaining_amphours', 'uint16', unit='Ah'),
+        # 4378 - 4380 Reserved
+        Field(4381, 'total_amphours', 'uint16', unit='Ah'),
+    ]),
+    RegisterBlock(16386, 4, [
+        Field(16387, 'app_rev', 'uint32'),
+        Field(16389, 'net_rev', 'uint32'),
+    ], STATIC),
+])
+
+# Register blocks read from the Classic (start address: register count)
+REGISTER_BLOCKS = OrderedDict(
+    (address, block.count) for address, block in REGISTER_MAP.items())
+
+# Field names in register map order and their slot in snapshots
+FIELD_NAMES = tuple(
+    field.name for block in REGISTER_MAP.values() for field in block.fields)
+FIELD_INDEX = {name: index for index, name in enumerate(FIELD_NAMES)}
+# Each block fills the slots from its first field on
+for block in REGISTER_MAP.values():
+    block.slot = FIELD_INDEX[block.names[0]]
+# Block holding the reason for the last Classic reset
+RESET_FIELD = 'reason_for_reset'
+RESET_BLOCK = next(
+    address for address, block in REGISTER_MAP.items() if RESET_FIELD in block.names)
+
+
+class SnapshotItems(ItemsView):
+    """Items of a snapshot, zipped instead of looked up one by one."""
+
+    __slots__ = ()
+
+    def __iter__(self):
+        """Iterate (name, value) pairs in register map order."""
+        return zip(FIELD_NAMES, self._mapping.values)
+
+
+class Snapshot(Mapping):
+    """Immutable view of Classic field values, keyed by the register map.
+
+    Holds one tuple of values and shares the field names and slots of the
+    register map, so taking one costs a single allocation and it can be
+    handed to any number of consumers without copying.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        """Constructor."""
+        self.values = tuple(values)
+
+    def __getitem__(self, key):
+        """Return the value of a field."""
+        return self.values[FIELD_INDEX[key]]
+
+    def __iter__(self):
+        """Iterate field names in register map order."""
+        return iter(FIELD_NAMES)
+
+    def __len__(self):
+        """Return the number of fields."""
+        return len(FIELD_NAMES)
+
+    def __contains__(self, key):
+        """Return whether a field is in the register map."""
+        return key in FIELD_INDEX
+
+    def __eq__(self, other):
+        """Compare values, directly against another snapshot."""
+        if isinstance(other, Snapshot):
+            return self.values == other.values
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def items(self):
+        """Return (name, value) pairs."""
+        return SnapshotItems(self)
+
+    def __repr__(self):
+        """Return the snapshot as a dict literal."""
+        return "Snapshot({})".format(dict(self.items()))
+
+
+# Plan Reads
+def planReads(blocks, gap=0, limit=MAX_READ_COUNT):
+    """Merge neighbouring register blocks into as few reads as possible.
+
+    Blocks separated by no more than `gap` unused registers are read
+    together, as long as the merged read stays within `limit` registers.
+    Returns a list of (addr, count, members) tuples, where members holds
+    the (addr, count) of each register block covered by that read.
+    """
+    reads = []
+    for addr, count in sorted(blocks.items()):
+        if reads:
+            start, length, members = reads[-1]
+            end = start + length
+            if addr - end <= gap and addr + count - start <= limit:
+                length = max(end, addr + count) - start
+                reads[-1] = (start, length, members + [(addr, count)])
+                continue
+        reads.append((addr, count, [(addr, count)]))
+    return reads
+
+
+# Modbus connection
+class ModbusConnection:
+    """A persistent modbus TCP connection shared by the units behind it."""
+
+    def __init__(self, host, port):
+        """Constructor."""
+        self.host = host
+        self.port = port
+        self.client = ModbusClient(host, port)
+        self.lock = threading.Lock()
+        # Bumped on every new connection so readers can drop cached data
+        self.generation = 0
+        self.last_used = 0.0
+        # Unit id used for keepalive probes
+        self.unit = None
+
+    # Healthy
+    def healthy(self):
+        """Return whether the socket is open and not closed by the peer."""
+        sock = self.client.socket
+        if sock is None:
+            return False
+        try:
+            # Readable while idle means the peer closed, or left a stray
+            # response behind that would throw off the next read
+            readable, _, _ = select.select([sock], [], [], 0)
+            return not readable
+        except (OSError, ValueError):
+            return False
+
+    # Ensure connected
+    def ensure(self):
+        """Reconnect if the connection is down or half-open, the lock must be held."""
+        if self.healthy():
+            return True
+        self.close()
+        if not self.client.connect():
+            return False
+        self.generation += 1
+        logger.debug("Connected to modbus {}:{}".format(self.host, self.port))
+        return True
+
+    # Touch
+    def touch(self):
+        """Mark the connection as just used."""
+        self.last_used = time.monotonic()
+
+    # Close
+    def close(self):
+        """Close the socket, the next use reconnects."""
+        try:
+            self.client.close()
+        except Exception as e:
+            logger.error("Modbus error on close: {}".format(e))
+
+    # Probe
+    def probe(self):
+        """Keep an idle connection alive with a one register read."""
+        if not self.lock.acquire(blocking=False):
+            return
+        try:
+            if self.unit is None or not self.ensure():
+                return
+            result = self.client.read_holding_registers(4100, 1, unit=self.unit)
+            if result.isError():
+                raise pymodbus.exceptions.ModbusIOException(str(result))
+            self.touch()
+        except Exception as e:
+            logger.warning("Modbus keepalive to {}:{} failed: {}".format(
+                self.host, self.port, e))
+            self.close()
+        finally:
+            self.lock.release()
+
+
+# Modbus connection pool
+class ModbusPool:
+    """Share one persistent modbus connection per host and port."""
+
+    def __init__(self):
+        """Constructor."""
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.keepalive = 0
+        self.thread = None
+
+    def get(self, host, port):
+        """Return the connection for a host and port."""
+        with self.lock:
+            key = (host, port)
+            if key not in self.connections:
+                self.connections[key] = ModbusConnection(host, port)
+            return self.connections[key]
+
+    def setKeepalive(self, seconds):
+        """Probe connections idle for `seconds`, 0 disables probing."""
+        self.keepalive = seconds
+        if seconds and self.thread is None:
+            self.thread = threading.Thread(
+                target=self.run, name="modbus-keepalive", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        """Keepalive loop."""
+        while self.keepalive:
+            time.sleep(self.keepalive / 2.0)
+            with self.lock:
+                connections = list(self.connections.values())
+            for connection in connections:
+                if time.monotonic() - connection.last_used >= self.keepalive:
+                    connection.probe()
+
+
+# Shared modbus connections
+pool = ModbusPool()
+
+
+# Circuit breaker
+class CircuitBreaker:
+    """Stop polling a failing device, probing it again with exponential backoff.
+
+    The breaker opens after `threshold` failures in a row. While open one
+    probe is let through per backoff period, which doubles after each failed
+    probe up to `maxbackoff` seconds. A success closes it again.
+    """
+
+    def __init__(self, name, threshold=3, backoff=10, maxbackoff=300):
+        """Constructor."""
+        self.name = name
+        self.threshold = threshold
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.failures = 0
+        self.delay = backoff
+        self.retry_at = 0.0
+
+    def isOpen(self):
+        """Return whether the device is considered offline."""
+        return self.failures >= self.threshold
+
+    def allow(self):
+        """Return whether a poll may go ahead."""
+        return not self.isOpen() or time.monotonic() >= self.retry_at
+
+    def success(self):
+        """Record a good poll."""
+        if self.isOpen():
+            logger.info("{} is back online.".format(self.name))
+        self.failures = 0
+        self.delay = self.backoff
+
+    def failure(self):
+        """Record a failed poll."""
+        self.failures += 1
+        if self.failures > self.threshold:
+            # A failed probe
+            self.delay = min(self.delay * 2, self.maxbackoff)
+        elif self.failures == self.threshold:
+            logger.warning("{} is offline after {} failed polls.".format(
+                self.name, self.failures))
+        if self.isOpen():
+            self.retry_at = time.monotonic() + self.delay
+
 
 class Midnite:
-    def __init__(self, host='localhost', port=502, unit=10, timeout=0.001, retries=30):
+    def __init__(self, host='localhost', port=502, unit=10, timeout=0.001, retries=30, gap=32, name="Classic", slow=300,
+                 wait=(1, 2), deadline=10, failures=3, backoff=10, maxbackoff=300, observer=None,
+                 recorder=None):
         """Constructor."""
         self.setup_logger()
         self.timeout = timeout
         self.host = host
         self.port = port
+        self.name = name
         self.reader = None
-        self.classic = None
+        self.classic = ClassicDevice(name=self.name)
         self.classic_model = -1
         self.unit = unit
         self.retry_count = retries
-
-        try:
-            self.client = ModbusClient(self.host, self.port)
-        except Exception as e:
-            logger.warning("Failed to connect to the Classic. {}".format(e))
-            self.client = None
-
+        self.retry_wait = wait
+        # Seconds a poll may spend retrying, None for no limit
+        self.retry_deadline = deadline
+        self.breaker = CircuitBreaker(name, failures, backoff, maxbackoff)
+        # Called with (name, event, value, *labels) for read, decode and retry
+        self.observer = observer
+        # Called with (name, {address: registers}) for every poll read
+        self.recorder = recorder
+        self.gap = gap
+        # Seconds each tier stays cached, None until invalidated
+        self.ttls = {STATIC: None, SLOW: slow, FAST: 0}
+        # Time each register block was last read (address: monotonic time)
+        self.cache = {}
+        # Read plans by the register blocks due
+        self.plans = {}
+        self.last_reset = None
+        self.stats = OrderedDict([
+            ("polls", 0),
+            ("failures", 0),
+            ("last", 0.0),
+            ("min", 0.0),
+            ("max", 0.0),
+            ("total", 0.0),
+        ])
+
+        self.setupClient()
         self.devices = [self.classic]
 
+    # Set up modbus client
+    def setupClient(self):
+        """Attach the pooled modbus connection for this host and port."""
+        self.connection = pool.get(self.host, self.port)
+        self.client = self.connection.client
+        self.clientLock = self.connection.lock
+        self.generation = self.connection.generation
+
     def getDevices(self):
         """Return associated devices."""
-        self.classic = ClassicDevice()
-        data = self.getModbusData()
-        self.classic.setData(data)
-
-        self.devices = [self.classic]
-
-        devices = []
-        for device in self.devices:
-            if device:
-                deviceInfo = device.getDevice()
-                if deviceInfo:
-                    devices.append(deviceInfo)
-
-        dp = deepcopy(devices)
-        return dp
+        if not self.breaker.allow():
+            return self.statusDevices("offline")
+        start = time.monotonic()
+        try:
+            data = self.getModbusData()
+        except Exception as e:
+            return self.pollFailed(e)
+        self.recordPoll(time.monotonic() - start)
+        self.breaker.success()
+        return self.makeDevices(data)
+
+    # Poll failed
+    def pollFailed(self, error):
+        """Record a failed poll and return the last data with its status."""
+        logger.error("Could not get {} data: {}".format(self.name, error))
+        self.stats["failures"] += 1
+        self.breaker.failure()
+        return self.statusDevices(
+            "offline" if self.breaker.isOpen() else "stale")
+
+    # Status Devices
+    def statusDevices(self, status):
+        """Return the last data read, flagged with a status."""
+        device = self.classic.getDevice()
+        device["status"] = status
+        return [device]
+
+    # Make Devices
+    def makeDevices(self, snapshot):
+        """Return the device list for a freshly decoded snapshot."""
+        return [OrderedDict([("device", self.name), ("data", snapshot)])]
+
+    # Record poll timing
+    def recordPoll(self, elapsed):
+        """Add a poll duration to the timing stats."""
+        stats = self.stats
+        stats["polls"] += 1
+        stats["last"] = elapsed
+        stats["total"] += elapsed
+        if stats["polls"] == 1 or elapsed < stats["min"]:
+            stats["min"] = elapsed
+        if elapsed > stats["max"]:
+            stats["max"] = elapsed
+
+    # Get Stats
+    def getStats(self):
+        """Return poll timing stats for this unit."""
+        stats = OrderedDict(self.stats)
+        stats["mean"] = stats["total"] / stats["polls"] if stats["polls"] else 0.0
+        return stats
 
     # Set up Logger
     def setup_logger(args):
-        """Setup the logger."""
+        """Setup the logger, once however many units there are."""
+        if logger.handlers:
+            return
+
         # Set default loglevel
         logger.setLevel(logging.DEBUG)
 
@@ -84,357 +624,348 @@ class Midnite:
         logger.addHandler(fh)
         logger.addHandler(ch)
   
-    retry_on_re_param_err = partial(
-        retry,
-        stop=stop_after_attempt(30),
-        wait=wait_random(min=1, max=2),
-        retry=retry_if_exception_type(pymodbus.exceptions.ParameterException)
-    )()
+    # Observe
+    def observe(self, event, value, *labels):
+        """Hand a timing or count to the observer, if any."""
+        if self.observer is not None:
+            self.observer(self.name, event, value, *labels)
+
+    # Retry Policy
+    def retryPolicy(self, deadline=None):
+        """Return the retry policy for a read, stopping at the poll deadline."""
+        stop = stop_after_attempt(self.retry_count)
+        if deadline is not None:
+            stop = stop | stop_after_delay(max(deadline - time.monotonic(), 0))
+        return Retrying(
+            stop=stop,
+            wait=wait_random(min=self.retry_wait[0], max=self.retry_wait[1]),
+            retry=retry_if_exception_type(pymodbus.exceptions.ModbusException),
+            before_sleep=lambda state: self.observe("retry", 1),
+            reraise=True)
 
     # Get Registers
-    @retry_on_re_param_err
-    def getRegisters(self, addr, count):
-        """Return supplied register values."""
+    def getRegisters(self, addr, count, deadline=None):
+        """Return supplied register values, retrying failed reads."""
+        return self.retryPolicy(deadline)(self.readRegisters, addr, count)
+
+    # Read Registers
+    def readRegisters(self, addr, count):
+        """Return supplied register values, raising on failure."""
         try:
             result = self.client.read_holding_registers(addr, count, unit=self.unit)
-            if result.function_code >= 0x80:
-                logging.error("error getting {} for {} bytes".format(addr, count))
-                return {}
         except Exception:
-            logging.error("Error getting {} for {} bytes".format(addr, count))
-            return {}
-
+            # Possibly a dead socket, the next read reconnects
+            self.connection.close()
+            raise
+        if result.isError():
+            raise pymodbus.exceptions.ModbusIOException(
+                "error getting {} for {} registers: {}".format(addr, count, result))
         return result.registers
 
-    # Data Decoder
-    def getDataDecoder(self, registers):
-        """Return payload decoder."""
-        return BinaryPayloadDecoder.fromRegisters(
-            registers,
-            byteorder=Endian.Big,
-            wordorder=Endian.Little)
+    # Due reads
+    def dueReads(self):
+        """Return the planned reads of the register blocks due a refresh."""
+        now = time.monotonic()
+        due = OrderedDict()
+        for addr, block in REGISTER_MAP.items():
+            cached = self.cache.get(addr)
+            ttl = self.ttls[block.tier]
+            if cached is None or (ttl is not None and now - cached >= ttl):
+                due[addr] = block.count
+
+        key = tuple(due)
+        if key not in self.plans:
+            self.plans[key] = planReads(due, gap=self.gap)
+        return self.plans[key]
+
+    # Invalidate cache
+    def invalidate(self):
+        """Forget cached registers so every block is read on the next poll."""
+        if self.cache:
+            logger.debug("{} register cache invalidated".format(self.name))
+        self.cache.clear()
 
     # Decode Data
-    def doDecode(self, addr, decoder):
-        if (addr == 4100):
-            decoded = OrderedDict([
-                # 4101 MSB
-                ('pcb_revision', decoder.decode_8bit_uint()),
-                # 4101 LSB
-                ('unit_type', decoder.decode_8bit_uint()),
-                # 4102
-                ('build_year', decoder.decode_16bit_uint()),
-                # 4103 MSB
-                ('build_month', decoder.decode_8bit_uint()),
-                # 4103 LSB
-                ('build_day', decoder.decode_8bit_uint()),
-                # 4104
-                ('info_flag_bits_3', decoder.decode_16bit_uint()),
-                # 4105 Reserved
-                ('ignore', decoder.skip_bytes(2)),
-                # 4106 MSB
-                ('mac_1', decoder.decode_8bit_uint()),
-                # 4106 LSB
-                ('mac_0', decoder.decode_8bit_uint()),
-                # 4107 MSB
-                ('mac_3', decoder.decode_8bit_uint()),
-                # 4107 LSB
-                ('mac_2', decoder.decode_8bit_uint()),
-                # 4108 MSB
-                ('mac_5', decoder.decode_8bit_uint()),
-                # 4108 LSB
-                ('mac_4', decoder.decode_8bit_uint()),
-                # 4109, 4110
-                ('ignore_2', decoder.skip_bytes(4)),
-                # 4111
-                ('unit_id', decoder.decode_32bit_int()),
-                # 4113
-                ('status_roll', decoder.decode_16bit_uint()),
-                # 4114
-                ('restart_timer_ms', decoder.decode_16bit_uint()),
-                # 4115
-                ('avg_battery_voltage', decoder.decode_16bit_int()/10.0),
-                # 4116
-                ('avg_pv_voltage', decoder.decode_16bit_uint()/10.0),
-                # 4117
-                ('avg_battery_current', decoder.decode_16bit_uint()/10.0),
-                # 4118
-                ('avg_energy_today', decoder.decode_16bit_uint()/10.0),
-                # 4119
-                ('avg_power', decoder.decode_16bit_uint()/1.0),
-                # 4120 MSB
-                ('charge_stage', decoder.decode_8bit_uint()),
-                # 4120 LSB
-                ('charge_state', decoder.decode_8bit_uint()),
-                # 4121
-                ('avg_pv_current', decoder.decode_16bit_uint()/10.0),
-                # 4122
-                ('last_voc', decoder.decode_16bit_uint()/10.0),
-                # 4123
-                ('highest_pv_voltage_seen', decoder.decode_16bit_uint()),
-                # 4124
-                ('match_point_shadow', decoder.decode_16bit_uint()),
-                # 4125
-                ('amphours_today', decoder.decode_16bit_uint()),
-                # 4126, 4127
-                ('lifetime_energy', decoder.decode_32bit_uint()/10.0),
-                # 4128, 4129
-                ('lifetime_amphours', decoder.decode_32bit_uint()),
-                # 4130, 4131
-                ('info_flags_bits', decoder.decode_32bit_int()),
-                # 4132
-                ('battery_temperature', decoder.decode_16bit_int()/10.0),
-                # 4133
-                ('fet_temperature', decoder.decode_16bit_int()/10.0),
-                # 4134
-                ('pcb_temperature', decoder.decode_16bit_int()/10.0),
-                # 4135
-                ('no_power_timer', decoder.decode_16bit_uint()),
-                # 4136 (in seconds, minimum: 1 minute)
-                ('log_interval', decoder.decode_16bit_uint()),
-                # 4137
-                ('modbus_port_register', decoder.decode_16bit_uint()),
-                # 4138
-                ('float_time_today', decoder.decode_16bit_uint()),
-                # 4139
-                ('absorb_time', decoder.decode_16bit_uint()),
-                # 4140
-                ('reserved_1', decoder.decode_16bit_uint()),
-                # 4141
-                ('pwm_readonly', decoder.decode_16bit_uint()),
-                # 4142
-                ('reason_for_reset', decoder.decode_16bit_uint()),
-                # 4143
-                ('equalize_time', decoder.decode_16bit_uint())
-            ])
-            # Removed reserved register data
-            del decoded["ignore"]
-            del decoded["ignore_2"]
-            del decoded["reserved_1"]
-        elif (addr == 4360):
-            decoded = OrderedDict([
-                # 4361
-                ('wbjr_cmd_s', decoder.decode_16bit_uint()),
-                # 4362
-                ('wbjr_raw_current', decoder.decode_16bit_int()),
-                # 4363, 4364
-                ('skip', decoder.skip_bytes(4)),
-                # 4365, 4366
-                ('wbjr_pos_amphour', decoder.decode_32bit_uint()),
-                # 4367, 4368
-                ('wbjr_neg_amphour', decoder.decode_32bit_int()),
-                # 4369, 4370
-                ('wbjr_net_amphour', decoder.decode_32bit_int()),
-                # 4371
-                ('wbjr_battery_current', decoder.decode_16bit_int()/10.0),
-                # 4372 MSB
-                ('wbjr_crc', decoder.decode_8bit_int()),
-                # 4372 LSB
-                ('shunt_temperature', decoder.decode_8bit_int() - 50.0),
-                # 4373
-                ('soc', decoder.decode_16bit_uint()),
-                # 4374 - 4376 Reserved
-                ('skip2', decoder.skip_bytes(6)),
-                # 4377
-                ('remaining_amphours', decoder.decode_16bit_uint()),
-                # 4378 - 4380 Reserved
-                ('skip3', decoder.skip_bytes(6)),
-                # 4381
-                ('total_amphours', decoder.decode_16bit_uint()),
-            ])
-            # Removed reserved register data
-            del decoded["skip"]
-            del decoded["skip2"]
-            del decoded["skip3"]
-        elif (addr == 4163):
-            decoded = OrderedDict([
-                # 4164
-                ('mppt_mode', decoder.decode_16bit_uint()),
-                # 4165
-                ('aux1_and_2_function', decoder.decode_16bit_int()),
-            ])
-        elif (addr == 4209):
-            decoded = OrderedDict([
-                # 4210
-                ('name_0', decoder.decode_8bit_uint()),
-                # 4211
-                ('name_1', decoder.decode_8bit_uint()),
-                # 4212
-                ('name_2', decoder.decode_8bit_uint()),
-                # 4213
-                ('name_3', decoder.decode_8bit_uint()),
-                # 4214
-                ('name_4', decoder.decode_8bit_uint()),
-                # 4215
-                ('name_5', decoder.decode_8bit_uint()),
-                # 4216
-                ('name_6', decoder.decode_8bit_uint()),
-                # 4217
-                ('name_7', decoder.decode_8bit_uint()),
-            ])
-        elif (addr == 4243):
-            decoded = OrderedDict([
-                # 4244
-                ('temp_regulated_battery_target_voltage',
-                  decoder.decode_16bit_int()/10.0),
-                # 4245
-                ('nominal_battery_voltage', decoder.decode_16bit_uint()),
-                # 4246
-                ('ending_amps', decoder.decode_16bit_int()/10.0),
-                # 4247-4274 Reserved
-                ('skip', decoder.skip_bytes(56)),
-                # 4275
-                ('reason_for_resting', decoder.decode_16bit_uint())
-            ])
-            # Removed reserved register data
-            del decoded["skip"]
-        elif (addr == 16386):
-            decoded = OrderedDict([
-                # 16387, 16388
-                ('app_rev', decoder.decode_32bit_uint()),
-                # 16387, 16388
-                ('net_rev', decoder.decode_32bit_uint())
-            ])
-
-        return decoded
+    def doDecode(self, addr, registers):
+        """Decode a register block read from the Classic into its field values."""
+        return REGISTER_MAP[addr].unpack(registers)
 
     # Get modbus data from classic.
     def getModbusData(self):
-        try:
-            # Open modbus connection
-            self.client.connect()
-
-            data = OrderedDict()
-            # Read registers
-            data[4100] = self.getRegisters(addr=4100, count=44)
-            data[4360] = self.getRegisters(addr=4360, count=22)
-            data[4163] = self.getRegisters(addr=4163, count=2)
-            data[4209] = self.getRegisters(addr=4209, count=4)
-            data[4243] = self.getRegisters(addr=4243, count=32)
-            data[16386] = self.getRegisters(addr=16386, count=4)
-
-            # Close modbus connection
-            self.client.close()
+        # Units behind the same gateway share a client, one poll at a time
+        with self.clientLock:
+            return self.readModbusData()
+
+    # Read and decode modbus data, the client lock must be held.
+    def readModbusData(self):
+        deadline = None
+        if self.retry_deadline:
+            deadline = time.monotonic() + self.retry_deadline
+
+        # (Re)open the persistent modbus connection if needed
+        if not self.connection.ensure():
+            raise pymodbus.exceptions.ConnectionException(
+                "{}:{}".format(self.host, self.port))
+        self.connection.unit = self.unit
+
+        # A new connection may follow a Classic restart
+        if self.connection.generation != self.generation:
+            if self.generation:
+                self.invalidate()
+            self.generation = self.connection.generation
+
+        data = OrderedDict()
+        error = None
+        # Read registers, slicing each block out of its merged read
+        for start, count, blocks in self.dueReads():
+            began = time.perf_counter()
+            try:
+                registers = self.getRegisters(start, count, deadline)
+            except pymodbus.exceptions.ModbusException as e:
+                # Left uncached, the block is due again next poll
+                logger.error("Error getting {} for {} registers: {}".format(
+                    start, count, e))
+                error = e
+                continue
+            self.observe("read", time.perf_counter() - began, start)
+            for addr, length in blocks:
+                offset = addr - start
+                data[addr] = registers[offset:offset + length]
+
+        if not data:
+            raise pymodbus.exceptions.ConnectionException(
+                "No data read from {}: {}".format(self.name, error))
+
+        self.connection.touch()
+        logger.debug("Obtained {} data".format(self.name))
+        return self.timedDecode(data)
+
+    # Timed decode
+    def timedDecode(self, data):
+        """Decode register blocks, handing the time taken to the observer."""
+        if self.recorder is not None:
+            self.recorder(self.name, data)
+        began = time.perf_counter()
+        decoded = self.decodeData(data)
+        self.observe("decode", time.perf_counter() - began)
+        return decoded
 
-        except pymodbus.exceptions.ConnectionException as e:
-            logger.error("Modbus Client Connect Attempt Error: {}".format(e))
-            sys.exit(1)
-            return OrderedDict()
+    # Decode register blocks
+    def decodeData(self, data):
+        """Decode the register blocks read in place, return a snapshot of all fields."""
+        now = time.monotonic()
+        for addr, registers in data.items():
+            self.classic.setBlock(REGISTER_MAP[addr], self.doDecode(addr, registers))
+            self.cache[addr] = now
 
+        # A restarted Classic may come back with different settings
+        reset = None
+        if RESET_BLOCK in self.cache:
+            reset = self.classic.values[FIELD_INDEX[RESET_FIELD]]
+        if self.last_reset is not None and reset != self.last_reset:
+            logger.info("{} reset, reason {}".format(self.name, reset))
+            self.invalidate()
+        self.last_reset = reset
+
+        return self.classic.takeSnapshot()
+
+
+# Modbus TCP header (transaction, protocol, length, unit)
+MBAP = struct.Struct('>HHHB')
+# Read holding registers request (MBAP, function, address, count)
+READ_REQUEST = struct.Struct('>HHHBBHH')
+READ_HOLDING_REGISTERS = 0x03
+
+
+class AsyncMidnite(Midnite):
+    """Classic reader pipelining every register read over one asyncio connection.
+
+    Requests are tagged with modbus TCP transaction ids, so all the planned
+    reads go out back to back and the responses are matched as they arrive.
+    Each request has its own timeout instead of the retry policy.
+    """
+
+    def __init__(self, host='localhost', port=502, unit=10, timeout=0.001, retries=30, gap=32, name="Classic", slow=300,
+                 wait=(1, 2), deadline=10, failures=3, backoff=10, maxbackoff=300, observer=None,
+                 recorder=None, request_timeout=2.0):
+        """Constructor."""
+        # Slow to import and only this backend needs it
+        global asyncio
+        import asyncio
+        self.request_timeout = request_timeout
+        self.loop = asyncio.new_event_loop()
+        self.streamReader = None
+        self.streamWriter = None
+        self.listener = None
+        self.transaction = 0
+        self.waiting = {}
+        super().__init__(host=host, port=port, unit=unit, timeout=timeout,
+                         retries=retries, gap=gap, name=name, slow=slow,
+                         wait=wait, deadline=deadline, failures=failures,
+                         backoff=backoff, maxbackoff=maxbackoff, observer=observer,
+                         recorder=recorder)
+
+    def setupClient(self):
+        """Connections are opened lazily on the event loop."""
+        self.connection = None
+        self.client = None
+        self.clientLock = threading.Lock()
+
+    def getDevices(self):
+        """Return associated devices."""
+        with self.clientLock:
+            return self.loop.run_until_complete(self.getDevicesAsync())
+
+    async def getDevicesAsync(self):
+        """Return associated devices."""
+        if not self.breaker.allow():
+            return self.statusDevices("offline")
+        start = time.monotonic()
+        try:
+            data = await self.getModbusDataAsync()
         except Exception as e:
-            logger.error("Could not get modbus data: {}".format(e))
-            try:
-                self.client.close()
-            except Exception as ee:
-                logger.error("Modbus error on close: {}".format(ee))
-            sys.exit(1)
-            return OrderedDict()
+            return self.pollFailed(e)
+        self.recordPoll(time.monotonic() - start)
+        self.breaker.success()
+        return self.makeDevices(data)
 
-        logger.debug("Obtained Classic data")
+    def getModbusData(self):
+        """Return decoded modbus data from the Classic."""
+        with self.clientLock:
+            return self.loop.run_until_complete(self.getModbusDataAsync())
+
+    async def getModbusDataAsync(self):
+        """Read every planned block concurrently and decode them."""
+        await self.connectAsync()
+        reads = self.dueReads()
+        results = await asyncio.gather(
+            *[self.getRegistersAsync(start, count) for start, count, _ in reads],
+            return_exceptions=True)
+
+        data = OrderedDict()
+        for (start, count, blocks), registers in zip(reads, results):
+            if isinstance(registers, Exception):
+                logger.error("Error getting {} for {} bytes: {}".format(
+                    start, count, registers or type(registers).__name__))
+                continue
+            for addr, length in blocks:
+                offset = addr - start
+                data[addr] = registers[offset:offset + length]
+
+        if not data:
+            raise pymodbus.exceptions.ConnectionException(
+                "No data read from {}".format(self.name))
+
+        logger.debug("Obtained {} data".format(self.name))
+        return self.timedDecode(data)
+
+    async def connectAsync(self):
+        """Open the connection if it is not already up."""
+        if self.streamWriter is not None and not self.streamWriter.is_closing():
+            return
+        try:
+            self.streamReader, self.streamWriter = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                self.request_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise pymodbus.exceptions.ConnectionException(
+                "{}:{} {}".format(self.host, self.port, e or "timed out"))
+        self.listener = asyncio.ensure_future(self.listen())
+        # Whatever was cached may predate a restart
+        self.invalidate()
+
+    def close(self):
+        """Close the connection and the event loop."""
+        with self.clientLock:
+            self.loop.run_until_complete(self.closeAsync())
+            self.loop.close()
+
+    async def closeAsync(self):
+        """Close the connection."""
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+        if self.streamWriter is not None:
+            self.streamWriter.close()
+            self.streamWriter = None
+        self.streamReader = None
+
+    async def listen(self):
+        """Hand responses to the requests waiting on them."""
+        try:
+            while True:
+                header = await self.streamReader.readexactly(MBAP.size)
+                transaction, _, length, _ = MBAP.unpack(header)
+                body = await self.streamReader.readexactly(length - 1)
+                future = self.waiting.pop(transaction, None)
+                if future is not None and not future.done():
+                    future.set_result(body)
+        except (asyncio.IncompleteReadError, OSError) as e:
+            logger.warning("{} connection lost: {}".format(self.name, e))
+            for future in self.waiting.values():
+                if not future.done():
+                    future.set_exception(
+                        pymodbus.exceptions.ConnectionException(str(e)))
+            self.waiting.clear()
+            if self.streamWriter is not None:
+                self.streamWriter.close()
+                self.streamWriter = None
+
+    async def getRegistersAsync(self, addr, count):
+        """Return supplied register values."""
+        self.transaction = (self.transaction + 1) & 0xFFFF
+        transaction = self.transaction
+        future = self.loop.create_future()
+        self.waiting[transaction] = future
+        began = time.perf_counter()
+        self.streamWriter.write(READ_REQUEST.pack(
+            transaction, 0, 6, self.unit, READ_HOLDING_REGISTERS, addr, count))
 
-        # Decode data
-        decoded = OrderedDict()
-        for index in data:
-            decoded = {
-                **dict(decoded),
-                **dict(self.doDecode(index, self.getDataDecoder(data[index])))}
+        try:
+            body = await asyncio.wait_for(future, self.request_timeout)
+        finally:
+            self.waiting.pop(transaction, None)
 
-        return decoded
+        if body[0] >= 0x80:
+            raise pymodbus.exceptions.ModbusIOException(
+                "exception code {}".format(body[1]))
+        self.observe("read", time.perf_counter() - began, addr)
+        return list(struct.unpack_from('>{}H'.format(body[1] // 2), body, 2))
 
 
 # Classic device class
 class ClassicDevice:
-    def __init__(self, reader=None, trace=False):
+    def __init__(self, reader=None, trace=False, name="Classic"):
         """Construtor."""
         # Instances
         self.trace = trace
-        self.data = OrderedDict()
-        self.device = OrderedDict()
+        self.name = name
         self.reader = None
 
-        # Device Attributes
-        self.device["device"] = "Classic"
-        self.device["data"] = self.data
-
-        # Default Register Value Data
-        self.data["pcb_revision"] = 0
-        self.data["unit_type"] = 0
-        self.data["build_year"] = 0
-        self.data["build_month"] = 0
-        self.data["build_day"] = 0
-        self.data["info_flag_bits_3"] = 0
-        self.data["mac_1"] = 0
-        self.data["mac_0"] = 0
-        self.data["mac_3"] = 0
-        self.data["mac_2"] = 0
-        self.data["mac_5"] = 0
-        self.data["mac_4"] = 0
-        self.data["unit_id"] = 0
-        self.data["status_roll"] = 0
-        self.data["restart_timer_ms"] = 0
-        self.data["avg_battery_voltage"] = 0
-        self.data["avg_pv_voltage"] = 0
-        self.data["avg_battery_current"] = 0
-        self.data["avg_energy_today"] = 0
-        self.data["avg_power"] = 0
-        self.data["charge_stage"] = 0
-        self.data["charge_state"] = 0
-        self.data["avg_pv_current"] = 0
-        self.data["last_voc"] = 0
-        self.data["highest_pv_voltage_seen"] = 0
-        self.data["match_point_shadow"] = 0
-        self.data["amphours_today"] = 0
-        self.data["lifetime_energy"] = 0
-        self.data["lifetime_amphours"] = 0
-        self.data["info_flags_bits"] = -0
-        self.data["battery_temperature"] = 0
-        self.data["fet_temperature"] = 0
-        self.data["pcb_temperature"] = 0
-        self.data["no_power_timer"] = 0
-        self.data["log_interval"] = 0
-        self.data["modbus_port_register"] = 0
-        self.data["float_time_today"] = 0
-        self.data["absorb_time"] = 0
-        self.data["pwm_readonly"] = 0
-        self.data["reason_for_reset"] = 0
-        self.data["equalize_time"] = 0
-        self.data["wbjr_cmd_s"] = 0
-        self.data["wbjr_raw_current"] = 0
-        self.data["wbjr_pos_amphour"] = 0
-        self.data["wbjr_neg_amphour"] = 0
-        self.data["wbjr_net_amphour"] = 0
-        self.data["wbjr_battery_current"] = 0
-        self.data["wbjr_crc"] = 0
-        self.data["shunt_temperature"] = 0
-        self.data["soc"] = 0
-        self.data["remaining_amphours"] = 0
-        self.data["total_amphours"] = 0
-        self.data["mppt_mode"] = 0
-        self.data["aux1_and_2_function"] = 0
-        self.data["name_0"] = 0
-        self.data["name_1"] = 0
-        self.data["name_2"] = 0
-        self.data["name_3"] = 0
-        self.data["name_4"] = 0
-        self.data["name_5"] = 0
-        self.data["name_6"] = 0
-        self.data["name_7"] = 0
-        self.data["temperature_compensated_regulated_battery_voltage"] = 0
-        self.data["nominal_battery_voltage"] = 0
-        self.data["ending_amps"] = 0
-        self.data["reason_for_resting"] = 0
-        self.data["app_rev"] = 0
-        self.data["net_rev"] = 0
+        # Register values in FIELD_NAMES order, updated in place each poll
+        self.values = [0] * len(FIELD_NAMES)
+        self.snapshot = Snapshot(self.values)
 
     def setReader(self, reader):
         """Set Reader."""
         self.reader = reader
 
     def setData(self, data):
-        """Read in Classic data."""
-        self.data.update(data)
+        """Read in Classic data by field name."""
+        for key, value in data.items():
+            self.values[FIELD_INDEX[key]] = value
+        self.takeSnapshot()
+
+    def setBlock(self, block, values):
+        """Read in the decoded values of a register block."""
+        self.values[block.slot:block.slot + len(values)] = values
+
+    def takeSnapshot(self):
+        """Freeze the current values into the snapshot shared from now on."""
+        self.snapshot = Snapshot(self.values)
+        return self.snapshot
 
     # Get Device
     def getDevice(self):
         """Return device data."""
-        return self.device
+        return OrderedDict([("device", self.name), ("data", self.snapshot)])
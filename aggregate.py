@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Aggregate"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+from array import array
+from collections import OrderedDict
+
+INFINITY = float("inf")
+
+
+# Device window
+class DeviceWindow:
+    """Array backed min/max/mean/last accumulators for one device.
+
+    Field slots are assigned from the first sample and the arrays are reset
+    in place at every flush, so memory stays flat however fast the device
+    is sampled. A field stays an int only while every sample in the window
+    is one.
+    """
+
+    def __init__(self, name, integrate=()):
+        """Constructor."""
+        self.name = name
+        self.integrate = integrate
+        self.index = OrderedDict()
+        self.integers = array('b')
+        self.other = OrderedDict()
+        self.count = array('L')
+        self.mins = array('d')
+        self.maxs = array('d')
+        self.sums = array('d')
+        self.lasts = array('d')
+        self.integrals = array('d')
+        self.previous = None
+        self.result = None
+
+    # Add field slot
+    def addField(self, key):
+        """Give a numeric field its accumulator slot."""
+        self.index[key] = len(self.index)
+        self.integers.append(1)
+        self.count.append(0)
+        self.mins.append(INFINITY)
+        self.maxs.append(-INFINITY)
+        self.sums.append(0.0)
+        self.lasts.append(0.0)
+        self.integrals.append(0.0)
+
+    # Add sample
+    def add(self, data, timestamp):
+        """Accumulate one sample taken at a monotonic timestamp."""
+        index = self.index
+        for key, value in data.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                self.other[key] = value
+                continue
+            if key not in index:
+                self.addField(key)
+            slot = index[key]
+            if self.integers[slot] and not isinstance(value, int):
+                self.integers[slot] = 0
+            self.count[slot] += 1
+            self.sums[slot] += value
+            self.lasts[slot] = value
+            if value < self.mins[slot]:
+                self.mins[slot] = value
+            if value > self.maxs[slot]:
+                self.maxs[slot] = value
+
+        # Trapezoid integration, value hours (Wh of a W field)
+        if self.previous is not None:
+            start, values = self.previous
+            hours = (timestamp - start) / 3600.0
+            for key in self.integrate:
+                if key in index and key in values and key in data:
+                    self.integrals[index[key]] += (
+                        (values[key] + data[key]) / 2.0 * hours)
+        self.previous = (timestamp, {
+            key: data[key] for key in self.integrate if key in data})
+
+    # Flush window
+    def flush(self):
+        """Return the aggregated data and reset the window, None if empty."""
+        if not any(self.count):
+            return None
+
+        data = OrderedDict()
+        for key, slot in self.index.items():
+            count = self.count[slot]
+            if not count:
+                continue
+            cast = int if self.integers[slot] else float
+            data[key] = cast(self.lasts[slot])
+            data[key + "_min"] = cast(self.mins[slot])
+            data[key + "_max"] = cast(self.maxs[slot])
+            data[key + "_mean"] = self.sums[slot] / count
+            if key in self.integrate:
+                data[key + "_integral"] = self.integrals[slot]
+        data.update(self.other)
+        data["samples"] = max(self.count)
+
+        # Reset in place
+        for slot in range(len(self.index)):
+            self.count[slot] = 0
+            self.mins[slot] = INFINITY
+            self.maxs[slot] = -INFINITY
+            self.sums[slot] = 0.0
+            self.integrals[slot] = 0.0
+            self.integers[slot] = 1
+        self.other.clear()
+
+        self.result = data
+        return data
+
+
+# Aggregator
+class Aggregator:
+    """Aggregate fast device samples over a publish window."""
+
+    def __init__(self, integrate=()):
+        """Constructor."""
+        self.integrate = tuple(integrate)
+        self.windows = OrderedDict()
+
+    # Add devices
+    def add(self, devices, timestamp):
+        """Accumulate a sample of every device."""
+        for device in devices:
+            name = device["device"]
+            if name not in self.windows:
+                self.windows[name] = DeviceWindow(name, self.integrate)
+            self.windows[name].add(device["data"], timestamp)
+
+    # Flush windows
+    def flush(self):
+        """Return aggregated devices, stale when a device was never sampled."""
+        devices = []
+        for name, window in self.windows.items():
+            data = window.flush()
+            device = OrderedDict([("device", name)])
+            if data is None:
+                if window.result is None:
+                    continue
+                data = window.result
+                device["status"] = "stale"
+            device["data"] = data
+            devices.append(device)
+        return devices
@@ -0,0 +1,744 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Benchmark"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+# Measures PowerPi poll, decode and publish cycles without the hardware,
+# against a modbus TCP server emulating the Classic register map, a pty fed
+# with Magnum RS485 packets and a bare MQTT broker stand-in.
+
+import json
+import os
+import pty
+import random
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import tracemalloc
+import tty
+from collections import OrderedDict
+from copy import deepcopy
+
+import configargparse
+parser = configargparse.ArgParser(description="PowerPi benchmark")
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Magnum Energy
+from magnum import magnum
+from magnumstream import StreamingMagnum
+
+# Midnite Classic
+from Midnite import Midnite
+
+import powerpi
+
+# Benchmarks in run order
+BENCHMARKS = ("classic", "async", "magnum", "stream", "decode", "publish")
+# Metrics compared against a baseline, lower is better unless a rate
+COMPARED = ("p50", "p90", "peak_kib", "bytes_per_message")
+# Magnum RS485 baud rate
+BAUD = 19200
+
+
+# Classic simulator handler
+class ClassicHandler(socketserver.BaseRequestHandler):
+    """Answer modbus TCP read holding registers requests."""
+
+    def setup(self):
+        """Answer pipelined requests without waiting on delayed acks."""
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        """Serve requests until the client hangs up."""
+        server = self.server
+        while True:
+            request = self.recv(12)
+            if request is None:
+                return
+            transaction, protocol, length, unit, function, address, count = \
+                Midnite.READ_REQUEST.unpack(request)
+            if length > 6:
+                self.recv(length - 6)
+
+            delay = server.latency + random.uniform(-server.jitter, server.jitter)
+            if delay > 0:
+                time.sleep(delay)
+
+            if function != Midnite.READ_HOLDING_REGISTERS:
+                # Illegal function
+                body = struct.pack('>BB', function | 0x80, 1)
+            else:
+                body = struct.pack(
+                    '>BB{}H'.format(count), function, count * 2,
+                    *server.read(address, count))
+            self.request.sendall(
+                Midnite.MBAP.pack(transaction, protocol, len(body) + 1, unit) + body)
+
+    def recv(self, size):
+        """Return exactly size bytes, None once the connection is closed."""
+        data = b""
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+# Classic simulator
+class ClassicSimulator(socketserver.ThreadingTCPServer):
+    """Modbus TCP server emulating the Classic register map.
+
+    Each request is answered after `latency` seconds, give or take up to
+    `jitter`. The fast changing registers drift between reads so decoded
+    data differs from poll to poll, everything else stays put.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0):
+        """Constructor."""
+        super().__init__(("127.0.0.1", port), ClassicHandler)
+        self.port = self.server_address[1]
+        self.latency = latency
+        self.jitter = min(jitter, latency)
+        self.lock = threading.Lock()
+        self.registers = {}
+        self.drifting = []
+        for block in Midnite.REGISTER_MAP.values():
+            # Field registers count from 1, addresses from 0
+            stable = set(
+                field.register - 1 for field in block.fields
+                if field.name == "reason_for_reset")
+            for register in range(block.address, block.address + block.count):
+                self.registers[register] = random.randrange(1, 1000)
+                if block.tier == Midnite.FAST and register not in stable:
+                    self.drifting.append(register)
+
+    # Read registers
+    def read(self, address, count):
+        """Return register values, drifting the fast registers first."""
+        with self.lock:
+            for register in random.sample(self.drifting, 8):
+                value = self.registers[register] + random.choice((-1, 1))
+                self.registers[register] = min(max(value, 0), 0xffff)
+            return [self.registers.get(register, 0)
+                    for register in range(address, address + count)]
+
+    # Start serving
+    def start(self):
+        """Serve in a background thread."""
+        threading.Thread(
+            target=self.serve_forever, name="classic-sim", daemon=True).start()
+        return self
+
+    # Stop serving
+    def stop(self):
+        """Shut the server down."""
+        self.shutdown()
+        self.server_close()
+
+
+# Magnum packets
+def magnum_packets(step=0):
+    """Return one round of Magnum network packets, values drifting with step."""
+    volts = 264 + step % 5
+    inverter = struct.pack(
+        '>BBhhBBBBBBBBBBBBhb',
+        0x40, 0, volts, 12 + step % 3, 120, 0, 0, 25, 0x27, 0, 60, 0, 107, 1,
+        0, 0, 0, 0)
+    remote = struct.pack(
+        '>BBBBBbBBBBBBBBBBBbBBB',
+        0x01, 0x20, 0x14, 0x30, 0x18, -5, 0x40, 0x0c, 0x1e, 0x08, 0x1e,
+        0x32, 0x5a, 0x64, 0x78, 0x05, 0x0a, 0, 0x14, 0x03, 0xa0)
+    bmk = struct.pack(
+        '>BbHhHHhHHBB',
+        0x81, 85, volts * 10, -150, 400, 500, 0, 600, 1200, 0, 1)
+    ags = struct.pack('>BbBbBB', 0xa1, 0, 0x14, 25, 0x1e, 0x02)
+    return [inverter, remote, inverter, bmk, inverter, ags]
+
+
+# Magnum simulator
+class MagnumSimulator:
+    """Pseudo terminal fed with a Magnum RS485 packet stream.
+
+    Packets are written at the network baud rate with `gap` seconds of
+    silence between them, which the reader takes as the end of a packet.
+    Point the Magnum reader at `path`.
+    """
+
+    def __init__(self, gap=0.02):
+        """Constructor."""
+        self.gap = gap
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.path = os.ttyname(self.slave)
+        self.running = False
+
+    # Start streaming
+    def start(self):
+        """Stream packets in a background thread."""
+        self.running = True
+        threading.Thread(target=self.run, name="magnum-sim", daemon=True).start()
+        return self
+
+    # Stream packets
+    def run(self):
+        """Write packet rounds until stopped."""
+        step = 0
+        while self.running:
+            for packet in magnum_packets(step):
+                try:
+                    os.write(self.master, packet)
+                except (BlockingIOError, OSError):
+                    # Nobody reading, the line just carries on
+                    pass
+                time.sleep(len(packet) * 10.0 / BAUD + self.gap)
+            step += 1
+
+    # Stop streaming
+    def stop(self):
+        """Stop streaming and close the terminal."""
+        self.running = False
+        time.sleep(self.gap * 2)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+# Replay Magnum reader
+class ReplayMagnum(magnum.Magnum):
+    """Magnum reader decoding a fixed list of packets instead of the port."""
+
+    def __init__(self, packets, **kwargs):
+        """Constructor."""
+        super().__init__(**kwargs)
+        self.packets = packets
+
+    def readPackets(self):
+        """Return the stored packets."""
+        return [bytearray(packet) for packet in self.packets]
+
+
+# Broker stand-in handler
+class BrokerHandler(socketserver.BaseRequestHandler):
+    """Accept an MQTT session and count what is published."""
+
+    def handle(self):
+        """Read packets until the client disconnects."""
+        stream = self.request.makefile("rb")
+        while True:
+            header = stream.read(1)
+            if not header:
+                return
+            length, multiplier = 0, 1
+            while True:
+                byte = stream.read(1)
+                if not byte:
+                    return
+                length += (byte[0] & 0x7f) * multiplier
+                multiplier *= 128
+                if not byte[0] & 0x80:
+                    break
+            body = stream.read(length)
+
+            kind = header[0] >> 4
+            if kind == 1:
+                # CONNECT, accept
+                self.request.sendall(b"\x20\x02\x00\x00")
+            elif kind == 3:
+                # PUBLISH, ack QoS 1 and 2 alike
+                topiclength = struct.unpack('>H', body[:2])[0]
+                topic = body[2:2 + topiclength].decode("utf-8")
+                if (header[0] >> 1) & 3:
+                    packetid = body[2 + topiclength:4 + topiclength]
+                    self.request.sendall(b"\x40\x02" + packetid)
+                self.server.received(topic, length)
+            elif kind == 12:
+                # PINGREQ
+                self.request.sendall(b"\xd0\x00")
+            elif kind == 14:
+                # DISCONNECT
+                return
+
+
+# Broker stand-in
+class BrokerStandIn(socketserver.ThreadingTCPServer):
+    """Minimal MQTT 3.1.1 broker that counts messages and bytes received."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        """Constructor."""
+        super().__init__(("127.0.0.1", port), BrokerHandler)
+        self.port = self.server_address[1]
+        self.condition = threading.Condition()
+        self.messages = 0
+        self.bytes = 0
+        self.marks = set()
+
+    # Count message
+    def received(self, topic, length):
+        """Record a published message."""
+        with self.condition:
+            if topic.startswith("benchmark/mark/"):
+                self.marks.add(topic)
+            else:
+                self.messages += 1
+                self.bytes += length
+            self.condition.notify_all()
+
+    # Wait for mark
+    def waitMark(self, topic, timeout=10):
+        """Wait until a mark topic arrives, everything sent before it has too."""
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: topic in self.marks, timeout=timeout)
+
+    # Start serving
+    def start(self):
+        """Serve in a background thread."""
+        threading.Thread(
+            target=self.serve_forever, name="broker", daemon=True).start()
+        return self
+
+    # Stop serving
+    def stop(self):
+        """Shut the server down."""
+        self.shutdown()
+        self.server_close()
+
+
+# Percentiles
+def percentiles(samples):
+    """Return latency stats in milliseconds of a list of durations."""
+    ordered = sorted(samples)
+
+    def rank(percent):
+        index = max(int(round(percent / 100.0 * len(ordered))) - 1, 0)
+        return ordered[index] * 1000
+
+    return OrderedDict([
+        ("cycles", len(ordered)),
+        ("p50", rank(50)),
+        ("p90", rank(90)),
+        ("p99", rank(99)),
+        ("max", ordered[-1] * 1000),
+        ("mean", sum(ordered) / len(ordered) * 1000),
+    ])
+
+
+# Time cycles
+def time_cycles(function, cycles, warmup):
+    """Return the durations of cycles of function after warming it up."""
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+# Measure allocations
+def allocations(function, cycles):
+    """Return the mean peak KiB allocated and bytes retained per cycle.
+
+    Traced on a separate pass, tracemalloc slows everything down.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        peak = retained = 0
+        for _ in range(cycles):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            function()
+            current, top = tracemalloc.get_traced_memory()
+            peak += top - before
+            retained += current - before
+    finally:
+        tracemalloc.stop()
+    return OrderedDict([
+        ("peak_kib", peak / cycles / 1024.0),
+        ("retained_bytes", retained / cycles),
+    ])
+
+
+# Measure function
+def measure(function, args, cycles=None):
+    """Return latency percentiles and allocations of a benchmark cycle."""
+    cycles = cycles or args.cycles
+    result = percentiles(time_cycles(function, cycles, args.warmup))
+    result.update(allocations(function, min(cycles, args.alloccycles)))
+    return result
+
+
+# Classic readers
+def classic_reader(args, simulator, backend):
+    """Return a Classic reader polling the simulator."""
+    options = {}
+    if backend is Midnite.AsyncMidnite:
+        options["request_timeout"] = args.classictimeout
+    reader = backend(
+        host="127.0.0.1",
+        port=simulator.port,
+        timeout=args.classictimeout,
+        retries=1,
+        wait=(0, 0),
+        name="Classic",
+        **options)
+    quiet(args)
+    return reader
+
+
+# Quiet logging
+def quiet(args):
+    """Keep per cycle log lines out of the results unless verbose."""
+    level = logging.DEBUG if args.verbose else logging.WARNING
+    logger.setLevel(level)
+    logging.getLogger(Midnite.__appname__).setLevel(level)
+
+
+# Benchmark Classic
+def bench_classic(args, backend):
+    """Measure Midnite getDevices against the simulated Classic."""
+    simulator = ClassicSimulator(
+        latency=args.latency, jitter=args.jitter).start()
+    reader = classic_reader(args, simulator, backend)
+    try:
+        result = measure(reader.getDevices, args)
+        result["reads_per_cycle"] = len(reader.dueReads())
+        return result
+    finally:
+        if backend is Midnite.AsyncMidnite:
+            reader.close()
+        simulator.stop()
+
+
+# Benchmark Magnum
+def bench_magnum(args):
+    """Measure magnum getDevices against the simulated RS485 stream."""
+    simulator = MagnumSimulator(gap=args.magnumgap).start()
+    reader = magnum.Magnum(
+        device=simulator.path,
+        packets=args.magnumpackets,
+        timeout=args.magnumtimeout)
+    try:
+        result = measure(reader.getDevices, args, args.magnumcycles)
+        result["devices"] = len(reader.getDevices())
+        return result
+    finally:
+        simulator.stop()
+
+
+# Benchmark streaming Magnum
+def bench_stream(args):
+    """Measure streaming Magnum getDevices against the simulated RS485 stream."""
+    simulator = MagnumSimulator(gap=args.magnumgap).start()
+    decodes = []
+
+    def observe(event, value):
+        if event == "decode":
+            decodes.append(value)
+
+    reader = StreamingMagnum(
+        device=simulator.path, timeout=args.magnumtimeout, observer=observe)
+    try:
+        # Let every device on the network be heard from
+        deadline = time.monotonic() + 5
+        while len(reader.getDevices()) < 4 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        result = measure(reader.getDevices, args)
+        result["devices"] = len(reader.getDevices())
+        if decodes:
+            result["packet_decode_ms"] = sum(decodes) / len(decodes) * 1000
+        return result
+    finally:
+        reader.close()
+        simulator.stop()
+
+
+# Benchmark decoding
+def bench_decode(args):
+    """Measure decode throughput without any I/O."""
+    simulator = ClassicSimulator()
+    blocks = OrderedDict(
+        (address, simulator.read(address, block.count))
+        for address, block in Midnite.REGISTER_MAP.items())
+    registers = sum(len(values) for values in blocks.values())
+    fields = sum(len(block.fields) for block in Midnite.REGISTER_MAP.values())
+    simulator.server_close()
+    reader = Midnite.Midnite(host="127.0.0.1", port=1, name="Classic")
+    quiet(args)
+
+    def classic():
+        reader.makeDevices(reader.decodeData(blocks))
+
+    packets = [packet for step in range(10) for packet in magnum_packets(step)]
+    replay = ReplayMagnum(packets)
+
+    result = OrderedDict()
+    start = time.perf_counter()
+    for _ in range(args.decodecycles):
+        classic()
+    elapsed = time.perf_counter() - start
+    result["classic_registers_per_s"] = registers * args.decodecycles / elapsed
+    result["classic_fields_per_s"] = fields * args.decodecycles / elapsed
+
+    start = time.perf_counter()
+    for _ in range(args.decodecycles // 10):
+        replay.getDevices()
+    elapsed = time.perf_counter() - start
+    result["magnum_packets_per_s"] = len(packets) * (args.decodecycles // 10) / elapsed
+
+    result.update(allocations(classic, args.alloccycles))
+    return result
+
+
+# Benchmark publishing
+def bench_publish(args):
+    """Measure powerpi publish through a real client to the broker stand-in."""
+    broker = BrokerStandIn().start()
+    options = [
+        "--broker", "127.0.0.1",
+        "--port", str(broker.port),
+        "--clientid", "powerpi-benchmark",
+        "--ignoremagnum",
+        "--ignoreclassic",
+    ] + args.publishargs.split()
+    powerpi.args = powerpi.get_arguments(options)
+    powerpi.setup_codec(powerpi.args)
+    powerpi.setup_mqtt(powerpi.args)
+    quiet(args)
+
+    # Device snapshots with a few fields moving each cycle
+    simulator = ClassicSimulator().start()
+    devices = classic_reader(args, simulator, Midnite.Midnite).getDevices()
+    devices.extend(ReplayMagnum(magnum_packets()).getDevices())
+    simulator.stop()
+
+    total = args.cycles + args.warmup + args.alloccycles + 1
+    snapshots = []
+    for step in range(total):
+        snapshot = deepcopy(devices)
+        for device in snapshot:
+            # Classic snapshots are read only
+            device["data"] = OrderedDict(device["data"])
+            numeric = [
+                key for key, value in device["data"].items()
+                if isinstance(value, int) and not isinstance(value, bool)]
+            for key in random.sample(numeric, min(3, len(numeric))):
+                device["data"][key] += step
+        snapshots.append(snapshot)
+
+    try:
+        deadline = time.monotonic() + 10
+        while not powerpi.client.connected_flag:
+            if time.monotonic() > deadline:
+                raise ConnectionError("broker stand-in did not accept the session")
+            time.sleep(0.01)
+
+        cycle = iter(snapshots)
+        marks = iter(range(total))
+
+        def publish():
+            powerpi.publish(next(cycle))
+            mark = "benchmark/mark/{}".format(next(marks))
+            powerpi.client.publish(mark, b"")
+            if not broker.waitMark(mark):
+                raise TimeoutError("broker stand-in missed {}".format(mark))
+
+        start = time.perf_counter()
+        result = measure(publish, args)
+        elapsed = time.perf_counter() - start
+        result["messages_per_s"] = broker.messages / elapsed
+        result["bytes_per_s"] = broker.bytes / elapsed
+        result["bytes_per_message"] = broker.bytes / max(broker.messages, 1)
+        return result
+    finally:
+        powerpi.teardown_mqtt()
+        broker.stop()
+
+
+# Compare with a baseline
+def compare(results, baseline, tolerance):
+    """Return the metrics that regressed past tolerance percent."""
+    regressions = []
+    for name, result in results.items():
+        for metric, value in result.items():
+            old = baseline.get(name, {}).get(metric)
+            if not old:
+                continue
+            change = (value - old) / old * 100
+            if metric.endswith("_per_s"):
+                change = -change
+            elif metric not in COMPARED:
+                continue
+            if change > tolerance:
+                regressions.append((name, metric, old, value, change))
+    return regressions
+
+
+# Report results
+def report(results):
+    """Print the results as one block per benchmark."""
+    for name, result in results.items():
+        print(name)
+        for metric, value in result.items():
+            if isinstance(value, float):
+                value = "{:.3f}".format(value) if value < 1000 else "{:.0f}".format(value)
+            print("  {:<24} {}".format(metric, value))
+
+
+# Get Arguments
+def get_arguments():
+    """Get parser arguments."""
+    parser.add(
+      "--only",
+      help="Run just this benchmark, repeat for several (default: all of {})".format(
+        ", ".join(BENCHMARKS)),
+      action="append",
+      choices=BENCHMARKS,
+      default=[])
+    parser.add(
+      "--cycles",
+      help="Timed cycles per benchmark (default: %(default)s)",
+      default=50,
+      type=int)
+    parser.add(
+      "--warmup",
+      help="Untimed cycles before timing (default: %(default)s)",
+      default=3,
+      type=int)
+    parser.add(
+      "--alloccycles",
+      help="Cycles traced for allocations (default: %(default)s)",
+      default=10,
+      type=int)
+    parser.add(
+      "--latency",
+      help="Seconds the simulated Classic takes to answer a request (default: %(default)s)",
+      default=0.005,
+      type=float)
+    parser.add(
+      "--jitter",
+      help="Seconds of random jitter on the Classic latency (default: %(default)s)",
+      default=0.002,
+      type=float)
+    parser.add(
+      "--classictimeout",
+      help="Classic request timeout in seconds (default: %(default)s)",
+      default=2.0,
+      type=float)
+    parser.add(
+      "--magnumcycles",
+      help="Timed Magnum cycles, each reads the port for a while (default: %(default)s)",
+      default=5,
+      type=int)
+    parser.add(
+      "--magnumpackets",
+      help="Packets read per Magnum cycle (default: %(default)s)",
+      default=50,
+      type=int)
+    parser.add(
+      "--magnumgap",
+      help="Seconds of silence between simulated Magnum packets (default: %(default)s)",
+      default=0.02,
+      type=float)
+    parser.add(
+      "--magnumtimeout",
+      help="Magnum reader inter packet timeout in seconds (default: %(default)s)",
+      default=0.005,
+      type=float)
+    parser.add(
+      "--decodecycles",
+      help="Decode iterations for the throughput figures (default: %(default)s)",
+      default=2000,
+      type=int)
+    parser.add(
+      "--publishargs",
+      help="Extra powerpi options for the publish benchmark, e.g. --publishargs=--fieldtopics (default: none)",
+      default="")
+    parser.add(
+      "--seed",
+      help="Random seed of the simulated data (default: %(default)s)",
+      default=1,
+      type=int)
+    parser.add(
+      "--json",
+      help="Write the results to this file")
+    parser.add(
+      "--baseline",
+      help="Compare with results saved by --json, exit 1 on a regression")
+    parser.add(
+      "--tolerance",
+      help="Percent a metric may get worse than the baseline (default: %(default)s)",
+      default=10.0,
+      type=float)
+    parser.add(
+      "-v",
+      "--verbose",
+      help="Show PowerPi log output (default: %(default)s)",
+      action="store_true")
+
+    args = parser.parse_args()
+    if args.cycles < 1 or args.magnumcycles < 1 or args.alloccycles < 1:
+        parser.error("arguments --cycles/--magnumcycles/--alloccycles: must be at least 1")
+    if args.decodecycles < 10:
+        parser.error("argument --decodecycles: must be at least 10")
+    return args
+
+
+# Main
+def main(args):
+    """Run the benchmarks."""
+    random.seed(args.seed)
+    logger.addHandler(logging.StreamHandler())
+
+    results = OrderedDict()
+    for name in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        if name == "classic":
+            results[name] = bench_classic(args, Midnite.Midnite)
+        elif name == "async":
+            results[name] = bench_classic(args, Midnite.AsyncMidnite)
+        elif name == "magnum":
+            results[name] = bench_magnum(args)
+        elif name == "stream":
+            results[name] = bench_stream(args)
+        elif name == "decode":
+            results[name] = bench_decode(args)
+        elif name == "publish":
+            results[name] = bench_publish(args)
+        report(OrderedDict([(name, results[name])]))
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, old, value, change in regressions:
+            print("REGRESSION {} {}: {:.3f} -> {:.3f} ({:+.1f}%)".format(
+                name, metric, old, value, change))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(get_arguments()))
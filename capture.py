@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Capture"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import bisect
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+# Magnum Energy
+from magnum import magnum
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# File header
+MAGIC = b"PPCAP\x01"
+# Record header (crc, kind, source name length, monotonic time, payload length)
+RECORD = struct.Struct('<IBBdI')
+# Record kinds
+SESSION = 0     # Wall clock and monotonic time a capture was opened at
+CLASSIC = 1     # Register blocks of one Classic poll
+MAGNUM = 2      # One raw Magnum packet
+# Session payload (wall clock time, monotonic time)
+ANCHOR = struct.Struct('<dd')
+# Register block header (address, register count)
+BLOCK = struct.Struct('<HH')
+# Index entry (wall clock time, monotonic time, offset)
+ENTRY = struct.Struct('<ddQ')
+# Seconds of capture between index entries
+INDEX_EVERY = 60
+# Seconds between flushes to disk
+FLUSH_EVERY = 1
+
+# Captured record, wall is the monotonic time on the wall clock
+Record = namedtuple('Record', ['kind', 'name', 'monotonic', 'wall', 'payload'])
+
+
+# Pack register blocks
+def pack_blocks(blocks):
+    """Return {address: registers} as a record payload."""
+    parts = []
+    for address, registers in blocks.items():
+        parts.append(BLOCK.pack(address, len(registers)))
+        parts.append(struct.pack('<{}H'.format(len(registers)), *registers))
+    return b"".join(parts)
+
+
+# Read record
+def read_record(file):
+    """Return (size, kind, name, monotonic, payload) of the record at the file position.
+
+    Returns None at the end of the file or at a torn or damaged record.
+    """
+    header = file.read(RECORD.size)
+    if len(header) < RECORD.size:
+        return None
+    crc, kind, namelength, monotonic, length = RECORD.unpack(header)
+    name = file.read(namelength)
+    payload = file.read(length)
+    if (len(name) < namelength or len(payload) < length or
+            zlib.crc32(header[4:] + name + payload) != crc):
+        return None
+    return RECORD.size + namelength + length, kind, name, monotonic, payload
+
+
+# Read index
+def read_entries(path):
+    """Return the whole (wall, monotonic, offset) entries of a capture index."""
+    with open(path + ".idx", "rb") as file:
+        data = file.read()
+    return [
+        ENTRY.unpack_from(data, position)
+        for position in range(0, len(data) - ENTRY.size + 1, ENTRY.size)]
+
+
+# Unpack register blocks
+def unpack_blocks(payload):
+    """Return the {address: registers} of a record payload."""
+    blocks = OrderedDict()
+    position = 0
+    while position < len(payload):
+        address, count = BLOCK.unpack_from(payload, position)
+        position += BLOCK.size
+        blocks[address] = list(struct.unpack_from('<{}H'.format(count), payload, position))
+        position += count * 2
+    return blocks
+
+
+class Capture:
+    """Append-only capture of raw Classic register blocks and Magnum packets.
+
+    Every record carries the monotonic time it was taken at, and each
+    session record opening a capture ties that clock to the wall clock.
+    An index of wall clock times and offsets is kept beside the capture
+    in `path`.idx so replays can start part way through.
+    """
+
+    def __init__(self, path):
+        """Constructor."""
+        self.path = path
+        self.lock = threading.Lock()
+        self.repair()
+        self.file = open(path, "ab")
+        self.index = open(path + ".idx", "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.flushed = self.indexed = time.monotonic()
+        self.anchor = (time.time(), self.indexed)
+        with self.lock:
+            self.addEntry(self.indexed)
+            self.write(SESSION, b"", self.indexed, ANCHOR.pack(*self.anchor))
+
+    # Repair
+    def repair(self):
+        """Cut the capture and its index back to the last whole record, as after power loss."""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        try:
+            entries = read_entries(self.path)
+            indexbytes = os.path.getsize(self.path + ".idx")
+        except OSError:
+            entries, indexbytes = [], 0
+        # Only the records after the last indexed one need checking
+        offsets = [entry[2] for entry in entries if entry[2] <= size]
+        valid = offsets[-1] if offsets else len(MAGIC)
+        with open(self.path, "rb") as file:
+            magic = file.read(len(MAGIC))
+            if magic != MAGIC:
+                if size and not MAGIC.startswith(magic):
+                    raise ValueError("{} is not a PowerPi capture".format(self.path))
+                valid = 0
+            else:
+                file.seek(valid)
+                while True:
+                    record = read_record(file)
+                    if record is None:
+                        break
+                    valid += record[0]
+
+        kept = [entry for entry in entries if entry[2] < valid]
+        if valid < size:
+            logger.warning("Capture {} has a torn record, cutting it back to {} bytes.".format(
+                self.path, valid))
+            os.truncate(self.path, valid)
+        if indexbytes > len(kept) * ENTRY.size:
+            os.truncate(self.path + ".idx", len(kept) * ENTRY.size)
+
+    # Add index entry
+    def addEntry(self, now):
+        """Index the next record, the lock must be held."""
+        wall = self.anchor[0] + now - self.anchor[1]
+        self.index.write(ENTRY.pack(wall, now, self.file.tell()))
+        self.indexed = now
+
+    # Write record
+    def write(self, kind, name, now, payload):
+        """Append a record, the lock must be held."""
+        header = RECORD.pack(0, kind, len(name), now, len(payload))[4:]
+        crc = zlib.crc32(header + name + payload)
+        self.file.write(struct.pack('<I', crc) + header + name + payload)
+
+    # Record
+    def record(self, kind, name, payload):
+        """Append a record taken now."""
+        now = time.monotonic()
+        with self.lock:
+            if self.file is None:
+                return
+            if now - self.indexed >= INDEX_EVERY:
+                self.addEntry(now)
+            self.write(kind, name, now, payload)
+            if now - self.flushed >= FLUSH_EVERY:
+                self.file.flush()
+                self.index.flush()
+                self.flushed = now
+
+    # Record Classic
+    def recordClassic(self, name, blocks):
+        """Capture the register blocks of a Classic poll."""
+        self.record(CLASSIC, name.encode("utf-8"), pack_blocks(blocks))
+
+    # Record Magnum
+    def recordMagnum(self, packet):
+        """Capture a raw Magnum packet."""
+        self.record(MAGNUM, b"", bytes(packet))
+
+    # Close
+    def close(self):
+        """Flush and close the capture."""
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.close()
+            self.index.close()
+            self.file = None
+
+
+class CaptureReader:
+    """Read the records of a capture back in order."""
+
+    def __init__(self, path):
+        """Constructor."""
+        self.path = path
+        self.entries = []
+        try:
+            self.entries = read_entries(path)
+        except OSError:
+            logger.warning("No index for capture {}, reading it from the start.".format(path))
+
+    # Seek
+    def seek(self, start):
+        """Return the (offset, anchor) to read from for records at start on."""
+        if not self.entries or start is None:
+            return len(MAGIC), None
+        walls = [entry[0] for entry in self.entries]
+        position = max(bisect.bisect_right(walls, start) - 1, 0)
+        wall, monotonic, offset = self.entries[position]
+        return offset, (wall, monotonic)
+
+    # Records
+    def records(self, start=None, end=None):
+        """Yield the records taken between wall clock start and end."""
+        offset, anchor = self.seek(start)
+        with open(self.path, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a PowerPi capture".format(self.path))
+            file.seek(offset)
+            while True:
+                record = read_record(file)
+                if record is None:
+                    if file.tell() == offset:
+                        return
+                    # Damaged write, carry on from the next indexed record
+                    following = [entry for entry in self.entries if entry[2] > offset]
+                    if not following:
+                        logger.error("Capture {} is corrupt after {} bytes.".format(
+                            self.path, offset))
+                        return
+                    wall, monotonic, skip = following[0]
+                    logger.error("Capture {} is corrupt at {} bytes, skipping to {}.".format(
+                        self.path, offset, skip))
+                    offset, anchor = skip, (wall, monotonic)
+                    file.seek(offset)
+                    continue
+                size, kind, name, monotonic, payload = record
+                offset += size
+
+                if kind == SESSION:
+                    anchor = ANCHOR.unpack(payload)
+                    continue
+                if anchor is None:
+                    raise ValueError("{} has records before a session".format(self.path))
+                wall = anchor[0] + monotonic - anchor[1]
+                if start is not None and wall < start:
+                    continue
+                if end is not None and wall >= end:
+                    return
+                yield Record(kind, name.decode("utf-8"), monotonic, wall, payload)
+
+
+class PacketMagnum(magnum.Magnum):
+    """Magnum parser fed captured packets instead of the port."""
+
+    def __init__(self, **kwargs):
+        """Constructor."""
+        super().__init__(**kwargs)
+        self.packets = []
+
+    def readPackets(self):
+        """Return the packets fed since the last read."""
+        packets, self.packets = self.packets, []
+        return packets
@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Codec"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import json
+import math
+import struct
+import sys
+import zlib
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
+
+import configargparse
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# First byte of packed payloads, never used by MessagePack while JSON
+# payloads start with "{"
+MAGIC = 0xC1
+# Packed header: magic, flags, schema id, epoch seconds, UTC offset in
+# minutes, status and age
+HEADER = struct.Struct("<BBIdhBf")
+# Header flags
+PARTIAL = 1         # A bitmap of the schema fields present follows the header
+KEYFRAME = 2        # The payload carries a delta mode keyframe flag
+KEYFRAME_SET = 4    # ... and it is set
+AGE = 8             # The age is set
+# Device statuses by header code
+STATUSES = ("online", "stale", "offline")
+# Length of text values
+LENGTH = struct.Struct("<H")
+# Kinds of fields without a register type, numbers widen left to right
+NUMBERS = ("?", "i", "q", "f", "d")
+TEXT = "s"
+JSON = "j"
+# Floats are packed as float32 only when that keeps them exactly
+FLOAT32 = struct.Struct("<f")
+
+
+# Kind of value
+def kind_of(value):
+    """Return the packed field kind of a value."""
+    if isinstance(value, bool):
+        return "?"
+    if isinstance(value, int):
+        if -2**31 <= value < 2**31:
+            return "i"
+        if -2**63 <= value < 2**63:
+            return "q"
+        return JSON
+    if isinstance(value, float):
+        return "f" if exact_float32(value) else "d"
+    if isinstance(value, str):
+        return TEXT
+    return JSON
+
+
+# Exact float32
+def exact_float32(value):
+    """Return whether a number survives packing as a float32 unchanged."""
+    if math.isnan(value):
+        return True
+    try:
+        return FLOAT32.unpack(FLOAT32.pack(value))[0] == value
+    except OverflowError:
+        return False
+
+
+# Widen kinds
+def widen(kind, other):
+    """Return the narrowest kind holding values of both kinds."""
+    if kind == other:
+        return kind
+    if kind in NUMBERS and other in NUMBERS:
+        wider = max(kind, other, key=NUMBERS.index)
+        if wider == "f" and "?" not in (kind, other):
+            # Float32 only holds 24 bit integers exactly
+            return "d"
+        return wider
+    return JSON
+
+
+# Plain mapping
+def plain(value):
+    """Return read only mappings, like Classic snapshots, as dicts to encode."""
+    if isinstance(value, Mapping):
+        return OrderedDict(value.items())
+    raise TypeError("{} is not serializable".format(type(value).__name__))
+
+
+# Schema
+class Schema:
+    """Field layout of the packed payloads of one device.
+
+    Fields are (name, kind, scale, offset). Register fields are packed as
+    their raw register type and scaled back when decoded, other numbers
+    by the kind their values need. Text and anything else, as JSON, follow
+    the numbers with a length in front.
+    """
+
+    def __init__(self, device, fields):
+        """Constructor."""
+        self.device = device
+        self.fields = [tuple(field) for field in fields]
+        self.names = [field[0] for field in self.fields]
+        self.index = {name: index for index, name in enumerate(self.names)}
+        self.id = zlib.crc32(json.dumps(
+            [device, self.fields], separators=(',', ':')).encode("utf-8"))
+        self.message = json.dumps(OrderedDict([
+            ("format", MAGIC),
+            ("id", self.id),
+            ("device", device),
+            ("fields", self.fields),
+        ]), separators=(',', ':'))
+        self.struct = self.compile(range(len(self.fields)))
+        self.bitmap = (len(self.fields) + 7) // 8
+
+    # Load
+    @classmethod
+    def load(cls, message):
+        """Return the schema of a published schema message."""
+        data = json.loads(message)
+        if data.get("format") != MAGIC:
+            raise ValueError("Unknown schema format {}".format(data.get("format")))
+        schema = cls(data["device"], data["fields"])
+        if schema.id != data["id"]:
+            raise ValueError("Schema {} of {} does not match its fields".format(
+                data["id"], schema.device))
+        return schema
+
+    # Compile
+    def compile(self, present):
+        """Return the struct of the numbers among present fields."""
+        return struct.Struct("<" + "".join(
+            self.fields[index][1] for index in present
+            if self.fields[index][1] not in (TEXT, JSON)))
+
+
+# Codec
+class Codec:
+    """Device payload encoding, JSON unless overridden."""
+
+    name = "json"
+
+    # Encode
+    def encode(self, payload):
+        """Return a device payload encoded."""
+        return json.dumps(
+            payload,
+            indent=None,
+            ensure_ascii=True,
+            allow_nan=True,
+            separators=(',', ':'),
+            default=plain)
+
+    # Take schemas
+    def takeSchemas(self):
+        """Return schemas added since the last call, to publish retained."""
+        return []
+
+
+# MessagePack codec
+class MsgpackCodec(Codec):
+    """Device payloads as MessagePack maps."""
+
+    name = "msgpack"
+
+    def __init__(self):
+        """Constructor."""
+        if msgpack is None:
+            raise ImportError("The msgpack codec needs the msgpack package")
+        # Packs into its own internal buffer, reused between payloads
+        self.packer = msgpack.Packer(use_bin_type=True, default=plain)
+
+    # Encode
+    def encode(self, payload):
+        """Return a device payload as MessagePack."""
+        return self.packer.pack(payload)
+
+
+# Packed codec
+class PackedCodec(Codec):
+    """Device payloads as a struct laid out by a published schema.
+
+    Keys are sent once, in the schema of each device, instead of in every
+    payload. `registers` maps device names to their register fields,
+    name: (struct char, scale, offset). A schema is replaced by a wider
+    one whenever a payload no longer fits it.
+    """
+
+    name = "packed"
+
+    def __init__(self, registers=None, size=1024):
+        """Constructor."""
+        self.registers = registers or {}
+        self.schemas = {}
+        self.added = []
+        # Grown as needed and reused between payloads
+        self.buffer = bytearray(size)
+
+    # Take schemas
+    def takeSchemas(self):
+        """Return schema messages added since the last call."""
+        added, self.added = self.added, []
+        return added
+
+    # Update schema
+    def update(self, device, values):
+        """Replace the schema of a device by one fitting values."""
+        schema = self.schemas.get(device)
+        fields = OrderedDict()
+        if schema is not None:
+            for field in schema.fields:
+                fields[field[0]] = field
+        registers = self.registers.get(device, {})
+
+        for name, value in values.items():
+            field = fields.get(name)
+            if name in registers and (field is None or field[1] == registers[name][0]):
+                char, scale, offset = registers[name]
+                try:
+                    struct.pack("<" + char, self.raw(value, scale, offset))
+                    fields[name] = (name, char, scale, offset)
+                    continue
+                except (struct.error, TypeError, ValueError, OverflowError):
+                    # Does not fit its register, pack it by value from now on
+                    field = None
+            kind = kind_of(value)
+            if field is not None and field[2] is None and field[3] is None:
+                kind = widen(field[1], kind)
+            fields[name] = (name, kind, None, None)
+
+        schema = Schema(device, fields.values())
+        self.schemas[device] = schema
+        self.added.append(schema.message)
+        logger.info("Packed schema {} of {} has {} fields.".format(
+            schema.id, device, len(schema.fields)))
+        return schema
+
+    # Raw value
+    @staticmethod
+    def raw(value, scale, offset):
+        """Return a scaled register value as the register held it."""
+        if scale is None and offset is None:
+            return value
+        return int(round((value - (offset or 0.0)) * (scale or 1.0)))
+
+    # Encode
+    def encode(self, payload):
+        """Return a device payload packed by the schema of its device."""
+        device = payload["device"]
+        values = payload["data"]
+        schema = self.schemas.get(device)
+        if schema is not None:
+            try:
+                return self.pack(schema, payload)
+            except (KeyError, struct.error, TypeError, ValueError,
+                    AttributeError, OverflowError):
+                pass
+        return self.pack(self.update(device, values), payload)
+
+    # Pack
+    def pack(self, schema, payload):
+        """Pack a payload into the buffer and return its bytes."""
+        values = payload["data"]
+        present = [schema.index[name] for name in values]
+        layout = schema.struct
+        flags = 0
+        if len(present) != len(schema.fields):
+            flags |= PARTIAL
+            present.sort()
+            layout = schema.compile(present)
+
+        numbers = []
+        texts = []
+        fields = schema.fields
+        for index in present:
+            name, kind, scale, offset = fields[index]
+            value = values[name]
+            if kind == TEXT:
+                texts.append(value.encode("utf-8"))
+            elif kind == JSON:
+                texts.append(json.dumps(value, separators=(',', ':')).encode("utf-8"))
+            elif scale is None and offset is None:
+                if kind == "?" and not isinstance(value, bool):
+                    # Struct would pack any value as its truth
+                    raise TypeError("{} is not a bool".format(name))
+                if kind == "f" and not exact_float32(value):
+                    # Struct would round it, widen the schema instead
+                    raise ValueError("{} does not fit a float32".format(name))
+                numbers.append(value)
+            else:
+                numbers.append(int(round((value - (offset or 0.0)) * (scale or 1.0))))
+
+        moment = datetime.fromisoformat(payload["datetime"])
+        utcoffset = moment.utcoffset()
+        age = payload.get("age")
+        if age is not None:
+            flags |= AGE
+        if "keyframe" in payload:
+            flags |= KEYFRAME | (KEYFRAME_SET if payload["keyframe"] else 0)
+
+        bitmap = schema.bitmap if flags & PARTIAL else 0
+        size = HEADER.size + bitmap + layout.size + sum(
+            LENGTH.size + len(text) for text in texts)
+        if len(self.buffer) < size:
+            self.buffer.extend(bytes(size - len(self.buffer)))
+        buffer = self.buffer
+
+        HEADER.pack_into(
+            buffer, 0, MAGIC, flags, schema.id, moment.timestamp(),
+            int(utcoffset.total_seconds() // 60) if utcoffset else 0,
+            STATUSES.index(payload.get("status", "online")),
+            age if age is not None else 0.0)
+        position = HEADER.size
+        if bitmap:
+            buffer[position:position + bitmap] = bytes(bitmap)
+            for index in present:
+                buffer[position + index // 8] |= 1 << (index % 8)
+            position += bitmap
+        layout.pack_into(buffer, position, *numbers)
+        position += layout.size
+        for text in texts:
+            if len(text) > 0xFFFF:
+                raise ValueError("Text over 65535 bytes")
+            LENGTH.pack_into(buffer, position, len(text))
+            position += LENGTH.size
+            buffer[position:position + len(text)] = text
+            position += len(text)
+        return bytes(memoryview(buffer)[:position])
+
+
+# Payload codecs by name
+CODECS = OrderedDict([
+    ("json", Codec),
+    ("msgpack", MsgpackCodec),
+    ("packed", PackedCodec),
+])
+
+
+# Get codec
+def get_codec(name, registers=None):
+    """Return a codec by name, packed codecs laid out by registers."""
+    if name == "packed":
+        return PackedCodec(registers)
+    return CODECS[name]()
+
+
+# Decoder
+class Decoder:
+    """Turn payloads of any codec back into the JSON payload structure.
+
+    Packed payloads need the schema they were packed with, so feed every
+    message published to a schema topic to addSchema(). Schemas are kept
+    by id, so payloads queued before a schema changed still decode.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.schemas = {}
+
+    # Add schema
+    def addSchema(self, message):
+        """Add a published schema message."""
+        schema = Schema.load(message)
+        self.schemas[schema.id] = schema
+        return schema
+
+    # Decode
+    def decode(self, payload):
+        """Return a decoded payload, telling codecs apart by the first byte."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if payload[:1] == b"{":
+            return json.loads(payload.decode("utf-8"), object_pairs_hook=OrderedDict)
+        if payload[:1] == bytes((MAGIC,)):
+            return self.unpack(payload)
+        if msgpack is None:
+            raise ValueError("Payload is not JSON or packed and msgpack is not installed")
+        return msgpack.unpackb(payload, raw=False, object_pairs_hook=OrderedDict)
+
+    # Unpack
+    def unpack(self, payload):
+        """Return a packed payload decoded by its schema."""
+        _, flags, schemaid, timestamp, utcoffset, status, age = \
+            HEADER.unpack_from(payload)
+        schema = self.schemas.get(schemaid)
+        if schema is None:
+            raise KeyError("Unknown packed schema {}".format(schemaid))
+
+        position = HEADER.size
+        present = range(len(schema.fields))
+        layout = schema.struct
+        if flags & PARTIAL:
+            bitmap = payload[position:position + schema.bitmap]
+            present = [
+                index for index in present
+                if bitmap[index // 8] & (1 << (index % 8))]
+            layout = schema.compile(present)
+            position += schema.bitmap
+        numbers = iter(layout.unpack_from(payload, position))
+        position += layout.size
+
+        values = OrderedDict()
+        for index in present:
+            name, kind, scale, offset = schema.fields[index]
+            if kind in (TEXT, JSON):
+                length, = LENGTH.unpack_from(payload, position)
+                position += LENGTH.size
+                text = payload[position:position + length].decode("utf-8")
+                position += length
+                values[name] = text if kind == TEXT else json.loads(text)
+                continue
+            value = next(numbers)
+            if scale is not None or offset is not None:
+                value = value / (scale or 1.0) + (offset or 0.0)
+            values[name] = value
+
+        data = OrderedDict()
+        data["datetime"] = datetime.fromtimestamp(
+            timestamp, timezone(timedelta(minutes=utcoffset))).isoformat()
+        data["device"] = schema.device
+        if STATUSES[status] != "online":
+            data["status"] = STATUSES[status]
+        if flags & AGE:
+            data["age"] = round(age, 3)
+        if flags & KEYFRAME:
+            data["keyframe"] = bool(flags & KEYFRAME_SET)
+        data["data"] = values
+        return data
+
+
+# Get Arguments
+def get_arguments():
+    """Get parser arguments."""
+    parser = configargparse.ArgParser(
+        description="Print PowerPi device payloads of any codec as JSON")
+    parser.add(
+      "-b",
+      "--broker",
+      help="MQTT broker (default: %(default)s)",
+      default="localhost")
+    parser.add(
+      "-p",
+      "--port",
+      help="MQTT broker port (default: %(default)s)",
+      default=1883,
+      type=int)
+    parser.add(
+      "-u",
+      "--username",
+      help="MQTT username")
+    parser.add(
+      "-P",
+      "--password",
+      help="MQTT password")
+    parser.add(
+      "-t",
+      "--topic",
+      help="Topic prefix (default: %(default)s)",
+      default="powerpi/")
+    args = parser.parse_args()
+    if args.topic[-1] != "/":
+        args.topic += "/"
+    return args
+
+
+# Main
+def main(args):
+    """Subscribe to the device and schema topics and print each payload."""
+    import paho.mqtt.client as mqtt
+
+    decoder = Decoder()
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe([(args.topic + "+/schema", 1), (args.topic + "+", 0)])
+
+    def on_message(client, userdata, message):
+        try:
+            if message.topic.endswith("/schema"):
+                decoder.addSchema(message.payload)
+                return
+            print(json.dumps(decoder.decode(message.payload), allow_nan=True))
+            sys.stdout.flush()
+        except (KeyError, ValueError, struct.error) as e:
+            logger.error("Could not decode {}: {}".format(message.topic, e))
+
+    client = mqtt.Client()
+    if args.username:
+        client.username_pw_set(args.username, args.password)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(args.broker, args.port)
+    client.loop_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig()
+    try:
+        main(get_arguments())
+    except KeyboardInterrupt:
+        pass
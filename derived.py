@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Derived"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import importlib
+from collections import OrderedDict
+from collections.abc import ItemsView, Mapping, MutableMapping
+from itertools import chain
+from operator import itemgetter
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Registered derivations by name
+DERIVATIONS = OrderedDict()
+
+
+# Derivation
+class Derivation:
+    """Field computed from other fields of a device sample.
+
+    The function is called with the values of `fields` in order, after a
+    per device state dict when stateful, and returns the derived value.
+    """
+
+    __slots__ = ("name", "fields", "function", "stateful", "unit")
+
+    def __init__(self, name, fields, function, stateful=False, unit=None):
+        """Constructor."""
+        self.name = name
+        self.fields = tuple(fields)
+        self.function = function
+        self.stateful = stateful
+        self.unit = unit
+
+
+# Register derivation
+def register(name, fields, function, stateful=False, unit=None):
+    """Register a derivation, replacing any of the same name."""
+    DERIVATIONS[name] = Derivation(name, fields, function, stateful, unit)
+
+
+# Derivation decorator
+def derivation(name, *fields, stateful=False, unit=None):
+    """Register the decorated function as a derivation of fields."""
+    def decorator(function):
+        register(name, fields, function, stateful, unit)
+        return function
+    return decorator
+
+
+# Load plugins
+def load_plugins(modules):
+    """Import modules registering derivations of their own."""
+    for module in modules:
+        importlib.import_module(module)
+        logger.debug("Loaded derivations from {}.".format(module))
+
+
+# Derived items
+class DerivedItems(ItemsView):
+    """Items of derived data, the sample's then the derived fields."""
+
+    __slots__ = ()
+
+    def __iter__(self):
+        """Iterate (name, value) pairs without looking them up."""
+        return chain(self._mapping.base.items(), self._mapping.extra.items())
+
+
+# Derived data
+class DerivedData(Mapping):
+    """Immutable view of a device sample and the fields derived from it.
+
+    Leaves the sample as it is, so Classic snapshots are still shared
+    rather than copied.
+    """
+
+    __slots__ = ("base", "extra")
+
+    def __init__(self, base, extra):
+        """Constructor."""
+        self.base = base
+        self.extra = extra
+
+    def __getitem__(self, key):
+        """Return the value of a field."""
+        if key in self.extra:
+            return self.extra[key]
+        return self.base[key]
+
+    def __iter__(self):
+        """Iterate sample fields, then derived fields."""
+        return chain(self.base, self.extra)
+
+    def __len__(self):
+        """Return the number of fields."""
+        return len(self.base) + len(self.extra)
+
+    def __contains__(self, key):
+        """Return whether the sample or a derivation has a field."""
+        return key in self.extra or key in self.base
+
+    def __eq__(self, other):
+        """Compare fields, part by part against other derived data."""
+        if isinstance(other, DerivedData):
+            return self.extra == other.extra and self.base == other.base
+        return Mapping.__eq__(self, other)
+
+    __hash__ = None
+
+    def items(self):
+        """Return (name, value) pairs."""
+        return DerivedItems(self)
+
+
+# Deriver
+class Deriver:
+    """Add a chosen set of derived fields to every device sample.
+
+    The derivations covering each device are worked out on first sight,
+    with an item getter fetching their inputs in one call, so each sample
+    only runs the functions themselves. Immutable samples such as Classic
+    snapshots are wrapped rather than copied.
+    """
+
+    def __init__(self, names):
+        """Constructor."""
+        unknown = [name for name in names if name not in DERIVATIONS]
+        if unknown:
+            raise ValueError("unknown derived fields {}, expected some of {}".format(
+                ", ".join(unknown), ", ".join(DERIVATIONS)))
+        self.derivations = [DERIVATIONS[name] for name in OrderedDict.fromkeys(names)]
+        # (derivation, input getter, single input) steps per device
+        self.plans = {}
+        # State of stateful derivations per (device, derivation)
+        self.states = {}
+
+    # Plan
+    def plan(self, name, data):
+        """Return the steps deriving fields of a device with these fields."""
+        steps = []
+        for derived in self.derivations:
+            if all(field in data for field in derived.fields):
+                steps.append((derived, itemgetter(*derived.fields), len(derived.fields) == 1))
+        logger.debug("{} derived fields cover {}.".format(len(steps), name))
+        return steps
+
+    # Derive
+    def derive(self, devices):
+        """Return the devices with their derived fields added."""
+        derived = []
+        for device in devices:
+            name = device["device"]
+            data = device["data"]
+            steps = self.plans.get(name)
+            if steps is None:
+                steps = self.plans[name] = self.plan(name, data)
+            if not steps:
+                derived.append(device)
+                continue
+
+            extra = OrderedDict()
+            for derivation, getter, single in steps:
+                values = getter(data)
+                if single:
+                    values = (values,)
+                try:
+                    if derivation.stateful:
+                        key = (name, derivation.name)
+                        state = self.states.get(key)
+                        if state is None:
+                            state = self.states[key] = {}
+                        extra[derivation.name] = derivation.function(state, *values)
+                    else:
+                        extra[derivation.name] = derivation.function(*values)
+                except Exception as e:
+                    logger.debug("Deriving {} of {} failed: {}".format(
+                        derivation.name, name, e))
+            device = OrderedDict(device)
+            if isinstance(data, MutableMapping):
+                # Plain samples stay plain, they are small and may be updated
+                device["data"] = OrderedDict(data)
+                device["data"].update(extra)
+            else:
+                device["data"] = DerivedData(data, extra)
+            derived.append(device)
+        return derived
+
+
+# PV power
+@derivation("pv_power", "avg_pv_voltage", "avg_pv_current", unit="W")
+def pv_power(voltage, current):
+    """Return the power drawn from the PV array."""
+    return round(voltage * current, 1)
+
+
+# Conversion efficiency
+@derivation("conversion_efficiency", "avg_power", "avg_pv_voltage", "avg_pv_current", unit="%")
+def conversion_efficiency(power, voltage, current):
+    """Return the percentage of PV power delivered to the battery, 0 in the dark."""
+    pv = voltage * current
+    if pv <= 0:
+        return 0.0
+    return round(100.0 * power / pv, 1)
+
+
+# Battery power
+@derivation("battery_power", "avg_battery_voltage", "wbjr_battery_current", unit="W")
+def battery_power(voltage, current):
+    """Return the net battery power from the WhizBang Jr., positive when charging."""
+    return round(voltage * current, 1)
+
+
+# MAC address
+@derivation("mac_address", "mac_5", "mac_4", "mac_3", "mac_2", "mac_1", "mac_0")
+def mac_address(*octets):
+    """Return the MAC address as a string."""
+    return ":".join("{:02x}".format(octet) for octet in octets)
+
+
+# Unit name
+@derivation("unit_name", *("name_{}".format(i) for i in range(8)))
+def unit_name(*characters):
+    """Return the unit name as a string."""
+    return bytes(characters).split(b"\x00", 1)[0].decode("ascii", "replace").strip()
+
+
+# Energy delta
+@derivation("energy_delta", "lifetime_energy", stateful=True, unit="kWh")
+def energy_delta(state, energy):
+    """Return the energy harvested since the last sample, 0 on the first or a reset."""
+    previous = state.get("energy")
+    state["energy"] = energy
+    if previous is None or energy < previous:
+        return 0.0
+    return round(energy - previous, 1)
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Gateway"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import multiprocessing
+import signal
+import threading
+import time
+from collections import OrderedDict, deque
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Worker requests
+POLL = "poll"
+CLOSE = "close"
+# Seconds a worker has to close before it is killed
+CLOSE_TIMEOUT = 5
+
+# Fresh interpreters, so workers inherit none of the publisher's threads or sockets
+context = multiprocessing.get_context("spawn")
+
+
+# Forward hook
+def forward(events, name, hook):
+    """Return a callback queueing a reader's calls for the supervisor."""
+    def callback(*values):
+        events.append((name, hook, values))
+    return callback
+
+
+# Run worker
+def run_worker(conn, readers, setup):
+    """Build readers and serve polls of them until closed or orphaned.
+
+    Readers are (name, factory, options, hook names). Each poll names a
+    reader and is answered with (devices, error, hook calls, stats), the
+    hook calls being those the readers made since the last poll.
+    """
+    # Interrupts are for the supervisor, which closes its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if setup is not None:
+        setup[0](*setup[1:])
+
+    events = deque()
+    built = OrderedDict()
+    for name, factory, options, hooks in readers:
+        for hook in hooks:
+            options[hook] = forward(events, name, hook)
+        built[name] = factory(**options)
+    try:
+        while True:
+            try:
+                request = conn.recv()
+            except EOFError:
+                break
+            if request == CLOSE:
+                break
+
+            reader = built[request[1]]
+            devices = error = None
+            try:
+                devices = reader.getDevices()
+            except Exception as e:
+                error = "{}: {}".format(type(e).__name__, e)
+            calls = []
+            while events:
+                calls.append(events.popleft())
+            stats = reader.getStats() if hasattr(reader, "getStats") else None
+            conn.send((devices, error, calls, stats))
+    finally:
+        for reader in built.values():
+            close = getattr(reader, "close", None)
+            if close is not None:
+                close()
+
+
+# Worker
+class Worker:
+    """Worker process running one or more readers.
+
+    Readers sharing a connection, such as Classics behind one Modbus
+    gateway, are added to the same worker so their reads still take turns
+    on it. The worker is polled over a Unix socket pair, one poll at a
+    time. Hook callbacks the readers make in the worker, such as observers
+    and recorders, are replayed here after each poll. A worker that dies
+    or does not answer within `timeout` seconds is killed and restarted,
+    waiting `backoff` seconds, doubling up to `maxbackoff`, while it keeps
+    failing.
+    """
+
+    def __init__(self, name, setup=None, timeout=60, backoff=1, maxbackoff=300,
+                 observer=None):
+        """Constructor."""
+        self.name = name
+        self.readers = []
+        self.hooks = {}
+        # Stats of each reader as of its last poll
+        self.stats = {}
+        self.setup = setup
+        self.timeout = timeout
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.delay = backoff
+        # Monotonic time the worker may next be restarted
+        self.restartAt = 0
+        self.observer = observer
+        self.lock = threading.Lock()
+        self.conn = None
+        self.process = None
+
+    # Add reader
+    def add(self, name, factory, options=None, hooks=None):
+        """Add a reader before the worker starts, returning its stand in."""
+        hooks = dict(hooks or {})
+        self.readers.append((name, factory, dict(options or {}), list(hooks)))
+        self.hooks[name] = hooks
+        return WorkerReader(self, name)
+
+    # Start worker
+    def start(self):
+        """Start a worker process."""
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=run_worker,
+            args=(child, self.readers, self.setup),
+            name="{}-worker".format(self.name),
+            daemon=True)
+        self.process.start()
+        child.close()
+        logger.debug("Started {} worker, pid {}.".format(self.name, self.process.pid))
+
+    # Stop worker
+    def stop(self):
+        """Kill the worker process."""
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(CLOSE_TIMEOUT)
+
+    # Restart worker
+    def restart(self, reason):
+        """Replace a failed worker, unless it is still backing off."""
+        now = time.monotonic()
+        if now < self.restartAt:
+            raise RuntimeError("{} worker {}, restarting in {:.0f}s".format(
+                self.name, reason, self.restartAt - now))
+        logger.error("{} worker {}, restarting it.".format(self.name, reason))
+        self.stop()
+        self.start()
+        self.restartAt = now + self.delay
+        self.delay = min(self.delay * 2, self.maxbackoff)
+        if self.observer is not None:
+            for name in self.hooks:
+                self.observer(name, "restart", 1)
+
+    # Poll
+    def poll(self, name):
+        """Poll a reader of the worker, returning its devices."""
+        with self.lock:
+            if not self.process.is_alive():
+                self.restart("exited with {}".format(self.process.exitcode))
+            try:
+                self.conn.send((POLL, name))
+                answered = self.conn.poll(self.timeout)
+                if answered:
+                    devices, error, calls, stats = self.conn.recv()
+            except (EOFError, OSError):
+                self.restart("died")
+                raise RuntimeError("{} worker died mid poll".format(self.name))
+            if not answered:
+                self.restart("did not answer within {}s".format(self.timeout))
+                raise TimeoutError("{} worker timed out".format(self.name))
+
+            for reader, hook, values in calls:
+                self.hooks[reader][hook](*values)
+            if stats is not None:
+                self.stats[name] = stats
+            if error is not None:
+                raise RuntimeError(error)
+            self.delay = self.backoff
+            return devices
+
+    # Close
+    def close(self):
+        """Close the worker's readers and stop it, once."""
+        with self.lock:
+            if self.process is None:
+                return
+            try:
+                self.conn.send(CLOSE)
+            except OSError:
+                pass
+            self.process.join(CLOSE_TIMEOUT)
+            self.stop()
+            self.process = None
+
+
+# Worker reader
+class WorkerReader:
+    """Stand in for a reader running in a worker process."""
+
+    def __init__(self, worker, name):
+        """Constructor."""
+        self.worker = worker
+        self.name = name
+
+    # Get devices
+    def getDevices(self):
+        """Poll the worker, returning its reader's devices."""
+        return self.worker.poll(self.name)
+
+    # Get stats
+    def getStats(self):
+        """Return the reader's stats as of the last poll."""
+        return self.worker.stats.get(self.name)
+
+    # Close
+    def close(self):
+        """Close the worker, along with any readers sharing it."""
+        self.worker.close()
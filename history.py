@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "History"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import configargparse
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Rollup tables and their bucket seconds, finest first
+RESOLUTIONS = OrderedDict([
+    ("raw", 0),
+    ("minute", 60),
+    ("hour", 3600),
+])
+# Longest span of each resolution picked automatically, in seconds
+AUTO_SPANS = OrderedDict([
+    ("raw", 6 * 3600),
+    ("minute", 14 * 86400),
+    ("hour", None),
+])
+# Relative time units
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    field TEXT NOT NULL,
+    UNIQUE (device, field));
+CREATE TABLE IF NOT EXISTS raw (
+    series INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (series, ts)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS minute (
+    series INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    sum REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (series, ts)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hour (
+    series INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    min REAL NOT NULL,
+    max REAL NOT NULL,
+    sum REAL NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (series, ts)) WITHOUT ROWID;
+"""
+
+# Merge a partial aggregate into a rollup row
+ROLLUP = """
+INSERT INTO {0} (series, ts, min, max, sum, count) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (series, ts) DO UPDATE SET
+    min = min({0}.min, excluded.min),
+    max = max({0}.max, excluded.max),
+    sum = {0}.sum + excluded.sum,
+    count = {0}.count + excluded.count
+"""
+
+
+# Connect
+def connect(path):
+    """Open the history database in WAL mode."""
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+
+# Parse time
+def parse_time(text, now=None):
+    """Return epoch seconds of 'now', '-90m', an epoch number or an ISO time."""
+    now = time.time() if now is None else now
+    text = str(text).strip()
+    if text in ("", "now"):
+        return now
+    match = re.match(r"^-(\d+(?:\.\d+)?)([smhdw])$", text)
+    if match:
+        return now - float(match.group(1)) * UNITS[match.group(2)]
+    try:
+        return float(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+class History:
+    """Local time series store of every device sample.
+
+    Samples are queued in memory and written by a background thread in one
+    transaction every `flush` seconds. The same batch is merged into minute
+    and hour rollups. Rows past the retention of their table are pruned,
+    a retention of 0 keeps them for good.
+    """
+
+    def __init__(self, path, flush=10, retention=None):
+        """Constructor."""
+        self.path = path
+        self.flush = flush
+        self.retention = OrderedDict([("raw", 86400), ("minute", 30 * 86400), ("hour", 0)])
+        self.retention.update(retention or {})
+        self.lock = threading.Lock()
+        self.queue = []
+        self.series = {}
+        self.pruned = 0.0
+        self.stopped = threading.Event()
+
+        self.connection = connect(path)
+        self.connection.executescript(SCHEMA)
+        for series, device, field in self.connection.execute(
+                "SELECT id, device, field FROM series"):
+            self.series[(device, field)] = series
+
+        self.thread = threading.Thread(target=self.run, name="history", daemon=True)
+        self.thread.start()
+
+    # Record samples
+    def record(self, devices, timestamp=None):
+        """Queue the numeric fields of devices read at timestamp."""
+        timestamp = time.time() if timestamp is None else timestamp
+        samples = []
+        for device in devices:
+            name = device["device"]
+            for field, value in device["data"].items():
+                if isinstance(value, (int, float)):
+                    samples.append((name, field, timestamp, float(value)))
+        with self.lock:
+            self.queue.extend(samples)
+
+    # Series id
+    def seriesId(self, device, field):
+        """Return the id of a series, adding it if new."""
+        key = (device, field)
+        if key not in self.series:
+            cursor = self.connection.execute(
+                "INSERT INTO series (device, field) VALUES (?, ?)", key)
+            self.series[key] = cursor.lastrowid
+        return self.series[key]
+
+    # Run
+    def run(self):
+        """Write queued samples every flush interval until closed."""
+        while not self.stopped.wait(self.flush):
+            try:
+                self.write()
+                if time.time() - self.pruned >= 3600:
+                    self.prune()
+            except sqlite3.Error as e:
+                logger.error("History write failed: {}".format(e))
+
+    # Write
+    def write(self):
+        """Write queued samples and merge them into the rollups."""
+        with self.lock:
+            samples, self.queue = self.queue, []
+        if not samples:
+            return
+
+        rows = []
+        rollups = {name: {} for name, seconds in RESOLUTIONS.items() if seconds}
+        with self.connection:
+            for device, field, timestamp, value in samples:
+                series = self.seriesId(device, field)
+                rows.append((series, timestamp, value))
+                for name, buckets in rollups.items():
+                    seconds = RESOLUTIONS[name]
+                    key = (series, int(timestamp // seconds * seconds))
+                    bucket = buckets.get(key)
+                    if bucket is None:
+                        buckets[key] = [value, value, value, 1]
+                    else:
+                        bucket[0] = min(bucket[0], value)
+                        bucket[1] = max(bucket[1], value)
+                        bucket[2] += value
+                        bucket[3] += 1
+
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO raw (series, ts, value) VALUES (?, ?, ?)", rows)
+            for name, buckets in rollups.items():
+                self.connection.executemany(
+                    ROLLUP.format(name),
+                    [key + tuple(bucket) for key, bucket in buckets.items()])
+        logger.debug("History wrote {} samples.".format(len(rows)))
+
+    # Prune
+    def prune(self):
+        """Delete rows older than the retention of their table."""
+        self.pruned = now = time.time()
+        with self.connection:
+            for name, seconds in self.retention.items():
+                if not seconds:
+                    continue
+                # Per series, so each delete walks the primary key
+                self.connection.executemany(
+                    "DELETE FROM {} WHERE series = ? AND ts < ?".format(name),
+                    [(series, now - seconds) for series in self.series.values()])
+
+    # Close
+    def close(self):
+        """Write what is queued and close the database."""
+        self.stopped.set()
+        self.thread.join()
+        self.write()
+        self.connection.close()
+
+
+# Fields
+def fields(connection):
+    """Return the recorded (device, field) pairs."""
+    return [list(row) for row in connection.execute(
+        "SELECT device, field FROM series ORDER BY device, field")]
+
+
+# Query
+def query(connection, device, field, start, end=None, step=0, resolution="auto"):
+    """Return [ts, min, max, mean, count] rows of a series between start and end.
+
+    The resolution is picked from the span unless given, and rows are
+    merged into buckets of `step` seconds if set.
+    """
+    end = time.time() if end is None else end
+    if resolution == "auto":
+        for name, span in AUTO_SPANS.items():
+            if span is None or end - start <= span:
+                resolution = name
+                break
+    if resolution not in RESOLUTIONS:
+        raise ValueError("Unknown resolution {}".format(resolution))
+    if RESOLUTIONS[resolution]:
+        # Take in the bucket start falls in
+        start = start // RESOLUTIONS[resolution] * RESOLUTIONS[resolution]
+
+    row = connection.execute(
+        "SELECT id FROM series WHERE device = ? AND field = ?",
+        (device, field)).fetchone()
+    if row is None:
+        return []
+
+    if resolution == "raw":
+        columns = "ts, value, value, value, 1"
+        aggregates = "MIN(value), MAX(value), SUM(value), COUNT(*)"
+    else:
+        columns = "ts, min, max, sum, count"
+        aggregates = "MIN(min), MAX(max), SUM(sum), SUM(count)"
+    if step:
+        columns = "CAST(ts / :step AS INTEGER) * :step, " + aggregates
+    sql = ("SELECT {} FROM {} WHERE series = :series AND ts >= :start AND ts < :end "
+           "{} ORDER BY 1").format(columns, resolution, "GROUP BY 1" if step else "")
+    rows = connection.execute(sql, {
+        "step": step, "series": row[0], "start": start, "end": end})
+    return [[ts, low, high, total / count, count]
+            for ts, low, high, total, count in rows]
+
+
+# History request handler
+class HistoryHandler(BaseHTTPRequestHandler):
+    """Serve /history/fields and /history?device=&field=&start=&end=&step=&resolution=."""
+
+    def do_GET(self):
+        """Answer a query."""
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        connection = connect(self.server.path)
+        try:
+            if url.path == "/history/fields":
+                result = fields(connection)
+            elif url.path == "/history":
+                now = time.time()
+                result = query(
+                    connection,
+                    params["device"],
+                    params["field"],
+                    parse_time(params.get("start", "-1h"), now),
+                    parse_time(params.get("end", "now"), now),
+                    float(params.get("step", 0)),
+                    params.get("resolution", "auto"))
+            else:
+                self.send_error(404)
+                return
+        except (KeyError, ValueError) as e:
+            self.send_error(400, "Bad query: {}".format(e))
+            return
+        finally:
+            connection.close()
+
+        body = json.dumps(result, separators=(',', ':')).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests at debug level only."""
+        logger.debug("History {} {}".format(self.address_string(), format % args))
+
+
+# Serve history
+def serve(path, port, address=""):
+    """Serve history queries over HTTP from a background thread."""
+    server = ThreadingHTTPServer((address, port), HistoryHandler)
+    server.daemon_threads = True
+    server.path = path
+    threading.Thread(
+        target=server.serve_forever, name="history-http", daemon=True).start()
+    logger.info("Serving history on {}:{}.".format(address or "*", port))
+    return server
+
+
+# Get Arguments
+def get_arguments():
+    """Get parser arguments."""
+    parser = configargparse.ArgParser(description="Query the PowerPi history")
+    parser.add(
+      "database",
+      help="History database written by powerpi --history")
+    parser.add(
+      "--device",
+      help="Device to query, lists the recorded fields when left out")
+    parser.add(
+      "--field",
+      help="Field to query")
+    parser.add(
+      "--start",
+      help="Start as =-90m, =-2h, =-7d, epoch seconds or an ISO time (default: %(default)s)",
+      default="-1h")
+    parser.add(
+      "--end",
+      help="End, like --start (default: %(default)s)",
+      default="now")
+    parser.add(
+      "--step",
+      help="Merge rows into buckets of this many seconds, 0 leaves them as stored (default: %(default)s)",
+      default=0,
+      type=float)
+    parser.add(
+      "--resolution",
+      help="Table to read, auto picks one by the span (default: %(default)s)",
+      choices=("auto",) + tuple(RESOLUTIONS),
+      default="auto")
+
+    args = parser.parse_args()
+    if args.device and not args.field:
+        parser.error("argument --field: required with --device")
+    return args
+
+
+# Main
+def main(args):
+    """Print fields or query results as JSON."""
+    connection = connect(args.database)
+    try:
+        if not args.device:
+            result = fields(connection)
+        else:
+            now = time.time()
+            result = query(
+                connection, args.device, args.field,
+                parse_time(args.start, now), parse_time(args.end, now),
+                args.step, args.resolution)
+    finally:
+        connection.close()
+    json.dump(result, sys.stdout)
+    print()
+
+
+if __name__ == '__main__':
+    main(get_arguments())
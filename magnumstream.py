@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "MagnumStream"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import io
+import select
+import threading
+import time
+from collections import OrderedDict
+
+import serial
+
+# Magnum Energy
+from magnum import magnum
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Device attribute and class by packet type
+DEVICE_TYPES = OrderedDict()
+for packetType in (magnum.INV, magnum.INV_C):
+    DEVICE_TYPES[packetType] = ("inverter", magnum.InverterDevice)
+for packetType in (
+        magnum.REMOTE_C, magnum.REMOTE_00, magnum.REMOTE_11, magnum.REMOTE_80,
+        magnum.REMOTE_A0, magnum.REMOTE_A1, magnum.REMOTE_A2, magnum.REMOTE_A3,
+        magnum.REMOTE_A4, magnum.REMOTE_C0, magnum.REMOTE_C1, magnum.REMOTE_C2,
+        magnum.REMOTE_C3, magnum.REMOTE_D0):
+    DEVICE_TYPES[packetType] = ("remote", magnum.RemoteDevice)
+DEVICE_TYPES[magnum.BMK_81] = ("bmk", magnum.BMKDevice)
+for packetType in (magnum.AGS_A1, magnum.AGS_A2):
+    DEVICE_TYPES[packetType] = ("ags", magnum.AGSDevice)
+DEVICE_TYPES[magnum.RTR_91] = ("rtr", magnum.RTRDevice)
+for packetType in (magnum.PT_C1, magnum.PT_C2, magnum.PT_C3):
+    DEVICE_TYPES[packetType] = ("pt100", magnum.PT100Device)
+DEVICE_TYPES[magnum.ACLD_D1] = ("acld", magnum.ACLDDevice)
+# Device attributes in the order pymagnum reports them
+DEVICE_ORDER = ("inverter", "remote", "bmk", "ags", "rtr", "pt100", "acld")
+
+
+class MagnumReader(magnum.Magnum):
+    """Magnum reader scanning a batch of packets on every read."""
+
+    def __init__(self, observer=None, recorder=None, **kwargs):
+        """Constructor."""
+        super().__init__(**kwargs)
+        # Called with (event, value) for "scan" and "decode" seconds
+        self.observer = observer
+        # Called with every raw packet scanned
+        self.recorder = recorder
+        self.scanned = 0.0
+
+    def readPackets(self):
+        """Scan packets off the network."""
+        start = time.perf_counter()
+        packets = super().readPackets()
+        self.scanned = time.perf_counter() - start
+        if self.observer is not None:
+            self.observer("scan", self.scanned)
+        if self.recorder is not None:
+            for packet in packets:
+                self.recorder(packet)
+        return packets
+
+    def getDevices(self):
+        """Return associated devices."""
+        start = time.perf_counter()
+        devices = super().getDevices()
+        if self.observer is not None:
+            self.observer("decode", time.perf_counter() - start - self.scanned)
+        return devices
+
+
+class StreamingMagnum(magnum.Magnum):
+    """Magnum reader parsing the RS485 network continuously in the background.
+
+    Bytes are read straight into a fixed buffer and every packet is parsed
+    from a view of it as soon as the line goes quiet, updating the device it
+    belongs to. getDevices() returns right away with the latest state of
+    each device and how many seconds old it is, flagged stale once older
+    than `stale` seconds.
+    """
+
+    def __init__(self, device="/dev/ttyUSB0", timeout=0.005, cleanpackets=True,
+                 trace=False, flip=False, buffersize=4096, stale=10, retry=5, observer=None,
+                 recorder=None):
+        """Constructor."""
+        super().__init__(
+            device=device, timeout=timeout, cleanpackets=cleanpackets,
+            trace=trace, flip=flip)
+        self.buffer = bytearray(buffersize)
+        self.view = memoryview(self.buffer)
+        self.stale = stale
+        self.retry = retry
+        # Called with (event, value) for "decode" seconds and "unknown" packets
+        self.observer = observer
+        # Called with every raw packet as it is split off the stream
+        self.recorder = recorder
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.port = None
+        self.raw = None
+        # Unknown packet kept to try joining with the next one
+        self.held = None
+        # Monotonic time each device was last updated
+        self.updated = {}
+        self.thread = threading.Thread(
+            target=self.run, name="magnum", daemon=True)
+        self.thread.start()
+
+    # Observe
+    def observe(self, event, value):
+        """Hand a timing or count to the observer, if any."""
+        if self.observer is not None:
+            self.observer(event, value)
+
+    # Open port
+    def open(self):
+        """Open the serial port, reading its file directly where possible."""
+        self.port = serial.serial_for_url(
+            self.comm_device,
+            baudrate=19200,
+            bytesize=8,
+            timeout=self.timeout,
+            stopbits=serial.STOPBITS_ONE,
+            dsrdtr=False,
+            parity=serial.PARITY_NONE)
+        try:
+            self.raw = io.FileIO(self.port.fileno(), "rb", closefd=False)
+        except (AttributeError, OSError, ValueError):
+            # URL handlers without a file descriptor
+            self.raw = None
+        self.port.reset_input_buffer()
+        logger.info("Streaming Magnum packets from {}".format(self.comm_device))
+
+    # Close port
+    def closePort(self):
+        """Close the serial port."""
+        if self.port is not None:
+            self.port.close()
+        self.port = None
+        self.raw = None
+
+    # Read into buffer
+    def readInto(self, view):
+        """Read what the line has into view, returning 0 after a quiet gap."""
+        if self.raw is not None:
+            ready, _, _ = select.select([self.raw], [], [], self.timeout)
+            if not ready:
+                return 0
+            return self.raw.readinto(view) or 0
+        data = self.port.read(min(len(view), self.port.in_waiting or 1))
+        view[:len(data)] = data
+        return len(data)
+
+    # Run
+    def run(self):
+        """Read packets until closed, reopening the port after errors."""
+        while not self.stopped.is_set():
+            try:
+                self.open()
+                self.stream()
+            except (serial.SerialException, OSError) as e:
+                logger.error("Magnum port {} failed: {}".format(
+                    self.comm_device, e))
+            finally:
+                self.closePort()
+            self.stopped.wait(self.retry)
+
+    # Stream
+    def stream(self):
+        """Split the byte stream into packets at each quiet gap."""
+        size = len(self.buffer)
+        start = end = 0
+        while not self.stopped.is_set():
+            if end == size:
+                if start:
+                    # Move the packet in progress to the front
+                    self.buffer[:end - start] = self.buffer[start:end]
+                    start, end = 0, end - start
+                else:
+                    logger.warning("Magnum packet overran the {} byte buffer.".format(size))
+                    start = end = 0
+
+            count = self.readInto(self.view[end:])
+            if count:
+                end += count
+            elif end > start:
+                self.handle(self.view[start:end])
+                start = end
+            else:
+                # Idle line, start filling from the front again
+                start = end = 0
+
+    # Handle packet
+    def handle(self, packet):
+        """Parse a packet and update the device it belongs to."""
+        began = time.perf_counter()
+        if self.recorder is not None:
+            self.recorder(packet)
+        message = self._parsePacket(packet)
+        if message[0] == magnum.UNKNOWN and self.cleanpackets:
+            if self.held is None:
+                # Possibly half a packet split by a gap, keep a copy
+                self.held = bytes(packet)
+                return
+            message = self._parsePacket(self.held + bytes(packet))
+        self.held = None
+
+        if message[0] not in DEVICE_TYPES:
+            self.observe("unknown", 1)
+            return
+        attribute, deviceClass = DEVICE_TYPES[message[0]]
+        with self.lock:
+            device = getattr(self, attribute)
+            if device is None:
+                device = deviceClass(trace=self.trace)
+                setattr(self, attribute, device)
+            device.parse(message)
+            self.updated[attribute] = time.monotonic()
+        self.observe("decode", time.perf_counter() - began)
+
+    # Get devices
+    def getDevices(self):
+        """Return the latest state of every device seen, with its age."""
+        devices = []
+        with self.lock:
+            now = time.monotonic()
+            if self.remote:
+                # Remove extraneous remote fields of devices not present
+                self.remote.cleanup(self.bmk, self.ags, self.pt100)
+            for attribute in DEVICE_ORDER:
+                device = getattr(self, attribute)
+                if device:
+                    deviceinfo = device.getDevice()
+                    if deviceinfo:
+                        age = now - self.updated[attribute]
+                        deviceinfo["age"] = round(age, 3)
+                        if age > self.stale:
+                            deviceinfo["status"] = "stale"
+                        devices.append(deviceinfo)
+        return devices
+
+    # Close
+    def close(self):
+        """Stop reading and close the port."""
+        self.stopped.set()
+        self.thread.join(self.timeout + 1)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Metrics"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import bisect
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Latency buckets in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0)
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# Format sample value
+def format_value(value):
+    """Return a sample value in exposition format."""
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if math.isnan(value):
+            return "NaN"
+        return repr(value)
+    return str(value)
+
+
+# Format labels
+def format_labels(names, values):
+    """Return a {name="value",...} label set, empty without labels."""
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace(
+            "\"", "\\\"").replace("\n", "\\n")
+        pairs.append('{}="{}"'.format(name, value))
+    return "{" + ",".join(pairs) + "}"
+
+
+# Metric
+class Metric:
+    """Base of a metric family, one series per set of label values."""
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        """Constructor."""
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.series = OrderedDict()
+
+    # Label key
+    def key(self, labels):
+        """Return the series key for label values."""
+        if len(labels) != len(self.labels):
+            raise ValueError("{} takes labels {}".format(self.name, self.labels))
+        return tuple(labels)
+
+    # Render
+    def render(self):
+        """Return the family in exposition format."""
+        lines = [
+            "# HELP {} {}".format(self.name, self.help),
+            "# TYPE {} {}".format(self.name, self.kind),
+        ]
+        with self.lock:
+            for labels, value in self.series.items():
+                lines.extend(self.samples(labels, value))
+        return lines
+
+    # Samples
+    def samples(self, labels, value):
+        """Return the sample lines of one series."""
+        return ["{}{} {}".format(
+            self.name, format_labels(self.labels, labels), format_value(value))]
+
+
+# Counter
+class Counter(Metric):
+    """Monotonic count."""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        """Add to the count of a series."""
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+# Gauge
+class Gauge(Metric):
+    """Value that goes up and down."""
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        """Set the value of a series."""
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = value
+
+
+# Histogram
+class Histogram(Metric):
+    """Distribution of observations over fixed buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        """Constructor."""
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        """Record one observation in a series."""
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # Per bucket counts, the last one past the top bucket
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the seconds spent in a with block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self, labels, value):
+        """Return cumulative bucket, sum and count lines of one series."""
+        counts, total, count = value
+        names = self.labels + ("le",)
+        lines = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket
+            lines.append("{}_bucket{} {}".format(
+                self.name, format_labels(names, labels + (format_value(float(bound)),)),
+                cumulative))
+        suffix = format_labels(self.labels, labels)
+        lines.append("{}_sum{} {}".format(self.name, suffix, format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, suffix, count))
+        return lines
+
+
+# Registry
+class Registry:
+    """Set of metric families rendered together."""
+
+    def __init__(self):
+        """Constructor."""
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        """Add a metric family and return it."""
+        if metric.name in self.metrics:
+            raise ValueError("Metric {} already registered".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        """Register a counter."""
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        """Register a gauge."""
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        """Register a histogram."""
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """Return every family in exposition format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Metrics request handler
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serve the registry at /metrics."""
+
+    def do_GET(self):
+        """Answer a scrape."""
+        if self.path.split("?", 1)[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Log requests at debug level only."""
+        logger.debug("Metrics {} {}".format(self.address_string(), format % args))
+
+
+# Serve metrics
+def serve(registry, port, address=""):
+    """Serve the registry over HTTP from a background thread."""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(
+        target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on {}:{}.".format(address or "*", port))
+    return server
@@ -5,13 +5,20 @@ __author__ = "David Durost <david.durost@gmail.com>"
 __version__ = "0.2.1"
 __license__ = "Apache2"
 
+import time
+# When loading began, for the startup profile
+loaded = time.monotonic()
+
 import sys
+import os
 from datetime import datetime
 import uuid
-from collections import OrderedDict
+import importlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
 import paho.mqtt.client as mqtt
 from tzlocal import get_localzone
-import time
 import json
 
 import configargparse
@@ -20,13 +27,53 @@ parser = configargparse.ArgParser(default_config_files=['powerpi.conf'])
 import logging
 logger = logging.getLogger(__appname__)
 
-# Magnum Energy
-from magnum import magnum
 
-# Midnite Classic
-from Midnite import Midnite
-from pymodbus.exceptions import ConnectionException
-from pymodbus.exceptions import ParameterException
+# Lazy module
+class LazyModule:
+    """Module imported the first time one of its attributes is used.
+
+    Keeps reader backends and features that are switched off out of startup.
+    """
+
+    def __init__(self, name):
+        """Constructor."""
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        """Return an attribute of the module, importing it first if need be."""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+
+# Store-and-forward
+from spool import Spool
+# Sample aggregation
+from aggregate import Aggregator
+# Metrics endpoint
+import metrics
+# Cycle scheduling
+from scheduler import Scheduler, POLICIES
+# Local history
+history = LazyModule("history")
+# Payload codecs
+import codec
+# Alert rules
+rules = LazyModule("rules")
+# Raw traffic capture
+capture = LazyModule("capture")
+# Reader worker processes
+gateway = LazyModule("gateway")
+# Derived fields
+import derived
+
+# Magnum Energy, loaded when the Magnum is read
+magnumstream = LazyModule("magnumstream")
+
+# Midnite Classic, loaded when a Classic is read or its registers are needed
+Midnite = LazyModule("Midnite.Midnite")
+modbus_exceptions = LazyModule("pymodbus.exceptions")
 
 # UUID
 uuidstr = str(uuid.uuid1())
@@ -37,16 +84,132 @@ args = {}
 # Readers
 magnumReader = None
 midniteReader = None
+midniteReaders = []
+readers = OrderedDict()
+# Reader worker processes by the connection their readers share
+workers = OrderedDict()
+# Reader thread pool, outstanding reads and last devices read per reader
+executor = None
+pending = {}
+lastdevices = {}
+# Last published status per device
+savedstatus = {}
+# Fast sample aggregation
+aggregator = None
+# Cycle scheduler and the readers polled by each schedule
+scheduler = None
+sources = OrderedDict()
+# Local history store
+store = None
+# Alert rule engine
+alerts = None
+# Raw traffic capture
+capturer = None
+# Derived field stage
+deriver = None
+# Seconds of each startup phase, until the first publish
+startup = OrderedDict()
+# When the last startup phase ended, and the broker was first connected
+startup_last = loaded
+startup_connected = None
+# Time of the last full keyframe per device in delta mode
+keyframes = {}
+# Devices with Home Assistant discovery configs published
+discovered = set()
+# Home Assistant device classes by unit of measurement
+DEVICE_CLASSES = {
+    "V": "voltage",
+    "A": "current",
+    "W": "power",
+    "kWh": "energy",
+    "°C": "temperature",
+}
+# Device classes of fields whose unit says too little, "%" is not always a battery
+FIELD_DEVICE_CLASSES = {
+    "soc": "battery",
+}
+# Fields that change without the device state changing, per device
+VOLATILE_FIELDS = {
+    # magnum.REMOTE, without loading the Magnum backend
+    "REMOTE": ("remotetimehours", "remotetimemins"),
+}
+# MQTT Client
+client = None
+# Device payload codec
+encoder = codec.Codec()
+# Outgoing payloads held while the broker is unreachable
+outbox = deque()
+outbox_lock = threading.Lock()
+# On-disk store-and-forward queue, replaces the outbox when enabled
+spool = None
+# Publish times of messages waiting on on_publish (mid: (time, qos))
+inflight = OrderedDict()
+# Most in flight publish times kept, older ones are forgotten
+INFLIGHT_LIMIT = 1000
+
+# Metrics
+registry = metrics.Registry()
+cycle_seconds = registry.histogram(
+    "powerpi_cycle_seconds", "Time to read and publish every device")
+poll_seconds = registry.histogram(
+    "powerpi_poll_seconds", "Time a reader takes to return its devices", ("reader",))
+read_seconds = registry.histogram(
+    "powerpi_modbus_read_seconds", "Classic register read time by first register",
+    ("reader", "block"))
+decode_seconds = registry.histogram(
+    "powerpi_decode_seconds", "Time to decode device data", ("reader",))
+scan_seconds = registry.histogram(
+    "powerpi_magnum_scan_seconds", "Time to scan Magnum packets off the network")
+encode_seconds = registry.histogram(
+    "powerpi_encode_seconds", "Payload serialization time")
+publish_seconds = registry.histogram(
+    "powerpi_publish_seconds",
+    "Time from publish until sent (QoS 0) or acknowledged by the broker", ("qos",))
+retries_total = registry.counter(
+    "powerpi_modbus_retries_total", "Classic register reads retried", ("reader",))
+duplicates_total = registry.counter(
+    "powerpi_duplicates_suppressed_total", "Payloads not published as unchanged",
+    ("device",))
+dropped_cycles_total = registry.counter(
+    "powerpi_dropped_cycles_total",
+    "Reader cycles that failed or missed the deadline, published stale", ("reader",))
+schedule_late_seconds = registry.histogram(
+    "powerpi_schedule_late_seconds", "Time a scheduled run started after it was due",
+    ("schedule",))
+schedule_overruns_total = registry.counter(
+    "powerpi_schedule_overruns_total", "Runs that finished after the next was due",
+    ("schedule",))
+schedule_skipped_total = registry.counter(
+    "powerpi_schedule_skipped_total", "Scheduled runs skipped after overruns",
+    ("schedule",))
+unknown_packets_total = registry.counter(
+    "powerpi_magnum_unknown_packets_total", "Magnum packets that could not be parsed")
+dropped_payloads_total = registry.counter(
+    "powerpi_dropped_payloads_total", "Payloads dropped from the full outbox")
+alerts_total = registry.counter(
+    "powerpi_alerts_total", "Alerts published by rule and state", ("rule", "state"))
+worker_restarts_total = registry.counter(
+    "powerpi_worker_restarts_total", "Reader worker processes restarted", ("reader",))
+device_online = registry.gauge(
+    "powerpi_device_online", "1 if the device was read this cycle, 0 if stale or offline",
+    ("device",))
+device_value = registry.gauge(
+    "powerpi_device_value", "Latest numeric device field values", ("device", "field"))
 
 
 # OnConnect Callback
 def on_connect(client, userdata, flags, rc):
     """On_connect callback."""
+    global startup_connected
     if rc == 0:
         client.connected_flag = True
         client.disconnected_flag = False
         client.bad_connection_flag = False
         logger.info("Connected to MQTT broker. [RC: {}]".format(rc))
+        if startup_connected is None:
+            startup_connected = time.monotonic() - loaded
+        # Send anything queued up while offline
+        flush_outbox(client)
     else:
         client.bad_connection_flag = True
         client.connected_flag = False
@@ -63,23 +226,87 @@ def on_log(client, obj, mid):
 def on_disconnect(client, userdata, rc):
     """On_disconnect callback."""
     log_data = "Disconnected from MQTT broker."
-    if rc != client.MQTT_ERR_SUCCESS:
-        logger.debug("{} [RC: {}]".format(log_data, rc))
+    if rc != mqtt.MQTT_ERR_SUCCESS:
+        # Unexpected, the network loop will reconnect with backoff
+        logger.warning("{} Reconnecting. [RC: {}]".format(log_data, rc))
         client.bad_connection_flag = True
+    else:
+        logger.info(log_data)
 
-    logger.info(log_data)
     client.connected_flag = False
     client.disconnected_flag = True
 
 # OnPublish Callback
 def on_publish(client, obj, mid):
     """On_publish callback."""
-    logger.info("Mid: {}".format(str(mid)))
+    sent = inflight.pop(mid, None)
+    if sent is not None:
+        publish_seconds.observe(time.monotonic() - sent[0], sent[1])
+    logger.debug("Mid: {}".format(str(mid)))
+
+
+# Track publish
+def track_publish(info, qos):
+    """Time a message until on_publish fires for it."""
+    inflight[info.mid] = (time.monotonic(), qos)
+    if len(inflight) > INFLIGHT_LIMIT:
+        inflight.popitem(last=False)
+    # on_publish may have fired before the message was tracked
+    if info.is_published():
+        inflight.pop(info.mid, None)
+
+
+# Process age
+def process_age():
+    """Return seconds since the process started, None without /proc."""
+    try:
+        with open("/proc/self/stat") as stat:
+            ticks = int(stat.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime:
+            return float(uptime.read().split()[0]) - ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# Mark startup
+def mark_startup(phase):
+    """Record how long a startup phase took since the last one ended."""
+    global startup_last
+    if startup is None:
+        return
+    now = time.monotonic()
+    startup[phase] = now - startup_last
+    startup_last = now
+
+
+# Report startup
+def report_startup(args):
+    """Log how long each startup phase took, then stop timing them."""
+    global startup
+    if startup is None:
+        return
+    phases, startup = startup, None
+    # Interpreter start up to the first line of this module
+    age = process_age()
+    if age is not None:
+        interpreter = age - (time.monotonic() - loaded)
+        phases = OrderedDict(
+            [("interpreter", max(interpreter, 0.0))] + list(phases.items()))
+
+    level = logging.INFO if args.startupprofile else logging.DEBUG
+    logger.log(level, "First publish {:.3f}s after launch.".format(sum(phases.values())))
+    for phase, seconds in phases.items():
+        logger.log(level, "  {:<14}{:.3f}s".format(phase, seconds))
+    if startup_connected is not None:
+        logger.log(level, "  broker connected {:.3f}s after loading.".format(startup_connected))
 
 
 # Set up Logger
 def setup_logger(args):
-    """Setup the logger."""
+    """Setup the logger, once."""
+    if logger.handlers:
+        return
+
     # Set default loglevel
     logger.setLevel(logging.DEBUG)
 
@@ -108,8 +335,8 @@ def setup_logger(args):
 
 
 # Get Arguments
-def get_arguments():
-    """Get parser arguments."""
+def get_arguments(argv=None):
+    """Get parser arguments, from the command line unless argv is given."""
     # Config File
     parser.add(
       '-cfg',
@@ -124,6 +351,13 @@ def get_arguments():
       default=False,
       action='store_true',
       dest="verbose")
+    # Startup Profile
+    parser.add(
+      "--startupprofile",
+      "--startup-profile",
+      help="Report how long each startup phase took, up to the first publish",
+      action="store_true",
+      dest="startupprofile")
     # Timeout
     parser.add(
       "--timeout",
@@ -145,6 +379,33 @@ def get_arguments():
       default=60,
       type=int,
       dest='interval')
+    # Source Intervals
+    parser.add(
+      "--magnuminterval",
+      help="Seconds between Magnum reads, 0 for the interval (default: %(default)s)",
+      default=0,
+      type=int)
+    parser.add(
+      "--classicinterval",
+      help="Seconds between Classic reads, 0 for the interval (default: %(default)s)",
+      default=0,
+      type=int)
+    # Alignment
+    parser.add(
+      "--align",
+      help="Run on wall clock multiples of each interval, e.g. on the minute (default: %(default)s)",
+      action="store_true")
+    parser.add(
+      "--alignoffset",
+      help="Seconds after each aligned boundary to run at (default: %(default)s)",
+      default=0.0,
+      type=float)
+    # Overrun Policy
+    parser.add(
+      "--overrun",
+      help="When a run takes longer than its interval: skip the missed runs, catchup on each or coalesce them into one (default: %(default)s)",
+      choices=POLICIES,
+      default="skip")
     # Device
     parser.add(
       "-d",
@@ -171,6 +432,80 @@ def get_arguments():
       help="Classic unit id (default: %(default)s)",
       default=10,
       type=int)
+    # Classic Endpoints
+    parser.add(
+      "--classic",
+      help="Classic endpoint as [name=]host[:port][/unit], repeat for each Classic (default: --classichost/--classicport/--classicunit)",
+      action="append",
+      dest="classics",
+      default=[])
+    # Classic Backend
+    parser.add(
+      "--classicbackend",
+      help="Modbus backend for the Classic readers (default: %(default)s)",
+      choices=["sync", "async"],
+      default="sync")
+    # Classic Request Timeout
+    parser.add(
+      "--classictimeout",
+      help="Seconds to wait on each register read with the async backend (default: %(default)s)",
+      default=2.0,
+      type=float)
+    # Classic Slow Registers
+    parser.add(
+      "--classicslow",
+      help="Seconds between reads of slow changing Classic settings, identity registers are read once (default: %(default)s)",
+      default=300,
+      type=int)
+    # Classic Keepalive
+    parser.add(
+      "--classickeepalive",
+      help="Seconds a Classic connection may sit idle before it is probed, 0 disables probing (default: %(default)s)",
+      default=30,
+      type=int)
+    # Classic Retry Policy
+    parser.add(
+      "--classicretries",
+      help="Attempts at each Classic register read (default: %(default)s)",
+      default=30,
+      type=int)
+    parser.add(
+      "--classicretrywaitmin",
+      help="Minimum seconds between Classic read attempts (default: %(default)s)",
+      default=1.0,
+      type=float)
+    parser.add(
+      "--classicretrywaitmax",
+      help="Maximum seconds between Classic read attempts (default: %(default)s)",
+      default=2.0,
+      type=float)
+    parser.add(
+      "--classicretrydeadline",
+      help="Seconds a Classic poll may spend retrying, kept under the read deadline (default: %(default)s)",
+      default=10.0,
+      type=float)
+    # Classic Circuit Breaker
+    parser.add(
+      "--classicfailures",
+      help="Failed polls in a row before a Classic is reported offline (default: %(default)s)",
+      default=3,
+      type=int)
+    parser.add(
+      "--classicbackoff",
+      help="Seconds before an offline Classic is probed, doubling after each failed probe (default: %(default)s)",
+      default=10,
+      type=int)
+    parser.add(
+      "--classicmaxbackoff",
+      help="Maximum seconds between probes of an offline Classic (default: %(default)s)",
+      default=300,
+      type=int)
+    # Classic Read Gap
+    parser.add(
+      "--classicgap",
+      help="Unused registers allowed between blocks merged into one read, 0 only merges adjacent blocks (default: %(default)s)",
+      default=32,
+      type=int)
     # Broker
     parser.add("-b",
       "--broker",
@@ -207,10 +542,229 @@ def get_arguments():
       "--topic",
       default='powerpi/',
       help="Topic prefix (default: %(default)s)")
+    # Sample Rate
+    parser.add(
+      "--samplerate",
+      help="Seconds between device samples, aggregated over each interval, 0 publishes one snapshot per interval (default: %(default)s)",
+      default=0,
+      type=float)
+    # Integrated Fields
+    parser.add(
+      "--integrate",
+      help="Field to integrate over time when sampling, e.g. avg_power for Wh, repeat for each field (default: avg_power)",
+      action="append",
+      default=[])
+    # Read Deadline
+    parser.add(
+      "--readdeadline",
+      help="Seconds to wait for each reader before publishing its last data as stale, capped at the interval (default: %(default)s)",
+      default=10,
+      type=float)
+    # Delta Publishing
+    parser.add(
+      "--delta",
+      help="Only publish fields that changed since they were last published (default: %(default)s)",
+      action="store_true",
+      default=False)
+    # Delta Deadbands
+    parser.add(
+      "--deadband",
+      help="field=amount a numeric field must move before it is published in delta mode, repeat for each field",
+      action="append",
+      dest="deadbands",
+      default=[])
+    # Delta Keyframe
+    parser.add(
+      "--keyframe",
+      help="Seconds between full payloads in delta mode (default: %(default)s)",
+      default=600,
+      type=int)
+    # Field Topics
+    parser.add(
+      "--fieldtopics",
+      help="Publish each changed field to its own retained topic, root_topic/device/field (default: %(default)s)",
+      action="store_true",
+      default=False)
+    # Alert Rules
+    parser.add(
+      "--rule",
+      help="Alert rule 'name[@device]: condition [until clear]', e.g. 'battery_low: avg_battery_voltage < 46 until avg_battery_voltage > 47', repeat for each rule",
+      action="append",
+      dest="rules",
+      default=[])
+    parser.add(
+      "--alerttopic",
+      help="Topic under the root topic alerts are published to, per device and rule (default: %(default)s)",
+      default="alerts")
+    parser.add(
+      "--alertinterval",
+      help="Minimum seconds between alerts of a rule on a device (default: %(default)s)",
+      default=60,
+      type=float)
+    # Derived Fields
+    parser.add(
+      "--derived",
+      help="Field to derive and add to every device it applies to, e.g. pv_power, repeat for each field (one of: {})".format(
+        ", ".join(derived.DERIVATIONS)),
+      action="append",
+      default=[])
+    parser.add(
+      "--derivedmodule",
+      help="Python module to import registering more derived fields, repeat for each module",
+      action="append",
+      dest="derivedmodules",
+      default=[])
+    # Payload Codec
+    parser.add(
+      "--codec",
+      help="Device payload encoding, msgpack needs the msgpack package (default: %(default)s)",
+      choices=tuple(codec.CODECS),
+      default="json")
+    # Home Assistant Discovery
+    parser.add(
+      "--discovery",
+      help="Publish Home Assistant discovery configs for field topics (default: %(default)s)",
+      action="store_true",
+      default=False)
+    parser.add(
+      "--discoveryprefix",
+      help="Home Assistant discovery topic prefix (default: %(default)s)",
+      default="homeassistant")
+    # MQTT Reconnect Delay
+    parser.add(
+      "--reconnectmin",
+      help="Initial MQTT reconnect delay in seconds (default: %(default)s)",
+      default=1,
+      type=int)
+    parser.add(
+      "--reconnectmax",
+      help="Maximum MQTT reconnect delay in seconds (default: %(default)s)",
+      default=120,
+      type=int)
+    # MQTT Outbox
+    parser.add(
+      "--outbox",
+      help="Payloads to hold while the broker is offline (default: %(default)s)",
+      default=1000,
+      type=int)
+    # Store-and-forward Spool
+    parser.add(
+      "--spool",
+      help="Directory to store payloads in while the broker is offline, replayed once it is back (default: disabled)",
+      default="")
+    parser.add(
+      "--spoolsize",
+      help="Maximum bytes kept in the spool, the oldest payloads are dropped past it (default: %(default)s)",
+      default=16 * 1024 * 1024,
+      type=int)
+    parser.add(
+      "--spoolrate",
+      help="Spooled payloads replayed per second (default: %(default)s)",
+      default=20,
+      type=int)
+    # Metrics
+    parser.add(
+      "--metricsport",
+      help="Port to serve Prometheus metrics on at /metrics, 0 disables it (default: %(default)s)",
+      default=0,
+      type=int)
+    parser.add(
+      "--metricsaddress",
+      help="Address to serve metrics on (default: all interfaces)",
+      default="")
+    # Capture
+    parser.add(
+      "--capture",
+      help="File to append raw Classic register blocks and Magnum packets to (default: disabled)",
+      default="")
+    parser.add(
+      "--replay",
+      help="Capture to decode and publish instead of reading devices")
+    parser.add(
+      "--replayspeed",
+      help="Multiple of real time to replay at, 0 replays as fast as possible (default: %(default)s)",
+      default=0,
+      type=float)
+    parser.add(
+      "--replaystart",
+      help="Replay from this epoch or ISO time, or =-2h (default: the start)")
+    parser.add(
+      "--replayend",
+      help="Replay until this epoch or ISO time, or =-1h (default: the end)")
+    # History
+    parser.add(
+      "--history",
+      help="SQLite database to record every sample in (default: disabled)",
+      default="")
+    parser.add(
+      "--historyflush",
+      help="Seconds between batched history writes (default: %(default)s)",
+      default=10,
+      type=float)
+    parser.add(
+      "--historyraw",
+      help="Seconds raw history samples are kept, 0 keeps them (default: %(default)s)",
+      default=86400,
+      type=int)
+    parser.add(
+      "--historyminute",
+      help="Seconds minute history rollups are kept, 0 keeps them (default: %(default)s)",
+      default=30 * 86400,
+      type=int)
+    parser.add(
+      "--historyhour",
+      help="Seconds hour history rollups are kept, 0 keeps them (default: %(default)s)",
+      default=0,
+      type=int)
+    parser.add(
+      "--historyport",
+      help="Port to serve history queries on, 0 disables it (default: %(default)s)",
+      default=0,
+      type=int)
+    parser.add(
+      "--historyaddress",
+      help="Address to serve history queries on (default: all interfaces)",
+      default="")
+    # Reader Workers
+    parser.add(
+      "--workers",
+      help="Run readers in worker processes, one per Classic host and port, restarting them if they die or hang",
+      action="store_true")
+    parser.add(
+      "--workertimeout",
+      help="Seconds a worker has to answer a poll before it is restarted (default: %(default)s)",
+      default=60,
+      type=float)
+    parser.add(
+      "--workerbackoff",
+      help="Seconds to wait before restarting a worker again, doubled while it keeps failing (default: %(default)s)",
+      default=1,
+      type=float)
+    parser.add(
+      "--workermaxbackoff",
+      help="Longest wait before restarting a failing worker (default: %(default)s)",
+      default=300,
+      type=float)
+    # Magnum Reader
+    parser.add(
+      "--magnumreader",
+      help="Magnum reader, stream parses the network continuously, batch reads --packets packets each poll (default: %(default)s)",
+      choices=("stream", "batch"),
+      default="stream")
+    parser.add(
+      "--magnumstale",
+      help="Seconds without packets before a streamed Magnum device is published stale (default: %(default)s)",
+      default=10,
+      type=float)
+    parser.add(
+      "--magnumbuffer",
+      help="Bytes of the streaming Magnum read buffer (default: %(default)s)",
+      default=4096,
+      type=int)
     # Packets
     parser.add(
       "--packets",
-      help="Number of packets to generate in reader (default: %(default)s)",
+      help="Number of packets to generate in reader, batch Magnum reader only (default: %(default)s)",
       default=50,
       type=int)
     # Trace
@@ -239,10 +793,78 @@ def get_arguments():
       default=False)
 
     # Parse Args
-    args = parser.parse_args()
-    if args.interval < 10 or args.interval > (60*60):
+    args = parser.parse_args(argv)
+    if args.interval < 1 or args.interval > (60*60):
+        parser.error(
+          "argument -i/--interval: must be between 1 second and 3600 (1 hour)")
+    for interval in (args.magnuminterval, args.classicinterval):
+        if interval and (interval < 1 or interval > (60*60)):
+            parser.error(
+              "arguments --magnuminterval/--classicinterval: must be 0 or between 1 second and 3600 (1 hour)")
+    if args.alignoffset < 0:
+        parser.error("argument --alignoffset: must not be negative")
+    if args.samplerate < 0 or args.samplerate >= args.interval:
         parser.error(
-          "argument -i/--interval: must be between 10 seconds and 3600 (1 hour)")
+          "argument --samplerate: must be 0 or less than the interval")
+    if not args.integrate:
+        args.integrate = ["avg_power"]
+    if args.readdeadline <= 0:
+        parser.error("argument --readdeadline: must be greater than 0")
+    args.readdeadline = min(args.readdeadline, args.interval)
+    # Retrying must give up before the reader is marked stale
+    args.classicretrydeadline = min(
+        args.classicretrydeadline, args.readdeadline * 0.9)
+    if args.classicretries < 1 or args.classicfailures < 1:
+        parser.error(
+          "arguments --classicretries/--classicfailures: must be at least 1")
+    if args.classicretrywaitmax < args.classicretrywaitmin:
+        parser.error(
+          "argument --classicretrywaitmax: must not be less than --classicretrywaitmin")
+    if args.spoolrate < 1:
+        parser.error("argument --spoolrate: must be at least 1")
+    if args.reconnectmin < 1 or args.reconnectmax < args.reconnectmin:
+        parser.error(
+          "argument --reconnectmax: must not be less than --reconnectmin")
+
+    # Optional codec packages
+    if args.codec == "msgpack" and codec.msgpack is None:
+        parser.error("argument --codec: msgpack is not installed")
+
+    # Delta deadbands
+    deadbands = {}
+    for deadband in args.deadbands:
+        try:
+            field, amount = deadband.split("=", 1)
+            deadbands[field.strip()] = abs(float(amount))
+        except ValueError:
+            parser.error(
+              "argument --deadband: expected field=amount, got '{}'".format(deadband))
+    args.deadbands = deadbands
+
+    # Alert rules
+    parsed = []
+    for spec in args.rules:
+        try:
+            parsed.append(rules.Rule.parse(spec))
+        except ValueError as e:
+            parser.error("argument --rule: {}".format(e))
+    args.rules = parsed
+
+    # Derived fields
+    try:
+        derived.load_plugins(args.derivedmodules)
+    except ImportError as e:
+        parser.error("argument --derivedmodule: {}".format(e))
+    unknown = [name for name in args.derived if name not in derived.DERIVATIONS]
+    if unknown:
+        parser.error("argument --derived: unknown {}, choose from {}".format(
+            ", ".join(unknown), ", ".join(derived.DERIVATIONS)))
+
+    # Classic endpoints
+    try:
+        args.classics = parse_classics(args)
+    except ValueError as e:
+        parser.error("argument --classic: {}".format(e))
 
     # Ensure proper topic formatting
     if args.topic[-1] != "/":
@@ -255,6 +877,242 @@ def get_arguments():
     return args
 
 
+# Parse Classic endpoints
+def parse_classics(args):
+    """Return (name, host, port, unit) for each configured Classic."""
+    if not args.classics:
+        return [("Classic", args.classichost, args.classicport, args.classicunit)]
+
+    classics = []
+    for index, spec in enumerate(args.classics, 1):
+        name = "Classic{}".format(index) if len(args.classics) > 1 else "Classic"
+        host = spec.strip()
+        port = args.classicport
+        unit = args.classicunit
+        if "=" in host:
+            name, host = host.split("=", 1)
+        if "/" in host:
+            host, unit = host.rsplit("/", 1)
+        if ":" in host:
+            host, port = host.rsplit(":", 1)
+        try:
+            port = int(port)
+            unit = int(unit)
+        except ValueError:
+            raise ValueError("bad port or unit in '{}'".format(spec))
+        if not name or not host:
+            raise ValueError("bad endpoint '{}'".format(spec))
+        classics.append((name, host, port, unit))
+
+    names = [classic[0].lower() for classic in classics]
+    if len(set(names)) != len(names):
+        raise ValueError("Classic names must be unique")
+    return classics
+
+
+# Setup metrics
+def setup_metrics(args):
+    """Serve the metrics endpoint if a port is configured."""
+    if args.metricsport:
+        metrics.serve(registry, args.metricsport, args.metricsaddress)
+
+
+# Setup history
+def setup_history(args):
+    """Open the local history store if a database is configured."""
+    global store
+    if not args.history:
+        return
+    store = history.History(
+        args.history,
+        flush=args.historyflush,
+        retention={
+            "raw": args.historyraw,
+            "minute": args.historyminute,
+            "hour": args.historyhour,
+        })
+    if args.historyport:
+        history.serve(args.history, args.historyport, args.historyaddress)
+
+
+# Teardown history
+def teardown_history():
+    """Write what is queued and close the history store."""
+    if store is not None:
+        store.close()
+
+
+# Record history
+def record_history(devices, timestamp):
+    """Record freshly read devices in the history store."""
+    if store is not None:
+        store.record(
+            [device for device in devices if "status" not in device], timestamp)
+
+
+# Setup codec
+def setup_codec(args):
+    """Select the device payload codec."""
+    global encoder
+    registers = {}
+    if args.codec == "packed" and not args.ignoreclassic:
+        # Classic fields pack as the registers they were read from
+        fields = OrderedDict(
+            (field.name, (Midnite.FIELD_TYPES[field.type][0], field.scale, field.offset))
+            for block in Midnite.REGISTER_MAP.values()
+            for field in block.fields)
+        registers = {classic[0]: fields for classic in args.classics}
+    encoder = codec.get_codec(args.codec, registers)
+
+
+# Setup rules
+def setup_rules(args):
+    """Compile the alert rules into an engine, if any are configured."""
+    global alerts
+    if args.rules:
+        alerts = rules.RuleEngine(args.rules, args.alertinterval)
+        logger.info("Checking {} alert rules on every sample.".format(len(args.rules)))
+
+
+# Setup derived
+def setup_derived(args):
+    """Set up the derived field stage, if any fields are configured."""
+    global deriver
+    if args.derived:
+        deriver = derived.Deriver(args.derived)
+        logger.info("Deriving {}.".format(", ".join(args.derived)))
+
+
+# Derive fields
+def derive_fields(devices):
+    """Return devices with the configured derived fields added."""
+    if deriver is None:
+        return devices
+    return deriver.derive(devices)
+
+
+# Check rules
+def check_rules(devices):
+    """Publish the alerts raised or cleared by device samples right away."""
+    if alerts is None:
+        return
+    messages = []
+    for alert in alerts.evaluate(devices, time.monotonic()):
+        payload = OrderedDict()
+        payload["datetime"] = datetime.now(
+            get_localzone()).replace(microsecond=0).isoformat()
+        payload.update(alert)
+        topic = "{}{}/{}/{}".format(
+            args.topic, args.alerttopic, alert["device"].lower(), alert["rule"])
+        messages.append((topic, encode_payload(payload), 1, False))
+        alerts_total.inc(alert["rule"], alert["state"])
+        message = "Alert {} {} on {}: {}".format(
+            alert["rule"], alert["state"], alert["device"], dict(alert["values"]))
+        if alert["state"] == "firing":
+            logger.warning(message)
+        else:
+            logger.info(message)
+    if messages:
+        send_batch(messages)
+
+
+# Setup capture
+def setup_capture(args):
+    """Open the raw traffic capture, if one is configured."""
+    global capturer
+    if args.capture:
+        capturer = capture.Capture(args.capture)
+        logger.info("Capturing raw device traffic to {}.".format(args.capture))
+
+
+# Teardown capture
+def teardown_capture():
+    """Flush and close the raw traffic capture."""
+    if capturer is not None:
+        capturer.close()
+
+
+# Replay capture
+def replay_capture(args):
+    """Decode a capture and publish it an interval at a time, stamped with its own times.
+
+    Classic register blocks go through the Classic decoder and Magnum
+    packets through the Magnum parser, as if just read. With a replay
+    speed the capture plays out at that multiple of real time, otherwise
+    as fast as it decodes.
+    """
+    reader = capture.CaptureReader(args.replay)
+    now = time.time()
+    start = history.parse_time(args.replaystart, now) if args.replaystart else None
+    end = history.parse_time(args.replayend, now) if args.replayend else None
+
+    # Wait for the broker rather than fill the outbox
+    deadline = time.monotonic() + 30
+    while not client.connected_flag and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    parser = capture.PacketMagnum(cleanpackets=args.cleanpackets)
+    decoders = {}
+    devices = OrderedDict()
+    stats = OrderedDict([
+        ("classic", 0), ("magnum", 0), ("published", 0), ("decode", 0.0)])
+
+    def flush(timestamp):
+        found = list(devices.values())
+        devices.clear()
+        if parser.packets:
+            began = time.perf_counter()
+            found.extend(parser.getDevices())
+            stats["decode"] += time.perf_counter() - began
+        found = derive_fields(found)
+        if found:
+            record_history(found, timestamp)
+            publish(found, timestamp)
+            stats["published"] += 1
+
+    began = time.monotonic()
+    first = due = None
+    for record in reader.records(start, end):
+        if first is None:
+            first = record.wall
+            due = (first // args.interval + 1) * args.interval
+        if args.replayspeed:
+            delay = (record.wall - first) / args.replayspeed - (time.monotonic() - began)
+            if delay > 0:
+                time.sleep(delay)
+        if record.wall >= due:
+            flush(due)
+            # Skip over gaps in the capture
+            due += ((record.wall - due) // args.interval + 1) * args.interval
+
+        if record.kind == capture.CLASSIC:
+            decoder = decoders.get(record.name)
+            if decoder is None:
+                decoder = decoders[record.name] = Midnite.Midnite(name=record.name)
+            started = time.perf_counter()
+            devices[record.name] = decoder.makeDevices(
+                decoder.decodeData(capture.unpack_blocks(record.payload)))[0]
+            stats["decode"] += time.perf_counter() - started
+            stats["classic"] += 1
+        elif record.kind == capture.MAGNUM:
+            parser.packets.append(bytearray(record.payload))
+            stats["magnum"] += 1
+    if first is not None:
+        flush(due)
+
+    elapsed = time.monotonic() - began
+    logger.info(
+        "Replayed {} Classic polls and {} Magnum packets as {} publishes in {:.1f}s, "
+        "decoding took {:.3f}s.".format(
+            stats["classic"], stats["magnum"], stats["published"], elapsed,
+            stats["decode"]))
+
+    # Let the network loop send what is queued
+    deadline = time.monotonic() + 30
+    while client.want_write() and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+
 # Setup MQTT
 def setup_mqtt(args):
     """Setup mqtt connection."""
@@ -273,42 +1131,482 @@ def setup_mqtt(args):
     client.on_disconnect = on_disconnect
     client.on_publish = on_publish
 
+    # Reconnect backoff, doubles from min up to max while the broker is away
+    client.reconnect_delay_set(
+        min_delay=args.reconnectmin,
+        max_delay=args.reconnectmax)
+
+    # Store-and-forward
+    global spool
+    if args.spool:
+        spool = Spool(args.spool, maxbytes=args.spoolsize)
+        threading.Thread(
+            target=replay_spool, name="spool", daemon=True).start()
+
+    # Connect once, the network loop keeps the session alive from here on
+    client.connect_async(args.broker, args.port)
+    client.loop_start()
+
+
+# Replay spool
+def replay_spool():
+    """Replay spooled payloads at --spoolrate while the broker is connected."""
+    while True:
+        if not client.connected_flag:
+            time.sleep(1)
+            continue
+
+        start = time.monotonic()
+        # One second worth of payloads at a time
+        messages = spool.read(args.spoolrate)
+        if not messages:
+            time.sleep(1)
+            continue
+
+        position = None
+        for next_position, (topic, payload, qos, retain, timestamp) in messages:
+            info = client.publish(topic, payload=payload, qos=qos, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            position = next_position
+        if position is not None:
+            spool.ack(position)
+            logger.debug("Replayed spooled payloads up to {}.".format(position))
+
+        elapsed = time.monotonic() - start
+        if elapsed < 1:
+            time.sleep(1 - elapsed)
+
+
+# Teardown MQTT
+def teardown_mqtt():
+    """Close the mqtt session."""
+    if spool is not None:
+        spool.close()
+    if client is None:
+        return
+    client.loop_stop()
+    client.disconnect()
+    client.connected_flag = False
+    client.disconnected_flag = True
+
+
+# Flush outbox
+def flush_outbox(client):
+    """Publish payloads queued while the broker was offline."""
+    with outbox_lock:
+        sent = 0
+        while outbox and client.connected_flag:
+            topic, payload, qos, retain = outbox[0]
+            info = client.publish(topic, payload=payload, qos=qos, retain=retain)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                break
+            outbox.popleft()
+            sent += 1
+        if sent:
+            logger.info("Sent {} queued payloads.".format(sent))
+
+
+# Send payload
+def send(topic, payload, qos=0, retain=False):
+    """Publish a payload, queueing it if the broker is unreachable."""
+    return send_batch([(topic, payload, qos, retain)]) == 1
+
+
+# Send batch
+def send_batch(messages):
+    """Publish (topic, payload, qos, retain) messages in one go.
+
+    Returns how many were published, the rest are queued in the spool or
+    the outbox.
+    """
+    sent = 0
+    with outbox_lock:
+        for topic, payload, qos, retain in messages:
+            # Keep ordering, anything already queued goes first. Spooled
+            # payloads replay alongside new ones instead.
+            if client.connected_flag and (spool is not None or not outbox):
+                info = client.publish(
+                    topic, payload=payload, qos=qos, retain=retain)
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    track_publish(info, qos)
+                    sent += 1
+                    continue
+
+            if spool is not None:
+                spool.append(topic, payload, qos, retain)
+                continue
+
+            if len(outbox) >= args.outbox:
+                outbox.popleft()
+                dropped_payloads_total.inc()
+                logger.warning("MQTT outbox full, dropped oldest payload.")
+            outbox.append((topic, payload, qos, retain))
+    return sent
+
 
 # Setup readers
 def setup_readers(args):
     """Setup reader."""
-    global magnumReader, midniteReader
+    global magnumReader, midniteReader, executor
 
     if not args.ignoremagnum:
-        magnumReader = magnum.Magnum(
-          device=args.device,
-          packets=args.packets,
-          timeout=args.timeout,
-          cleanpackets=args.cleanpackets)
+        recorder = capturer.recordMagnum if capturer else None
+        if args.magnumreader == "stream":
+            magnumReader = make_reader(args, "Magnum", magnumstream.StreamingMagnum, {
+              "device": args.device,
+              "timeout": args.timeout,
+              "cleanpackets": args.cleanpackets,
+              "buffersize": args.magnumbuffer,
+              "stale": args.magnumstale,
+            }, observer=observe_magnum, recorder=recorder)
+        else:
+            magnumReader = make_reader(args, "Magnum", magnumstream.MagnumReader, {
+              "device": args.device,
+              "packets": args.packets,
+              "timeout": args.timeout,
+              "cleanpackets": args.cleanpackets,
+            }, observer=observe_magnum, recorder=recorder)
+        readers["magnum"] = magnumReader
 
     if not args.ignoreclassic:
-        midniteReader = Midnite.Midnite(
-          host=args.classichost,
-          port=args.classicport,
-          unit=args.classicunit,
-          timeout=args.timeout)
+        for name, host, port, unit in args.classics:
+            options = {}
+            backend = Midnite.Midnite
+            if args.classicbackend == "async":
+                backend = Midnite.AsyncMidnite
+                options["request_timeout"] = args.classictimeout
+            options.update(
+              host=host,
+              port=port,
+              unit=unit,
+              timeout=args.timeout,
+              gap=args.classicgap,
+              slow=args.classicslow,
+              retries=args.classicretries,
+              wait=(args.classicretrywaitmin, args.classicretrywaitmax),
+              deadline=args.classicretrydeadline,
+              failures=args.classicfailures,
+              backoff=args.classicbackoff,
+              maxbackoff=args.classicmaxbackoff,
+              name=name)
+            # Classics behind one gateway share a worker, and with it a connection
+            reader = make_reader(
+              args, name, backend, options,
+              keepalive=args.classickeepalive,
+              group="{}:{}".format(host, port),
+              observer=observe_reader,
+              recorder=capturer.recordClassic if capturer else None)
+            midniteReaders.append(reader)
+            readers[name.lower()] = reader
+        midniteReader = midniteReaders[0]
+        if not args.workers:
+            Midnite.pool.setKeepalive(args.classickeepalive)
+
+    for worker in workers.values():
+        worker.start()
+
+    # Fast sampling
+    global aggregator
+    if args.samplerate:
+        aggregator = Aggregator(integrate=args.integrate)
+
+    # One worker per reader so a hung reader never holds up the others
+    executor = ThreadPoolExecutor(
+        max_workers=max(len(readers), 1),
+        thread_name_prefix="reader")
+
+
+# Make reader
+def make_reader(args, name, factory, options, keepalive=0, group=None, **hooks):
+    """Return a reader, or with --workers a stand in for one in a worker process.
+
+    Readers of the same group share a worker, others get one of their own.
+    Hooks are the callback options of the reader, called back here either way.
+    """
+    hooks = {hook: callback for hook, callback in hooks.items() if callback is not None}
+    if not args.workers:
+        return factory(**dict(options, **hooks))
+    group = group or name
+    worker = workers.get(group)
+    if worker is None:
+        worker = workers[group] = gateway.Worker(
+          name,
+          setup=(setup_worker, args.verbose, keepalive),
+          timeout=args.workertimeout,
+          backoff=args.workerbackoff,
+          maxbackoff=args.workermaxbackoff,
+          observer=observe_worker)
+    else:
+        logger.info("{} shares the {} worker.".format(name, worker.name))
+    return worker.add(name, factory, options, hooks)
+
+
+# Setup worker
+def setup_worker(verbose, keepalive):
+    """Set up logging and connection keepalive in a reader worker process."""
+    setup_logger(configargparse.Namespace(verbose=verbose))
+    if keepalive:
+        Midnite.pool.setKeepalive(keepalive)
+
+
+# Observe worker
+def observe_worker(name, event, value):
+    """Record reader worker restarts."""
+    if event == "restart":
+        worker_restarts_total.inc(name.lower(), amount=value)
+
+
+# Observe reader
+def observe_reader(name, event, value, *labels):
+    """Record Classic reader timings and retries."""
+    # Labelled like the readers, by lower case name
+    name = name.lower()
+    if event == "read":
+        read_seconds.observe(value, name, *labels)
+    elif event == "decode":
+        decode_seconds.observe(value, name)
+    elif event == "retry":
+        retries_total.inc(name, amount=value)
+
+
+# Observe Magnum
+def observe_magnum(event, value):
+    """Record Magnum packet scans and decodes."""
+    if event == "scan":
+        scan_seconds.observe(value)
+    elif event == "decode":
+        decode_seconds.observe(value, "magnum")
+    elif event == "unknown":
+        unknown_packets_total.inc(amount=value)
+
+
+# Teardown readers
+def teardown_readers():
+    """Close readers holding connections or threads."""
+    for reader in readers.values():
+        close = getattr(reader, "close", None)
+        if close is not None:
+            close()
+
+
+# Timed poll
+def timed_poll(name, reader):
+    """Return a reader's devices, recording how long it took."""
+    with poll_seconds.time(name):
+        return reader.getDevices()
+
+
+# Poll readers
+def poll_readers(deadline, names=None):
+    """Read devices concurrently, waiting at most deadline seconds.
+
+    Reads every reader unless given the names of some.
+    """
+    names = list(readers) if names is None else names
+    # A reader still busy from an earlier cycle is not asked again
+    for name in names:
+        if name not in pending:
+            pending[name] = executor.submit(timed_poll, name, readers[name])
+
+    done, _ = wait([pending[name] for name in names], timeout=deadline)
+
+    devices = []
+    for name in names:
+        future = pending[name]
+        if future in done:
+            del pending[name]
+            try:
+                lastdevices[name] = future.result()
+                devices.extend(lastdevices[name])
+                # Readers that fail softly flag their old data themselves
+                if any("status" in device for device in lastdevices[name]):
+                    dropped_cycles_total.inc(name)
+                continue
+            except Exception as e:
+                logger.error("Failed to read {} devices: {}".format(name, e))
+        else:
+            logger.warning(
+                "Reading {} devices missed the {}s deadline.".format(
+                    name, deadline))
+        dropped_cycles_total.inc(name)
+
+        # Fall back to the last data read, marked as stale
+        for device in lastdevices.get(name, []):
+            device = dict(device)
+            device["status"] = "stale"
+            devices.append(device)
+
+    return devices
+
+
+# Encode payload
+def encode_payload(data):
+    """Return a JSON payload, whatever the device payload codec."""
+    with encode_seconds.time():
+        return json.dumps(
+            data,
+            indent=None,
+            ensure_ascii=True,
+            allow_nan=True,
+            separators=(',', ':'))
+
+
+# Encode device payload
+def encode_device(topic, data):
+    """Return the payload for device data in the configured codec."""
+    with encode_seconds.time():
+        payload = encoder.encode(data)
+    # Schemas go out ahead of the first payload packed with them
+    for schema in encoder.takeSchemas():
+        send(topic + "/schema", schema, 1, True)
+    return payload
+
+
+# Changed fields
+def changed_fields(savedkey, saved, values):
+    """Return the fields that moved past their deadband since last published."""
+    volatile = VOLATILE_FIELDS.get(savedkey, ())
+    changes = OrderedDict()
+    for key, value in values.items():
+        if key in volatile:
+            continue
+        if key in saved:
+            old = saved[key]
+            deadband = args.deadbands.get(key)
+            if (deadband is not None and isinstance(value, (int, float)) and
+                    isinstance(old, (int, float))):
+                if abs(value - old) <= deadband:
+                    continue
+            elif value == old:
+                continue
+        changes[key] = value
+    return changes
+
+
+# Delta data
+def delta_data(savedkey, values, status):
+    """Return (keyframe, fields) to publish in delta mode, None if unchanged."""
+    now = time.monotonic()
+    saved = saveddevices.get(savedkey)
+
+    # Full keyframe when new, on a status change or when one is due
+    if (saved is None or savedstatus.get(savedkey) != status or
+            now - keyframes[savedkey] >= args.keyframe):
+        saveddevices[savedkey] = OrderedDict(values)
+        savedstatus[savedkey] = status
+        keyframes[savedkey] = now
+        return True, values
+
+    changes = changed_fields(savedkey, saved, values)
+    if not changes:
+        return None
+    # Deadbands are measured against the last published value
+    saved.update(changes)
+    return False, changes
+
+
+# Format field value
+def format_value(value):
+    """Return a field value as a plain topic payload."""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value, allow_nan=True)
+
+
+# Publish fields
+def publish_fields(topic, savedkey, device, status, timestamp):
+    """Publish changed device fields to their own retained topics."""
+    delta = delta_data(savedkey, device["data"], status)
+    if delta is None:
+        duplicates_total.inc(savedkey)
+        return
+
+    keyframe, fields = delta
+    messages = [(topic + "/datetime", timestamp, 0, True)]
+    if keyframe:
+        messages.append((topic + "/status", status, 0, True))
+    for key, value in fields.items():
+        messages.append((topic + "/" + key, format_value(value), 0, True))
+    send_batch(messages)
+
+    # Devices without a register map are discovered on first sight
+    if args.discovery and device["device"] not in discovered:
+        publish_discovery(device["device"], [(key, None) for key in fields])
+
+
+# Publish discovery
+def publish_discovery(name, fields, manufacturer="", model=""):
+    """Publish Home Assistant discovery configs for (field, unit) pairs."""
+    node = args.topic.strip("/").replace("/", "_") or __appname__.lower()
+    topic = args.topic + name.lower()
+    identifier = "{}_{}".format(node, name.lower())
+    device = OrderedDict([
+        ("identifiers", [identifier]),
+        ("name", name),
+    ])
+    if manufacturer:
+        device["manufacturer"] = manufacturer
+    if model:
+        device["model"] = model
+
+    messages = []
+    for field, unit in fields:
+        config = OrderedDict([
+            ("name", "{} {}".format(name, field.replace("_", " "))),
+            ("unique_id", "{}_{}".format(identifier, field)),
+            ("state_topic", "{}/{}".format(topic, field)),
+            ("availability_topic", topic + "/status"),
+            ("payload_available", "online"),
+            ("payload_not_available", "offline"),
+            ("device", device),
+        ])
+        if unit:
+            config["unit_of_measurement"] = unit
+            deviceclass = FIELD_DEVICE_CLASSES.get(field, DEVICE_CLASSES.get(unit))
+            if deviceclass:
+                config["device_class"] = deviceclass
+            config["state_class"] = (
+                "total_increasing" if field.startswith("lifetime_") else
+                "measurement")
+        messages.append((
+            "{}/sensor/{}/{}/config".format(args.discoveryprefix, node, config["unique_id"]),
+            encode_payload(config), 1, True))
+
+    send_batch(messages)
+    discovered.add(name)
+    logger.info("Published {} discovery configs for {}.".format(len(messages), name))
+
+
+# Publish Classic discovery
+def publish_classic_discovery():
+    """Publish discovery configs for every Classic from the register map."""
+    if not midniteReaders:
+        return
+    fields = [
+        (field.name, field.unit)
+        for block in Midnite.REGISTER_MAP.values()
+        for field in block.fields]
+    # Derived fields of Classic fields
+    if deriver is not None:
+        fields.extend(
+            (derivation.name, derivation.unit) for derivation in deriver.derivations
+            if all(field in Midnite.FIELD_INDEX for field in derivation.fields))
+    for reader in midniteReaders:
+        publish_discovery(reader.name, fields, "Midnite Solar", "Classic")
 
 
 # Publish device data
-def publish(devices):
-    """Publish device data."""
+def publish(devices, timestamp=None):
+    """Publish device data, stamped with timestamp or the current time."""
     global args
     try:
-        # Connect To MQTT Broker
-        client.connect(args.broker)
-        client.loop_start()
-        while not client.connected_flag:
-            time.sleep(1)
-
         # Build Payload Header Data
         data = OrderedDict()
-        data["datetime"] = datetime.now(
-            get_localzone()).replace(microsecond=0).isoformat()
+        if timestamp is None:
+            timestamp = time.time()
+        data["datetime"] = datetime.fromtimestamp(
+            timestamp, get_localzone()).replace(microsecond=0).isoformat()
         
         # Publish Each Device
         for device in devices:
@@ -317,44 +1615,135 @@ def publish(devices):
             savedkey = data["device"]
             duplicate = False
 
+            # Flag data that could not be refreshed this cycle
+            status = device.get("status", "online")
+            if status != "online":
+                data["status"] = status
+            elif "status" in data:
+                del data["status"]
+            # Seconds since a streamed device was last heard from
+            if "age" in device:
+                data["age"] = device["age"]
+            elif "age" in data:
+                del data["age"]
+
+            # Latest values for the metrics endpoint
+            device_online.set(int(status == "online"), savedkey)
+            for key, value in device["data"].items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    device_value.set(value, savedkey, key)
+
+            # Field Topic Mode
+            if args.fieldtopics:
+                publish_fields(topic, savedkey, device, status, data["datetime"])
+                continue
+
+            # Delta Mode
+            if args.delta:
+                delta = delta_data(savedkey, device["data"], status)
+                if delta is None:
+                    duplicates_total.inc(savedkey)
+                    continue
+                data["keyframe"], data["data"] = delta
+                send(topic, encode_device(topic, data))
+                continue
+
             # If NOT Data From Classic OR NOT Checking For Duplicate Devices
-            if not args.allowduplicates or device["device"].lower() != 'classic':
+            classic = device["device"] in [r.name for r in midniteReaders]
+            if not args.allowduplicates or not classic:
                 # If Device Is Known
                 if savedkey in saveddevices:
-                    # If Magnum Remote
-                    if device["device"] == magnum.REMOTE:
-                        # Normalize Timestamps
-                        for key in ["remotetimehours", "remotetimemins"]:
-                            saveddevices[savedkey][key] = device["data"][key]
+                    # Normalize Fields Like The Magnum Remote Clock
+                    for key in VOLATILE_FIELDS.get(savedkey, ()):
+                        saveddevices[savedkey][key] = device["data"][key]
                     # Duplicate Check
-                    if saveddevices[savedkey] == device["data"]:
+                    if (saveddevices[savedkey] == device["data"] and
+                            savedstatus.get(savedkey) == status):
                         duplicate = True
 
+            if duplicate:
+                duplicates_total.inc(savedkey)
+
             # If NOT A Duplicate Device
             if not duplicate:
                 # Mark As Known Device
                 saveddevices[savedkey] = device["data"]
+                savedstatus[savedkey] = status
                 # Copy Payload Data
                 data["data"] = device["data"]
-                # Generate JSON
-                payload = json.dumps(
-                    data,
-                    indent=None,
-                    ensure_ascii=True,
-                    allow_nan=True,
-                    separators=(',', ':'))
                 # Publish
-                client.publish(topic, payload=payload)
-
-        # Disconnect From MQTT Broker
-        client.loop_stop()
-        client.disconnect()
-        client.connected_flag = False
-        client.disconnected_flag = True
+                send(topic, encode_device(topic, data))
 
     except Exception as e:
-        logging.error(
-            "Failed connect to MQTT broker: {}".format(e))
+        logger.error(
+            "Failed to publish device data: {}".format(e))
+
+
+# Observe schedule
+def observe_schedule(name, event, value):
+    """Record scheduler lateness and overruns."""
+    if event == "late":
+        schedule_late_seconds.observe(value, name)
+    elif event == "overrun":
+        schedule_overruns_total.inc(name)
+    elif event == "skipped":
+        schedule_skipped_total.inc(name, amount=value)
+
+
+# Setup scheduler
+def setup_scheduler(args):
+    """Schedule sampling and publishing, or each source at its own cadence."""
+    global scheduler
+    scheduler = Scheduler(observer=observe_schedule)
+    options = {
+        "align": args.align,
+        "offset": args.alignoffset,
+        "policy": args.overrun,
+    }
+
+    # Sampled sources are all read together and published once an interval
+    if aggregator is not None:
+        scheduler.add("sample", args.samplerate, **options)
+        scheduler.add("publish", args.interval, **options)
+        return
+
+    if magnumReader is not None:
+        sources["magnum"] = ["magnum"]
+        scheduler.add("magnum", args.magnuminterval or args.interval, **options)
+    if midniteReaders:
+        sources["classic"] = [reader.name.lower() for reader in midniteReaders]
+        scheduler.add("classic", args.classicinterval or args.interval, **options)
+
+
+# Run cycle
+def run_cycle(due):
+    """Read and publish whatever the due schedules cover."""
+    names = [schedule.name for schedule in due]
+    # Aligned nodes stamp data with the same slot time
+    timestamp = max(schedule.slot for schedule in due)
+
+    if aggregator is not None:
+        if "sample" in names:
+            # Stale repeats would only skew the aggregates
+            devices = [
+                device for device in poll_readers(
+                    min(args.readdeadline, args.samplerate))
+                if "status" not in device]
+            devices = derive_fields(devices)
+            check_rules(devices)
+            aggregator.add(devices, time.monotonic())
+            record_history(devices, time.time())
+        if "publish" in names:
+            publish(aggregator.flush(), timestamp)
+        return
+
+    # Sources due together are read concurrently
+    deadline = min([args.readdeadline] + [schedule.interval for schedule in due])
+    names = [reader for name in names for reader in sources[name]]
+    devices = derive_fields(poll_readers(deadline, names))
+    check_rules(devices)
+    record_history(devices, timestamp)
+    publish(devices, timestamp)
 
 
 # Main loop
@@ -363,51 +1752,68 @@ def main(args):
     # Notify of start
     print("Publishing to broker:{} Every:{} seconds beginning at {}".format(
       args.broker, args.interval, datetime.now()))
+    # Nothing to do, exit.
+    if not readers:
+        logger.info("No devices to report, exiting.")
+        sys.exit(0)
+
+    setup_scheduler(args)
     while(True):
-        start = time.time()
-        # Read devices
-        devices = []
-        if not args.ignoremagnum:
-            data = magnumReader.getDevices()
-            if len(devices) > 0:
-                devices.append(data[0])
-            else:
-                devices = data
-
-        if not args.ignoreclassic:
-            data = midniteReader.getDevices()
-            if len(devices) > 0:
-                devices.append(data[0])
-            else:
-                devices = data
-
-        # Nothing to do, exit.
-        if args.ignoremagnum and args.ignoreclassic:
-            logger.info("No devices to report, exiting.")
-            sys.exit(0)
-        # Publish Device Data
-        publish(devices)
-
-        # Calculate Sleep Timer
-        interval = time.time() - start
-        sleep = args.interval - interval
-        if sleep > 0:
-            time.sleep(sleep)
+        due = scheduler.wait()
+        if not due:
+            break
+        start = time.monotonic()
+
+        run_cycle(due)
+        cycle_seconds.observe(time.monotonic() - start)
+        scheduler.complete(due)
+        if startup is not None:
+            mark_startup("first cycle")
+            report_startup(args)
+
+        # Classic Poll Timing
+        if "classic" in [schedule.name for schedule in due]:
+            for reader in midniteReaders:
+                stats = reader.getStats()
+                # Workers have none until first polled
+                if stats is None:
+                    continue
+                logger.debug(
+                    "{} polls: {} failures: {} last: {:.3f}s min: {:.3f}s mean: {:.3f}s max: {:.3f}s".format(
+                        reader.name, stats["polls"], stats["failures"], stats["last"],
+                        stats["min"], stats["mean"], stats["max"]))
 
 
 if __name__ == '__main__':
     try:
         # start
         start_time = datetime.now()
+        mark_startup("imports")
 
         args = get_arguments()
         setup_logger(args)
+        mark_startup("arguments")
+        setup_metrics(args)
+        setup_codec(args)
+        setup_derived(args)
         setup_mqtt(args)
-        setup_readers(args)
+        mark_startup("mqtt")
+        if not args.replay:
+            setup_capture(args)
+            setup_readers(args)
+            setup_rules(args)
+        mark_startup("readers")
+        setup_history(args)
+        if args.fieldtopics and args.discovery:
+            publish_classic_discovery()
+        mark_startup("history")
         logger.debug("PowerPi started at {}".format(start_time))
 
         # loop
-        main(args)
+        if args.replay:
+            replay_capture(args)
+        else:
+            main(args)
 
         # end
         finish_time = datetime.now()
@@ -429,12 +1835,12 @@ if __name__ == '__main__':
         raise e
         sys.exit(0)
 
-    except ParameterException as e:
+    except modbus_exceptions.ParameterException as e:
         raise e
         sys.exit(1)
 
     # Connection fail
-    except ConnectionException as e:
+    except modbus_exceptions.ConnectionException as e:
         raise e
         sys.exit(1)
 
@@ -442,3 +1848,9 @@ if __name__ == '__main__':
     except Exception as e:
         logger.exception("Unknown exception occurred.")
         sys.exit(1)
+
+    finally:
+        teardown_readers()
+        teardown_capture()
+        teardown_history()
+        teardown_mqtt()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Rules"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import ast
+import re
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Functions rules may call, rate() is bound per device when evaluated
+FUNCTIONS = {
+    "abs": abs,
+    "min": min,
+    "max": max,
+    "round": round,
+}
+RATE = "rate"
+# Syntax rules may use
+NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+    ast.USub, ast.UAdd, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+    ast.FloorDiv, ast.Mod, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE,
+    ast.Gt, ast.GtE, ast.IfExp, ast.Call, ast.Name, ast.Load, ast.Constant)
+# name[@device]: condition [until clear]
+SPEC = re.compile(r"^\s*([\w-]+)(?:@([\w-]+))?\s*:\s*(.+?)(?:\s+until\s+(.+))?\s*$")
+# Alert states
+FIRING = "firing"
+CLEARED = "cleared"
+
+
+# Compile expression
+def compile_expression(text):
+    """Return the code of a rule expression and the fields and rates it reads."""
+    try:
+        tree = ast.parse(text.strip(), mode="eval")
+    except SyntaxError as e:
+        raise ValueError("bad expression '{}': {}".format(text, e.msg))
+
+    fields = []
+    rates = []
+    for node in ast.walk(tree):
+        if not isinstance(node, NODES):
+            raise ValueError("'{}' is not allowed in '{}'".format(
+                type(node).__name__, text))
+        if isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or node.keywords or
+                    node.func.id not in FUNCTIONS and node.func.id != RATE):
+                raise ValueError("only {} and {}() may be called in '{}'".format(
+                    ", ".join(FUNCTIONS), RATE, text))
+            if node.func.id == RATE:
+                if len(node.args) != 1 or not isinstance(node.args[0], ast.Name):
+                    raise ValueError("{}() takes one field in '{}'".format(RATE, text))
+                # Pass the field name, not its value
+                field = node.args[0].id
+                node.args[0] = ast.copy_location(ast.Constant(field), node.args[0])
+                if field not in rates:
+                    rates.append(field)
+                if field not in fields:
+                    fields.append(field)
+        elif isinstance(node, ast.Name):
+            if node.id not in FUNCTIONS and node.id != RATE and node.id not in fields:
+                fields.append(node.id)
+
+    code = compile(ast.fix_missing_locations(tree), "<rule {}>".format(text), "eval")
+    return code, tuple(fields), tuple(rates)
+
+
+# Rule
+class Rule:
+    """Condition over the fields of a device, raising an alert while true.
+
+    Once firing, the alert clears when the clear expression is true, or
+    when the condition is no longer true without one, so a clear threshold
+    apart from the firing one gives hysteresis.
+    """
+
+    def __init__(self, name, condition, clear=None, device=None):
+        """Constructor."""
+        self.name = name
+        self.device = device.lower() if device else None
+        self.condition = condition
+        self.clear = clear
+        self.code, fields, rates = compile_expression(condition)
+        self.clearCode = None
+        if clear:
+            self.clearCode, clearFields, clearRates = compile_expression(clear)
+            fields += tuple(field for field in clearFields if field not in fields)
+            rates += tuple(field for field in clearRates if field not in rates)
+        self.fields = fields
+        self.rates = rates
+
+    # Parse
+    @classmethod
+    def parse(cls, spec):
+        """Return the rule of a 'name[@device]: condition [until clear]' spec."""
+        match = SPEC.match(spec)
+        if not match:
+            raise ValueError("expected name[@device]: condition [until clear], got '{}'".format(spec))
+        name, device, condition, clear = match.groups()
+        return cls(name, condition, clear, device)
+
+    # Applies
+    def applies(self, device, data):
+        """Return whether the rule covers a device with these fields."""
+        if self.device is not None and self.device != device.lower():
+            return False
+        return all(field in data for field in self.fields)
+
+
+# Alert state
+class AlertState:
+    """Firing state and rate limiting of one rule on one device."""
+
+    __slots__ = ("active", "sent", "last", "suppressed")
+
+    def __init__(self):
+        """Constructor."""
+        self.active = False
+        # Whether the alert of the current firing was published
+        self.sent = False
+        # Monotonic time the last firing alert was published
+        self.last = None
+        self.suppressed = 0
+
+
+# Rule engine
+class RuleEngine:
+    """Evaluate compiled rules against every device sample.
+
+    Firing alerts of a rule and device are published at most once every
+    `interval` seconds. Firings in between are counted and reported with
+    the next alert, and an alert still firing once the interval is up is
+    published then. A cleared alert is published only if its firing was.
+    """
+
+    def __init__(self, rules, interval=60):
+        """Constructor."""
+        self.rules = list(rules)
+        self.interval = interval
+        self.states = {}
+        # Rules covering each device, worked out on first sight
+        self.applicable = {}
+        # (monotonic time, rate field values) of the last sample per device
+        self.previous = {}
+        self.current = None
+        self.before = None
+        self.namespace = dict(FUNCTIONS, __builtins__={})
+        self.namespace[RATE] = self.rate
+        self.rateFields = tuple(OrderedDict.fromkeys(
+            field for rule in self.rules for field in rule.rates))
+
+    # Rate
+    def rate(self, field):
+        """Return the change per second of a field since the last sample."""
+        if self.before is None:
+            return 0.0
+        start, values = self.before
+        elapsed = self.current[0] - start
+        if field not in values or elapsed <= 0:
+            return 0.0
+        return (self.current[1][field] - values[field]) / elapsed
+
+    # Evaluate
+    def evaluate(self, devices, now):
+        """Return the alerts raised or cleared by device samples at monotonic now."""
+        alerts = []
+        for device in devices:
+            # Stale data says nothing new
+            if "status" in device:
+                continue
+            name = device["device"]
+            data = device["data"]
+            rules = self.applicable.get(name)
+            if rules is None:
+                rules = self.applicable[name] = [
+                    rule for rule in self.rules if rule.applies(name, data)]
+                logger.debug("{} alert rules cover {}.".format(len(rules), name))
+            if not rules:
+                continue
+
+            self.current = (now, data)
+            self.before = self.previous.get(name)
+            for rule in rules:
+                alert = self.check(rule, name, data, now)
+                if alert is not None:
+                    alerts.append(alert)
+            if self.rateFields:
+                self.previous[name] = (now, {
+                    field: data[field] for field in self.rateFields if field in data})
+        return alerts
+
+    # Check rule
+    def check(self, rule, device, data, now):
+        """Update the state of a rule on a device, returning an alert to publish."""
+        key = (rule.name, device)
+        state = self.states.get(key)
+        if state is None:
+            state = self.states[key] = AlertState()
+
+        try:
+            if not state.active:
+                state.active = bool(eval(rule.code, self.namespace, data))
+                if not state.active:
+                    return None
+                state.sent = False
+            elif rule.clearCode is not None:
+                if eval(rule.clearCode, self.namespace, data):
+                    return self.cleared(rule, device, data, state)
+            elif not eval(rule.code, self.namespace, data):
+                return self.cleared(rule, device, data, state)
+        except Exception as e:
+            logger.debug("Rule {} failed on {}: {}".format(rule.name, device, e))
+            return None
+
+        # Firing, published already or held back until the interval is up
+        if state.sent or (state.last is not None and now - state.last < self.interval):
+            return None
+        state.sent = True
+        state.last = now
+        alert = self.alert(rule, device, data, FIRING)
+        alert["suppressed"] = state.suppressed
+        state.suppressed = 0
+        return alert
+
+    # Cleared
+    def cleared(self, rule, device, data, state):
+        """Clear a firing rule, returning the alert if its firing was published."""
+        state.active = False
+        if not state.sent:
+            state.suppressed += 1
+            return None
+        return self.alert(rule, device, data, CLEARED)
+
+    # Alert
+    def alert(self, rule, device, data, status):
+        """Return an alert payload."""
+        alert = OrderedDict()
+        alert["rule"] = rule.name
+        alert["device"] = device
+        alert["state"] = status
+        alert["condition"] = rule.condition
+        alert["values"] = OrderedDict(
+            (field, data[field]) for field in rule.fields)
+        return alert
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Scheduler"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Overrun policies
+SKIP = "skip"
+CATCHUP = "catchup"
+COALESCE = "coalesce"
+POLICIES = (SKIP, CATCHUP, COALESCE)
+# Most missed slots run back to back when catching up
+MAX_CATCHUP = 10
+# Seconds the wall clock may step before schedules are realigned
+MAX_SKEW = 1.0
+
+
+# Schedule
+class Schedule:
+    """Fixed cadence on the monotonic clock.
+
+    Runs are due every `interval` seconds from the first slot, so time spent
+    running never pushes later runs back. Aligned schedules start on a wall
+    clock multiple of the interval plus `offset`, e.g. on the minute.
+    """
+
+    def __init__(self, name, interval, align=False, offset=0.0, policy=SKIP):
+        """Constructor."""
+        if policy not in POLICIES:
+            raise ValueError("Unknown overrun policy {}".format(policy))
+        self.name = name
+        self.interval = interval
+        self.align = align
+        self.offset = offset % interval
+        self.policy = policy
+        # Monotonic time of the next run
+        self.due = None
+        # Wall clock time of the next run, the timestamp of its data
+        self.slot = None
+        self.stats = OrderedDict([
+            ("runs", 0),
+            ("overruns", 0),
+            ("skipped", 0),
+            ("late", 0.0),
+            ("maxlate", 0.0),
+        ])
+
+    # Start
+    def start(self, now, wall):
+        """Set the first run, on the next boundary when aligned."""
+        slot = wall
+        if self.align:
+            slot = math.ceil(
+                (wall - self.offset) / self.interval) * self.interval + self.offset
+        self.slot = slot
+        self.due = now + (slot - wall)
+
+    # Skew
+    def skew(self, now, wall):
+        """Return how far the wall clock moved against the monotonic clock."""
+        return wall - (self.slot - (self.due - now))
+
+    # Advance
+    def advance(self, now):
+        """Move on to the next run after one finished at now.
+
+        Returns how many slots had already passed and how many of them are
+        skipped under the overrun policy.
+        """
+        self.stats["runs"] += 1
+        due = self.due + self.interval
+        if due > now:
+            self.due = due
+            self.slot += self.interval
+            return 0, 0
+
+        missed = int((now - due) // self.interval) + 1
+        if self.policy == SKIP:
+            # Carry on from the next slot still ahead
+            skipped = missed
+        elif self.policy == COALESCE:
+            # One run straight away stands in for every missed slot
+            skipped = missed - 1
+        else:
+            # Run every missed slot straight away, within reason
+            skipped = max(missed - MAX_CATCHUP, 0)
+        self.due = due + skipped * self.interval
+        self.slot += (skipped + 1) * self.interval
+        self.stats["overruns"] += 1
+        self.stats["skipped"] += skipped
+        return missed, skipped
+
+
+# Scheduler
+class Scheduler:
+    """Wait for schedules to come due and account for their overruns.
+
+    The optional observer is called with (name, event, value) for "late"
+    (seconds a run started after it was due), "overrun" and "skipped".
+    """
+
+    def __init__(self, observer=None):
+        """Constructor."""
+        self.schedules = []
+        self.observer = observer
+        self.stopped = threading.Event()
+
+    # Observe
+    def observe(self, name, event, value):
+        """Hand a stat to the observer, if any."""
+        if self.observer is not None:
+            self.observer(name, event, value)
+
+    # Add schedule
+    def add(self, name, interval, align=False, offset=0.0, policy=SKIP):
+        """Add a schedule, its first run due now or on the next boundary."""
+        schedule = Schedule(name, interval, align, offset, policy)
+        schedule.start(time.monotonic(), time.time())
+        self.schedules.append(schedule)
+        return schedule
+
+    # Check clock
+    def checkClock(self, now, wall):
+        """Realign the schedules if the wall clock was stepped."""
+        skew = self.schedules[0].skew(now, wall)
+        if abs(skew) > MAX_SKEW:
+            logger.info("Clock moved {:.1f}s, realigning schedules.".format(skew))
+            for schedule in self.schedules:
+                schedule.start(now, wall)
+
+    # Wait
+    def wait(self):
+        """Block until schedules are due and return them, empty once stopped."""
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            self.checkClock(now, time.time())
+            due = min(schedule.due for schedule in self.schedules)
+            if due > now:
+                self.stopped.wait(due - now)
+                continue
+
+            ready = [
+                schedule for schedule in self.schedules if schedule.due <= now]
+            for schedule in ready:
+                late = now - schedule.due
+                schedule.stats["late"] = late
+                schedule.stats["maxlate"] = max(schedule.stats["maxlate"], late)
+                self.observe(schedule.name, "late", late)
+            return ready
+        return []
+
+    # Complete
+    def complete(self, schedules):
+        """Record the runs of schedules returned by wait() as finished."""
+        now = time.monotonic()
+        for schedule in schedules:
+            missed, skipped = schedule.advance(now)
+            if not missed:
+                continue
+            logger.warning(
+                "{} overran its {}s interval, {} missed, {} skipped ({}).".format(
+                    schedule.name, schedule.interval, missed, skipped,
+                    schedule.policy))
+            self.observe(schedule.name, "overrun", 1)
+            if skipped:
+                self.observe(schedule.name, "skipped", skipped)
+
+    # Stop
+    def stop(self):
+        """Wake wait() and make it return nothing."""
+        self.stopped.set()
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__appname__ = "Spool"
+__author__ = "David Durost <david.durost@gmail.com>"
+__version__ = "0.2.1"
+__license__ = "Apache2"
+
+import os
+import struct
+import threading
+import time
+import zlib
+
+import logging
+logger = logging.getLogger("PowerPi")
+
+# Record header (crc, payload length, timestamp, topic length, qos, retain)
+RECORD = struct.Struct('<IIdHBB')
+# Segment file name
+SEGMENT = "{:010d}.seg"
+# Read position file name
+POSITION = "position"
+
+
+class Spool:
+    """Bounded on-disk store-and-forward queue of MQTT messages.
+
+    Messages are appended to numbered segment files inside `path`. Once the
+    segments hold more than `maxbytes` the oldest one is dropped, so the
+    spool never grows past its budget on the SD card. The read position is
+    kept in its own file, so replay carries on where it stopped after a
+    restart.
+    """
+
+    def __init__(self, path, maxbytes=16 * 1024 * 1024, segmentbytes=None):
+        """Constructor."""
+        self.path = path
+        self.maxbytes = maxbytes
+        self.segmentbytes = segmentbytes or max(maxbytes // 8, 64 * 1024)
+        self.lock = threading.Lock()
+        self.writer = None
+
+        os.makedirs(self.path, exist_ok=True)
+        self.sizes = {}
+        for name in os.listdir(self.path):
+            if name.endswith(".seg"):
+                seq = int(name[:-4])
+                self.sizes[seq] = os.path.getsize(self.segment(seq))
+        self.writeseq = max(self.sizes) if self.sizes else 0
+        self.sizes.setdefault(self.writeseq, 0)
+        self.repair(self.writeseq)
+        self.readseq, self.readoffset = self.loadPosition()
+
+    # Read record
+    @staticmethod
+    def readRecord(file):
+        """Return (size, message) of the record at the file position, None if torn."""
+        header = file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        crc, length, timestamp, topiclength, qos, retain = RECORD.unpack(header)
+        topic = file.read(topiclength)
+        payload = file.read(length)
+        if (len(topic) < topiclength or len(payload) < length or
+                zlib.crc32(header[4:] + topic + payload) != crc):
+            return None
+        return RECORD.size + topiclength + length, (
+            topic.decode("utf-8"), payload, qos, bool(retain), timestamp)
+
+    # Repair segment
+    def repair(self, seq):
+        """Cut a segment back to its last whole record, as after power loss."""
+        if not self.sizes[seq]:
+            return
+        valid = 0
+        with open(self.segment(seq), "rb") as file:
+            while valid < self.sizes[seq]:
+                record = self.readRecord(file)
+                if record is None:
+                    break
+                valid += record[0]
+        if valid < self.sizes[seq]:
+            logger.warning(
+                "Spool segment {} has a torn record, cutting it back to {} bytes.".format(
+                    seq, valid))
+            os.truncate(self.segment(seq), valid)
+            self.sizes[seq] = valid
+
+    # Segment path
+    def segment(self, seq):
+        """Return the file path of a segment."""
+        return os.path.join(self.path, SEGMENT.format(seq))
+
+    # Load read position
+    def loadPosition(self):
+        """Return the saved (segment, offset) read position."""
+        try:
+            with open(os.path.join(self.path, POSITION)) as file:
+                seq, offset = [int(value) for value in file.read().split()]
+            if seq in self.sizes:
+                return seq, offset
+        except (OSError, ValueError):
+            pass
+        return min(self.sizes), 0
+
+    # Save read position
+    def savePosition(self):
+        """Persist the read position."""
+        path = os.path.join(self.path, POSITION)
+        with open(path + ".tmp", "w") as file:
+            file.write("{} {}".format(self.readseq, self.readoffset))
+        os.replace(path + ".tmp", path)
+
+    # Pending bytes
+    def pending(self):
+        """Return the number of bytes waiting to be replayed."""
+        with self.lock:
+            return sum(
+                size for seq, size in self.sizes.items()
+                if seq >= self.readseq) - self.readoffset
+
+    # Append message
+    def append(self, topic, payload, qos=0, retain=False, timestamp=None):
+        """Store a message for later replay."""
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        topic = topic.encode("utf-8")
+        if timestamp is None:
+            timestamp = time.time()
+        header = RECORD.pack(
+            0, len(payload), timestamp, len(topic), qos, int(retain))[4:]
+        crc = zlib.crc32(header + topic + payload)
+        record = struct.pack('<I', crc) + header + topic + payload
+
+        with self.lock:
+            if self.sizes[self.writeseq] >= self.segmentbytes:
+                self.roll()
+            if self.writer is None:
+                self.writer = open(self.segment(self.writeseq), "ab")
+            self.writer.write(record)
+            self.writer.flush()
+            self.sizes[self.writeseq] += len(record)
+            self.trim()
+
+    # Roll segment
+    def roll(self):
+        """Start a new segment, the lock must be held."""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.writeseq += 1
+        self.sizes[self.writeseq] = 0
+
+    # Trim segments
+    def trim(self):
+        """Drop the oldest segments past the byte budget, the lock must be held."""
+        while sum(self.sizes.values()) > self.maxbytes and len(self.sizes) > 1:
+            oldest = min(self.sizes)
+            os.remove(self.segment(oldest))
+            del self.sizes[oldest]
+            logger.warning("Spool full, dropped segment {}.".format(oldest))
+            if self.readseq <= oldest:
+                self.readseq, self.readoffset = min(self.sizes), 0
+
+    # Read messages
+    def read(self, limit):
+        """Return up to `limit` (position, message) pairs from the read position.
+
+        A message is a (topic, payload, qos, retain, timestamp) tuple. Pass
+        the position of the last message handled to ack().
+        """
+        messages = []
+        with self.lock:
+            seq, offset = self.readseq, self.readoffset
+            while len(messages) < limit and seq in self.sizes:
+                if offset >= self.sizes[seq]:
+                    if seq == self.writeseq:
+                        break
+                    seq, offset = seq + 1, 0
+                    continue
+                with open(self.segment(seq), "rb") as file:
+                    file.seek(offset)
+                    while len(messages) < limit and offset < self.sizes[seq]:
+                        record = self.readRecord(file)
+                        if record is None:
+                            self.truncated(seq, offset)
+                            break
+                        offset += record[0]
+                        messages.append(((seq, offset), record[1]))
+                if seq == self.writeseq:
+                    break
+        return messages
+
+    # Truncated segment
+    def truncated(self, seq, offset):
+        """End a segment at a damaged record, the lock must be held.
+
+        The rest of the segment is skipped, and writing moves on to a new
+        segment so later messages are not stuck behind the damage.
+        """
+        logger.error("Spool segment {} is corrupt after {} bytes.".format(seq, offset))
+        if seq == self.writeseq:
+            self.roll()
+        self.sizes[seq] = offset
+
+    # Acknowledge messages
+    def ack(self, position):
+        """Move the read position past replayed messages."""
+        with self.lock:
+            seq, offset = position
+            if (seq, offset) < (self.readseq, self.readoffset):
+                # Trimmed while replaying, the read position has moved past it
+                return
+            # Segments read to the end are no longer needed
+            for old in [old for old in self.sizes if old < seq]:
+                os.remove(self.segment(old))
+                del self.sizes[old]
+            if (seq != self.writeseq and seq in self.sizes and
+                    offset >= self.sizes[seq]):
+                os.remove(self.segment(seq))
+                del self.sizes[seq]
+                seq, offset = seq + 1, 0
+            self.readseq, self.readoffset = seq, offset
+            self.savePosition()
+
+    # Close spool
+    def close(self):
+        """Close the segment being written."""
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
@@ -0,0 +1,50 @@
+from aggregate import Aggregator, DeviceWindow
+
+
+def test_min_max_mean_last():
+    window = DeviceWindow("Classic")
+    for value in (3, 1, 2):
+        window.add({"watts": value}, 0)
+    data = window.flush()
+    assert (data["watts"], data["watts_min"], data["watts_max"]) == (2, 1, 3)
+    assert data["watts_mean"] == 2.0
+    assert data["samples"] == 3
+    assert type(data["watts"]) is int
+
+
+def test_float_after_int_is_kept():
+    window = DeviceWindow("Classic")
+    window.add({"volts": 13}, 0)
+    window.add({"volts": 13.6}, 1)
+    data = window.flush()
+    assert data["volts"] == 13.6
+    assert data["volts_max"] == 13.6
+    assert type(data["volts_min"]) is float
+
+
+def test_int_type_is_decided_per_window():
+    window = DeviceWindow("Classic")
+    window.add({"volts": 13.5}, 0)
+    assert type(window.flush()["volts"]) is float
+    window.add({"volts": 13}, 1)
+    assert type(window.flush()["volts"]) is int
+
+
+def test_integral_is_trapezoid_in_hours():
+    window = DeviceWindow("Classic", integrate=("watts",))
+    window.add({"watts": 100}, 0)
+    window.add({"watts": 200}, 3600)
+    assert window.flush()["watts_integral"] == 150.0
+
+
+def test_other_fields_and_stale_devices():
+    aggregator = Aggregator()
+    aggregator.add([{"device": "Classic", "data": {"state": "Bulk", "ok": True, "watts": 5}}], 0)
+    devices = aggregator.flush()
+    assert devices[0]["data"]["state"] == "Bulk"
+    assert devices[0]["data"]["ok"] is True
+    assert "status" not in devices[0]
+
+    devices = aggregator.flush()
+    assert devices[0]["status"] == "stale"
+    assert devices[0]["data"]["watts"] == 5
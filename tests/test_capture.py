@@ -0,0 +1,79 @@
+import os
+from collections import OrderedDict
+
+from capture import CLASSIC, MAGIC, MAGNUM, Capture, CaptureReader, pack_blocks, unpack_blocks
+
+
+def blocks(value):
+    return OrderedDict([(4100, [value, 2, 3]), (4360, [value])])
+
+
+def classic_values(path):
+    return [
+        unpack_blocks(record.payload)[4360][0]
+        for record in CaptureReader(path).records() if record.kind == CLASSIC]
+
+
+def test_blocks_round_trip():
+    assert unpack_blocks(pack_blocks(blocks(7))) == blocks(7)
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "powerpi.cap")
+    capture = Capture(path)
+    capture.recordClassic("Classic", blocks(1))
+    capture.recordMagnum(b"\x01\x02\x03")
+    capture.close()
+
+    records = list(CaptureReader(path).records())
+    assert [(record.kind, record.name) for record in records] == [
+        (CLASSIC, "Classic"), (MAGNUM, "")]
+    assert unpack_blocks(records[0].payload) == blocks(1)
+    assert records[1].payload == b"\x01\x02\x03"
+    assert records[0].monotonic <= records[1].monotonic
+    assert abs(records[0].wall - records[1].wall) < 5
+
+
+def test_torn_tail_is_cut_back_on_open(tmp_path):
+    path = str(tmp_path / "powerpi.cap")
+    capture = Capture(path)
+    capture.recordClassic("Classic", blocks(1))
+    capture.recordClassic("Classic", blocks(2))
+    capture.close()
+    # Power lost part way through the last record
+    os.truncate(path, os.path.getsize(path) - 3)
+
+    capture = Capture(path)
+    capture.recordClassic("Classic", blocks(3))
+    capture.close()
+    assert classic_values(path) == [1, 3]
+    with open(path, "rb") as file:
+        assert file.read(len(MAGIC)) == MAGIC
+
+
+def test_torn_magic_is_rewritten(tmp_path):
+    path = str(tmp_path / "powerpi.cap")
+    with open(path, "wb") as file:
+        file.write(MAGIC[:3])
+    capture = Capture(path)
+    capture.recordClassic("Classic", blocks(1))
+    capture.close()
+    assert classic_values(path) == [1]
+
+
+def test_damage_skips_to_next_session(tmp_path):
+    path = str(tmp_path / "powerpi.cap")
+    capture = Capture(path)
+    capture.recordClassic("Classic", blocks(1))
+    capture.recordClassic("Classic", blocks(2))
+    capture.close()
+    damaged = os.path.getsize(path) - 1
+    capture = Capture(path)
+    capture.recordClassic("Classic", blocks(3))
+    capture.close()
+    # Damage the last record of the first session
+    with open(path, "r+b") as file:
+        file.seek(damaged)
+        file.write(b"X")
+
+    assert classic_values(path) == [1, 3]
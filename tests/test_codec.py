@@ -0,0 +1,102 @@
+import math
+from collections import OrderedDict
+
+import pytest
+
+from aggregate import DeviceWindow
+from codec import Codec, Decoder, PackedCodec, kind_of, widen
+
+DATETIME = "2026-01-02T03:04:05.500000+01:00"
+
+
+def payload(data, device="Classic", **extra):
+    message = OrderedDict([("datetime", DATETIME), ("device", device)])
+    message.update(extra)
+    message["data"] = data
+    return message
+
+
+def round_trip(codec, message, decoder=None):
+    decoder = decoder or Decoder()
+    encoded = codec.encode(message)
+    for schema in codec.takeSchemas():
+        decoder.addSchema(schema)
+    return decoder.decode(encoded)
+
+
+@pytest.mark.parametrize("value, kind", [
+    (True, "?"),
+    (7, "i"),
+    (2**40, "q"),
+    (2**70, "j"),
+    (13.5, "f"),
+    (0.1, "d"),
+    (1e300, "d"),
+    (float("inf"), "f"),
+    ("Bulk", "s"),
+    ([1, 2], "j"),
+])
+def test_kind_of(value, kind):
+    assert kind_of(value) == kind
+
+
+def test_widen():
+    assert widen("?", "i") == "i"
+    assert widen("i", "q") == "q"
+    assert widen("i", "f") == "d"
+    assert widen("f", "d") == "d"
+    assert widen("i", "s") == "j"
+
+
+def test_json_round_trip():
+    message = payload(OrderedDict([("volts", 13.5), ("state", "Bulk")]), status="stale")
+    assert round_trip(Codec(), message) == message
+
+
+def test_aggregate_output_round_trip():
+    window = DeviceWindow("Classic", integrate=("avg_power",))
+    samples = [
+        {"avg_power": 101, "avg_battery_voltage": 13.1, "charge_state": "Bulk", "soc": 80},
+        {"avg_power": 97, "avg_battery_voltage": 13.3, "charge_state": "Bulk", "soc": 80},
+        {"avg_power": 250, "avg_battery_voltage": 13.7, "charge_state": "Absorb", "soc": 81},
+    ]
+    for second, sample in enumerate(samples):
+        window.add(sample, second * 7.3)
+    data = window.flush()
+    data["conversion_efficiency"] = 93.7
+    data["nothing"] = float("nan")
+
+    codec = PackedCodec()
+    decoded = round_trip(codec, payload(data), Decoder())
+    nothing = decoded["data"].pop("nothing")
+    assert math.isnan(nothing)
+    del data["nothing"]
+    # Means and integrals keep every bit of their doubles
+    assert decoded["data"] == data
+    assert [type(value) for value in decoded["data"].values()] == [
+        type(value) for value in data.values()]
+    assert decoded["datetime"] == DATETIME
+
+
+def test_float_field_widens_when_float32_loses_precision():
+    codec = PackedCodec()
+    decoder = Decoder()
+    assert round_trip(codec, payload({"volts": 13.5}), decoder)["data"] == {"volts": 13.5}
+    assert round_trip(codec, payload({"volts": 13.4}), decoder)["data"] == {"volts": 13.4}
+    assert codec.schemas["Classic"].fields == [("volts", "d", None, None)]
+
+
+def test_register_fields_and_partial_payloads():
+    codec = PackedCodec({"Classic": {"avg_battery_voltage": ("h", 10.0, None)}})
+    decoder = Decoder()
+    full = payload(OrderedDict([("avg_battery_voltage", 13.6), ("soc", 80)]), age=1.25)
+    assert round_trip(codec, full, decoder) == full
+    partial = payload(OrderedDict([("soc", 81)]))
+    assert round_trip(codec, partial, decoder) == partial
+    assert codec.schemas["Classic"].fields[0] == ("avg_battery_voltage", "h", 10.0, None)
+
+
+def test_unknown_schema():
+    encoded = PackedCodec().encode(payload({"soc": 80}))
+    with pytest.raises(KeyError):
+        Decoder().decode(encoded)
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from gateway import Worker
+
+
+class CountingReader:
+    """Reader counting its polls, failing when told to."""
+
+    def __init__(self, name, fail=False, observer=None):
+        self.name = name
+        self.fail = fail
+        self.observer = observer
+        self.polls = 0
+
+    def getDevices(self):
+        self.polls += 1
+        if self.observer is not None:
+            self.observer(self.name, "poll", self.polls)
+        if self.fail:
+            raise IOError("no answer")
+        return [{"device": self.name, "data": {"polls": self.polls, "pid": os.getpid()}}]
+
+    def getStats(self):
+        return {"polls": self.polls}
+
+
+@pytest.fixture
+def worker():
+    worker = Worker("Classic", timeout=10)
+    yield worker
+    worker.close()
+
+
+def test_readers_share_a_worker(worker):
+    calls = []
+    first = worker.add("A", CountingReader, {"name": "A"}, {"observer": lambda *call: calls.append(call)})
+    second = worker.add("B", CountingReader, {"name": "B"})
+    worker.start()
+
+    a = first.getDevices()[0]["data"]
+    first.getDevices()
+    b = second.getDevices()[0]["data"]
+    assert a["pid"] == b["pid"] != os.getpid()
+    assert b["polls"] == 1
+    assert first.getStats() == {"polls": 2}
+    assert calls == [("A", "poll", 1), ("A", "poll", 2)]
+
+
+def test_reader_errors_are_raised(worker):
+    reader = worker.add("A", CountingReader, {"name": "A", "fail": True})
+    worker.start()
+    with pytest.raises(RuntimeError, match="no answer"):
+        reader.getDevices()
+    assert reader.getStats() == {"polls": 1}
+
+
+def test_dead_worker_is_restarted(worker):
+    restarts = []
+    worker.observer = lambda *event: restarts.append(event)
+    first = worker.add("A", CountingReader, {"name": "A"})
+    worker.add("B", CountingReader, {"name": "B"})
+    worker.start()
+    first.getDevices()
+    worker.process.kill()
+    worker.process.join()
+
+    assert first.getDevices()[0]["data"]["polls"] == 1
+    assert restarts == [("A", "restart", 1), ("B", "restart", 1)]
+    first.close()
+    first.close()
+    assert worker.process is None
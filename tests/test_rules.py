@@ -0,0 +1,78 @@
+import pytest
+
+from rules import CLEARED, FIRING, Rule, RuleEngine
+
+
+def sample(name="Classic", **data):
+    return {"device": name, "data": data}
+
+
+def states(alerts):
+    return [alert["state"] for alert in alerts]
+
+
+def test_parse():
+    rule = Rule.parse("low-battery@Classic: avg_battery_voltage < 11.8 until avg_battery_voltage > 12.4")
+    assert rule.name == "low-battery"
+    assert rule.device == "classic"
+    assert rule.condition == "avg_battery_voltage < 11.8"
+    assert rule.clear == "avg_battery_voltage > 12.4"
+    assert rule.fields == ("avg_battery_voltage",)
+
+
+@pytest.mark.parametrize("spec", [
+    "no condition",
+    "bad: avg_power >",
+    "call: open('x')",
+    "attribute: avg_power.real > 0",
+    "rate: rate(avg_power + 1) > 0",
+])
+def test_rejected(spec):
+    with pytest.raises(ValueError):
+        Rule.parse(spec)
+
+
+def test_hysteresis():
+    rule = Rule.parse("low: volts < 11.8 until volts > 12.4")
+    engine = RuleEngine([rule], interval=0)
+    assert states(engine.evaluate([sample(volts=12.0)], 0)) == []
+    assert states(engine.evaluate([sample(volts=11.5)], 1)) == [FIRING]
+    # Back over the firing threshold but not past the clear one
+    assert states(engine.evaluate([sample(volts=12.0)], 2)) == []
+    assert states(engine.evaluate([sample(volts=12.5)], 3)) == [CLEARED]
+    assert states(engine.evaluate([sample(volts=12.0)], 4)) == []
+
+
+def test_clears_without_until():
+    engine = RuleEngine([Rule.parse("hot: fet_temperature > 70")], interval=0)
+    assert states(engine.evaluate([sample(fet_temperature=75)], 0)) == [FIRING]
+    assert states(engine.evaluate([sample(fet_temperature=75)], 1)) == []
+    assert states(engine.evaluate([sample(fet_temperature=65)], 2)) == [CLEARED]
+
+
+def test_rate_limited_flapping_is_counted():
+    engine = RuleEngine([Rule.parse("hot: fet_temperature > 70")], interval=60)
+    assert states(engine.evaluate([sample(fet_temperature=75)], 0)) == [FIRING]
+    assert states(engine.evaluate([sample(fet_temperature=65)], 1)) == [CLEARED]
+    # Flapping within the interval is held back
+    for now in range(2, 12, 2):
+        assert engine.evaluate([sample(fet_temperature=75)], now) == []
+        assert engine.evaluate([sample(fet_temperature=65)], now + 1) == []
+    alerts = engine.evaluate([sample(fet_temperature=75)], 61)
+    assert states(alerts) == [FIRING]
+    assert alerts[0]["suppressed"] == 5
+
+
+def test_rate_and_device_filter():
+    rule = Rule.parse("drop@Classic: rate(volts) < -0.5")
+    engine = RuleEngine([rule], interval=0)
+    assert engine.evaluate([sample(volts=13.0), sample("Magnum", volts=13.0)], 0) == []
+    alerts = engine.evaluate([sample(volts=12.0), sample("Magnum", volts=10.0)], 1)
+    assert [(alert["device"], alert["state"]) for alert in alerts] == [("Classic", FIRING)]
+
+
+def test_stale_and_missing_fields_are_ignored():
+    engine = RuleEngine([Rule.parse("low: volts < 11.8")], interval=0)
+    stale = sample(volts=10.0)
+    stale["status"] = "stale"
+    assert engine.evaluate([stale, sample("Magnum", amps=1)], 0) == []
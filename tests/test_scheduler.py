@@ -0,0 +1,82 @@
+import pytest
+
+import scheduler
+from scheduler import CATCHUP, COALESCE, SKIP, Schedule, Scheduler
+
+
+def test_aligned_start():
+    schedule = Schedule("publish", 60, align=True, offset=5)
+    schedule.start(1000.0, 1_700_000_010.0)
+    assert schedule.slot == 1_700_000_045.0
+    assert schedule.due == 1035.0
+
+
+def test_no_drift_when_runs_take_time():
+    schedule = Schedule("publish", 10)
+    schedule.start(0.0, 0.0)
+    for run in range(1, 101):
+        # Each run finishes 3 seconds after it was due
+        assert schedule.advance(schedule.due + 3.0) == (0, 0)
+        assert schedule.due == run * 10.0
+        assert schedule.slot == run * 10.0
+
+
+@pytest.mark.parametrize("policy, skipped, due, slot", [
+    (SKIP, 3, 40.0, 40.0),
+    (COALESCE, 2, 30.0, 30.0),
+    (CATCHUP, 0, 10.0, 10.0),
+])
+def test_overrun_policies(policy, skipped, due, slot):
+    schedule = Schedule("publish", 10, policy=policy)
+    schedule.start(0.0, 0.0)
+    # The run due at 0 finished at 35, after slots 10, 20 and 30
+    assert schedule.advance(35.0) == (3, skipped)
+    assert schedule.due == due
+    assert schedule.slot == slot
+    assert schedule.stats["overruns"] == 1
+    assert schedule.stats["skipped"] == skipped
+
+
+def test_catchup_is_capped():
+    schedule = Schedule("publish", 1, policy=CATCHUP)
+    schedule.start(0.0, 0.0)
+    missed, skipped = schedule.advance(100.5)
+    assert missed == 100
+    assert skipped == missed - scheduler.MAX_CATCHUP
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Schedule("publish", 10, policy="later")
+
+
+def test_clock_step_realigns(monkeypatch):
+    events = []
+    runner = Scheduler(observer=lambda *event: events.append(event))
+    monkeypatch.setattr(scheduler.time, "monotonic", lambda: 100.0)
+    monkeypatch.setattr(scheduler.time, "time", lambda: 5000.0)
+    schedule = runner.add("publish", 60, align=True)
+    assert (schedule.due, schedule.slot) == (140.0, 5040.0)
+
+    # Wall clock stepped an hour forward without the monotonic clock moving
+    runner.checkClock(100.0, 8600.0)
+    assert (schedule.due, schedule.slot) == (140.0, 8640.0)
+
+
+def test_wait_reports_lateness(monkeypatch):
+    events = []
+    runner = Scheduler(observer=lambda *event: events.append(event))
+    clock = [100.0]
+    monkeypatch.setattr(scheduler.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(scheduler.time, "time", lambda: clock[0] + 1000.0)
+    schedule = runner.add("publish", 10)
+    clock[0] = 100.5
+    assert runner.wait() == [schedule]
+    assert events == [("publish", "late", 0.5)]
+
+    clock[0] = 125.0
+    runner.complete([schedule])
+    assert ("publish", "overrun", 1) in events
+    assert ("publish", "skipped", 2) in events
+    runner.stop()
+    assert runner.wait() == []
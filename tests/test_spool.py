@@ -0,0 +1,101 @@
+import os
+
+from spool import Spool
+
+
+def fill(spool, count, start=0):
+    for index in range(start, start + count):
+        spool.append("powerpi/test", "payload {}".format(index), qos=1, timestamp=index)
+
+
+def payloads(messages):
+    return [message[1] for _, message in messages]
+
+
+def test_round_trip_and_ack(tmp_path):
+    spool = Spool(str(tmp_path))
+    fill(spool, 3)
+    messages = spool.read(10)
+    assert payloads(messages) == [b"payload 0", b"payload 1", b"payload 2"]
+    topic, payload, qos, retain, timestamp = messages[0][1]
+    assert (topic, qos, retain, timestamp) == ("powerpi/test", 1, False, 0)
+
+    spool.ack(messages[1][0])
+    assert payloads(spool.read(10)) == [b"payload 2"]
+    spool.ack(messages[2][0])
+    assert spool.read(10) == []
+    assert spool.pending() == 0
+
+
+def test_position_survives_restart(tmp_path):
+    spool = Spool(str(tmp_path))
+    fill(spool, 3)
+    spool.ack(spool.read(1)[0][0])
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert payloads(spool.read(10)) == [b"payload 1", b"payload 2"]
+
+
+def test_torn_tail_is_cut_back_on_open(tmp_path):
+    spool = Spool(str(tmp_path))
+    fill(spool, 1)
+    spool.append("powerpi/test", "torn", timestamp=1)
+    spool.close()
+    # Power lost part way through the last record
+    segment = spool.segment(spool.writeseq)
+    os.truncate(segment, os.path.getsize(segment) - 3)
+
+    spool = Spool(str(tmp_path))
+    fill(spool, 2, start=2)
+    messages = spool.read(10)
+    assert payloads(messages) == [b"payload 0", b"payload 2", b"payload 3"]
+    spool.ack(messages[-1][0])
+    assert spool.read(10) == []
+    assert spool.pending() == 0
+
+
+def test_corrupt_record_is_skipped(tmp_path):
+    spool = Spool(str(tmp_path))
+    fill(spool, 2)
+    # Damage the second record while the spool is open
+    segment = spool.segment(spool.writeseq)
+    size = os.path.getsize(segment)
+    with open(segment, "r+b") as file:
+        file.seek(size - 1)
+        file.write(b"X")
+
+    messages = spool.read(10)
+    assert payloads(messages) == [b"payload 0"]
+    # Writing moves past the damage rather than appending behind it
+    fill(spool, 1, start=2)
+    messages = spool.read(10)
+    assert payloads(messages) == [b"payload 0", b"payload 2"]
+    spool.ack(messages[-1][0])
+    assert spool.read(10) == []
+    assert spool.pending() == 0
+
+
+def test_oldest_segments_are_dropped(tmp_path):
+    spool = Spool(str(tmp_path), maxbytes=4096, segmentbytes=1024)
+    fill(spool, 200)
+    assert spool.pending() <= 4096
+    messages = spool.read(1000)
+    assert payloads(messages)[-1] == b"payload 199"
+    assert b"payload 0" not in payloads(messages)
+
+
+def test_ack_after_trim_does_not_strand_messages(tmp_path):
+    spool = Spool(str(tmp_path), maxbytes=2000, segmentbytes=500)
+    fill(spool, 2)
+    messages = spool.read(2)
+    # The broker dropped during replay, new messages trim the segment being read
+    fill(spool, 80, start=2)
+    assert 0 not in spool.sizes
+    spool.ack(messages[-1][0])
+
+    assert spool.readseq in spool.sizes
+    remaining = spool.read(100)
+    assert payloads(remaining)[-1] == b"payload 81"
+    spool.ack(remaining[-1][0])
+    assert spool.pending() == 0